@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import zipfile
+from pathlib import Path
+from executors import run_in_process, run_in_thread
+from pdf_parser import extract_invoice_data
+from uploads import UPLOAD_CHUNK_SIZE, UPLOAD_MAX_BYTES, UploadTooLarge
+from uploads import check_page_budget
+from validate import validate
+from xrechnung_generator import generate_xrechnung
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Conversions of one batch running at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "2000"))
+BATCH_VALIDATE = os.getenv("BATCH_VALIDATE", "1") == "1"
+
+
+def is_pdf_name(name):
+    name = Path(name).name
+    return name.lower().endswith(".pdf") and not name.startswith(("._", "."))
+
+
+def extract_entry(archive, info, target, max_bytes=UPLOAD_MAX_BYTES):
+    """Unpack the ZIP entry ``info`` to ``target``, at most ``max_bytes``.
+
+    The declared size is checked first, the bytes are counted while they
+    are written as well.
+    """
+    if info.file_size > max_bytes:
+        raise UploadTooLarge(f"Uploads are limited to {max_bytes} bytes")
+    size = 0
+    try:
+        with archive.open(info) as source, open(target, "wb") as f:
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Uploads are limited to {max_bytes} bytes")
+                f.write(chunk)
+    except BaseException:
+        Path(target).unlink(missing_ok=True)
+        raise
+
+
+def checked_pdf(path):
+    """``path``, or the ``UploadTooLarge`` error if the PDF has too many pages."""
+    try:
+        check_page_budget(str(path))
+    except UploadTooLarge as e:
+        return e
+    return path
+
+
+def iter_batch_sources(uploads, folder):
+    """Yield ``(name, pdf_path)`` for every PDF of the stored uploads.
+
+    ZIP archives are opened lazily and extracted one entry at a time, so only
+    the PDFs that are currently converted are unpacked. Entry names are never
+    used as paths. A PDF that is too large, has too many pages or cannot be
+    unpacked is yielded as ``(name, error)``, so the batch goes on.
+    """
+    for name, path in uploads:
+        if not name.lower().endswith(".zip"):
+            yield name, checked_pdf(path)
+            continue
+        try:
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not is_pdf_name(info.filename):
+                        continue
+                    target = Path(folder) / f"{uuid.uuid4().hex}.pdf"
+                    try:
+                        extract_entry(archive, info, target, UPLOAD_MAX_BYTES)
+                    except Exception as e:
+                        yield info.filename, e
+                        continue
+                    yield info.filename, checked_pdf(target)
+        except Exception as e:
+            yield name, e
+
+
+def count_batch_files(uploads):
+    count = 0
+    for name, path in uploads:
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(path) as archive:
+                count += sum(
+                    1
+                    for info in archive.infolist()
+                    if not info.is_dir() and is_pdf_name(info.filename)
+                )
+        else:
+            count += 1
+    return count
+
+
+async def convert_batch_file(name, pdf_path, validate_xml=BATCH_VALIDATE):
+    start_time = time.perf_counter()
+    result = {"file": name}
+    try:
+        if isinstance(pdf_path, Exception):
+            # Refused while it was unpacked, see iter_batch_sources
+            raise pdf_path
+        invoice_data = await run_in_thread(
+            extract_invoice_data, str(pdf_path), endpoint="batch"
+        )
+        xml_content = await run_in_process(generate_xrechnung, invoice_data)
+        result.update(status="ok", invoice=invoice_data, xml_content=xml_content)
+        if validate_xml:
+            xml_file = Path(pdf_path).with_suffix(".xml")
+            await run_in_thread(xml_file.write_text, xml_content)
+            result["validation"] = await run_in_thread(
+                validate, xml_file, xml_file.parent
+            )
+    except Exception as e:
+        logging.warning(f"Batch conversion of {name} failed: {e}")
+        result.update(status="error", error=str(e))
+    result["seconds"] = round(time.perf_counter() - start_time, 3)
+    return result
+
+
+async def stream_batch(sources, folder, concurrency=BATCH_CONCURRENCY):
+    """Convert the sources and yield one NDJSON line per file as it finishes.
+
+    At most ``concurrency`` files are in flight; the next source is only
+    taken (and unpacked) when a slot frees up. A summary line closes the
+    stream and the batch folder is removed afterwards.
+    """
+    sources = iter(sources)
+    pending = set()
+    summary = {"ok": 0, "error": 0}
+    start_time = time.perf_counter()
+    try:
+        while True:
+            while len(pending) < concurrency:
+                # Unpacking the next ZIP entry is file I/O as well
+                try:
+                    source = await run_in_thread(next, sources, None)
+                except Exception as e:
+                    # The sources cannot go on after raising
+                    logging.warning(f"Reading the batch failed: {e}")
+                    summary["error"] += 1
+                    yield json.dumps({"status": "error", "error": str(e)}) + "\n"
+                    source = None
+                    sources = iter(())
+                if source is None:
+                    break
+                pending.add(asyncio.create_task(convert_batch_file(*source)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                result = task.result()
+                summary[result["status"]] += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+        summary["seconds"] = round(time.perf_counter() - start_time, 3)
+        yield json.dumps({"summary": summary}) + "\n"
+    finally:
+        # Client went away: stop what is still running
+        for task in pending:
+            task.cancel()
+        shutil.rmtree(folder, ignore_errors=True)
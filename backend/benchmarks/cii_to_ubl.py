@@ -0,0 +1,56 @@
+"""Time the CII to UBL XRechnung conversion over the sample corpus.
+
+Run from the backend folder:
+
+    python benchmarks/cii_to_ubl.py [--rounds 5]
+"""
+
+import sys
+import argparse
+import logging
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cii_reader import convert_cii_files  # noqa: E402
+
+SAMPLES = Path("tests/samples")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--samples", type=Path, default=SAMPLES)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    paths = sorted(args.samples.glob("zugferd_*.xml"))
+    timings = {str(path): [] for path in paths}
+    errors = {}
+    for _ in range(args.rounds):
+        for result in convert_cii_files(paths):
+            timings[result["file"]].append(result["seconds"])
+            if "error" in result:
+                errors[result["file"]] = result["error"]
+
+    width = max(len(path.name) for path in paths)
+    print(f"{'file':<{width}}  {'median ms':>10}  {'min ms':>8}")
+    for path in paths:
+        seconds = timings[str(path)]
+        status = "  FAILED" if str(path) in errors else ""
+        print(
+            f"{path.name:<{width}}  {statistics.median(seconds) * 1000:>10.2f}"
+            f"  {min(seconds) * 1000:>8.2f}{status}"
+        )
+
+    medians = [statistics.median(seconds) for seconds in timings.values()]
+    print(
+        f"\n{len(paths)} files, {len(errors)} failed, "
+        f"total {sum(medians) * 1000:.1f} ms per round, "
+        f"median {statistics.median(medians) * 1000:.2f} ms per file"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compare the drafthorse and the lxml CII writers side by side.
+
+pdf_parser imports the model providers, so GEMINI_API_KEY must be set (any
+value will do). Run from the backend folder:
+
+    GEMINI_API_KEY=x python benchmarks/cii_writer.py [--rounds 3]
+"""
+
+import io
+import sys
+import time
+import argparse
+import logging
+import statistics
+import tracemalloc
+from pathlib import Path
+
+from lxml import etree
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cii_writer import generate_cii_xml  # noqa: E402
+from pdf_parser import generate_invoice_xml  # noqa: E402
+
+LINE_COUNTS = [10, 100, 1000, 5000]
+
+
+def synthetic_invoice(lines):
+    items = [
+        {
+            "line_id": str(line),
+            "product_name": f"Artikel {line}",
+            "agreement_net_price": 12.5,
+            "quantity": line % 9 + 1,
+            "settlement_tax": {"category": "S", "rate": 19.0},
+            "total_amount": round(12.5 * (line % 9 + 1) * 1.19, 2),
+        }
+        for line in range(1, lines + 1)
+    ]
+    return {
+        "header": {
+            "id": "R-2024-0001",
+            "name": "Rechnung",
+            "issue_date_time": "2024-02-01",
+            "languages": "de",
+            "notes": ["Vielen Dank"],
+        },
+        "trade": {
+            "agreement": {
+                "seller": {
+                    "name": "Muster GmbH",
+                    "tax_id": "DE123456789",
+                    "address": {"country_code": "DE"},
+                },
+                "buyer": {"name": "Kunde AG"},
+            },
+            "settlement": {
+                "currency_code": "EUR",
+                "payment_means": {"type_code": "58"},
+                "trade_tax": [{"category": "S", "rate": 19.0, "amount": 100.0}],
+                "monetary_summation": {"total": 1000.0, "tax_total": 100.0},
+            },
+            "items": items,
+        },
+    }
+
+
+def canonical(xml):
+    parser = etree.XMLParser(remove_blank_text=True)
+    return etree.tostring(etree.fromstring(xml.encode(), parser), method="c14n")
+
+
+def measure(write, data, rounds):
+    seconds = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        write(data)
+        seconds.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    write(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(seconds), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--lines", type=int, nargs="*", default=LINE_COUNTS)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    variants = [
+        ("drafthorse", generate_invoice_xml),
+        ("lxml", lambda data: generate_cii_xml(data, validate=True)),
+        ("lxml-novalid", lambda data: generate_cii_xml(data, validate=False)),
+    ]
+    print(f"{'lines':>6}  {'writer':<13}  {'median ms':>10}  {'peak MiB':>9}")
+    for lines in args.lines:
+        data = synthetic_invoice(lines)
+        if canonical(generate_invoice_xml(data)) != canonical(generate_cii_xml(data)):
+            sys.exit(f"The writers disagree on {lines} lines")
+        for name, write in variants:
+            seconds, peak = measure(write, data, args.rounds)
+            print(
+                f"{lines:>6}  {name:<13}  {seconds * 1000:>10.2f}"
+                f"  {peak / 1024**2:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
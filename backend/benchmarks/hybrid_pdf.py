@@ -0,0 +1,151 @@
+"""Compare the incremental hybrid update with rewriting the whole PDF.
+
+Builds scan-like PDFs of ``--sizes`` MiB (one incompressible image per
+page) and embeds the same XML with ``hybrid_pdf.build_update``, with
+``drafthorse.pdf.attach_xml`` and with a pypdf writer. Run from the backend
+folder:
+
+    python benchmarks/hybrid_pdf.py [--sizes 5 20 50] [--rounds 3]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import statistics
+import tracemalloc
+from pathlib import Path
+
+from drafthorse.pdf import attach_xml
+from pypdf import PdfReader, PdfWriter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from hybrid_pdf import build_update  # noqa: E402
+
+SAMPLE = Path("tests/samples/zugferd_2p1_EN16931_Einfach.xml")
+SIZES = [5, 20, 50]
+# One A4 page scanned at ~150 dpi is a few MiB of image data
+PAGE_BYTES = 2 * 1024 * 1024
+
+
+def scanned_pdf(path, size_mib):
+    """A PDF of ``size_mib`` MiB, one random RGB image per page."""
+    pages = max(1, size_mib * 1024 * 1024 // PAGE_BYTES)
+    side = int((PAGE_BYTES / 3) ** 0.5)
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>"}
+    kids = []
+    for page in range(pages):
+        image, content, number = 3 + page * 3, 4 + page * 3, 5 + page * 3
+        objects[image] = (
+            (
+                f"<< /Type /XObject /Subtype /Image /Width {side} /Height {side} "
+                "/ColorSpace /DeviceRGB /BitsPerComponent 8 "
+                f"/Length {side * side * 3} >>"
+                "\nstream\n"
+            ).encode()
+            + os.urandom(side * side * 3)
+            + b"\nendstream"
+        )
+        drawing = b"q 595 0 0 842 0 0 cm /Im Do Q"
+        objects[content] = (
+            f"<< /Length {len(drawing)} >>\nstream\n".encode()
+            + drawing
+            + b"\nendstream"
+        )
+        objects[number] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /XObject << /Im {image} 0 R >> >> "
+            f"/Contents {content} 0 R >>"
+        ).encode()
+        kids.append(f"{number} 0 R")
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode()
+
+    offsets = {}
+    with open(path, "wb") as pdf:
+        pdf.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        for number in sorted(objects):
+            offsets[number] = pdf.tell()
+            pdf.write(f"{number} 0 obj\n".encode() + objects[number] + b"\nendobj\n")
+        xref = pdf.tell()
+        pdf.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f\r\n".encode())
+        for number in sorted(objects):
+            pdf.write(f"{offsets[number]:010d} 00000 n\r\n".encode())
+        pdf.write(
+            f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+            f"startxref\n{xref}\n%%EOF\n".encode()
+        )
+
+
+def incremental(pdf_path, xml, output_path):
+    with open(pdf_path, "rb") as pdf_file:
+        update = build_update(pdf_file, xml)
+    shutil.copyfile(pdf_path, output_path)
+    with open(output_path, "ab") as output:
+        output.write(update)
+
+
+def update_only(pdf_path, xml, output_path):
+    # What /convert/hybrid computes, the PDF itself is streamed as is
+    with open(pdf_path, "rb") as pdf_file:
+        build_update(pdf_file, xml)
+
+
+def drafthorse_rewrite(pdf_path, xml, output_path):
+    Path(output_path).write_bytes(attach_xml(Path(pdf_path).read_bytes(), xml))
+
+
+def pypdf_rewrite(pdf_path, xml, output_path):
+    writer = PdfWriter(clone_from=PdfReader(pdf_path))
+    writer.add_attachment("factur-x.xml", xml)
+    with open(output_path, "wb") as output:
+        writer.write(output)
+
+
+def measure(embed, pdf_path, xml, output_path, rounds):
+    seconds = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        embed(pdf_path, xml, output_path)
+        seconds.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    embed(pdf_path, xml, output_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(seconds), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--sizes", type=int, nargs="*", default=SIZES)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("drafthorse").setLevel(logging.WARNING)
+
+    xml = SAMPLE.read_bytes()
+    variants = [
+        ("update", update_only),
+        ("update+copy", incremental),
+        ("drafthorse", drafthorse_rewrite),
+        ("pypdf", pypdf_rewrite),
+    ]
+    print(f"{'MiB':>4}  {'variant':<12}  {'median ms':>10}  {'peak MiB':>9}")
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            pdf_path = os.path.join(folder, f"scan_{size}.pdf")
+            output_path = os.path.join(folder, "hybrid.pdf")
+            scanned_pdf(pdf_path, size)
+            for name, embed in variants:
+                seconds, peak = measure(embed, pdf_path, xml, output_path, args.rounds)
+                print(
+                    f"{size:>4}  {name:<12}  {seconds * 1000:>10.2f}"
+                    f"  {peak / 1024**2:>9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Compare the chained post-processing passes with the single-pass normalizer.
+
+Builds a synthetic invoice answer with ``--lines`` line items. Run from the
+backend folder:
+
+    python benchmarks/normalize.py [--lines 10000] [--rounds 5]
+"""
+
+import sys
+import copy
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import (  # noqa: E402
+    fix_settlement_tax,
+    format_dates,
+    normalize_invoice,
+    remove_nulls,
+    replace_value_in_dict,
+)
+
+
+def synthetic_invoice(lines):
+    items = [
+        {
+            "line_id": str(line),
+            "product_name": f"Artikel {line}",
+            "period_start": "2024-01-01T00:00:00Z",
+            "period_end": None,
+            "agreement_net_price": 1.25,
+            "quantity": line % 7 + 1,
+            "delivery_details": round(1.25 * (line % 7 + 1), 2),
+            "settlement_tax": {"category": "S", "rate": 19.0, "amount": None},
+            "total_amount": None,
+            "id": None,
+            "order_position": None,
+            "description": "Wartung und Ersatzteile",
+            "quantity_unit": "C62",
+        }
+        for line in range(1, lines + 1)
+    ]
+    return {
+        "header": {
+            "id": "R-2024-0001",
+            "leitweg_id": "LEITWEGID-12345ABCXYZ-00",
+            "issue_date_time": "2024-02-01T00:00:00Z",
+            "notes": ["Vielen Dank"],
+        },
+        "trade": {
+            "agreement": {
+                "seller": {"name": "Muster GmbH", "tax_id": "321/312/54321"},
+                "buyer": {"name": "Kunde AG", "order_id": "BUYER-2019-0789"},
+            },
+            "settlement": {"currency_code": "EUR", "payment_reference": None},
+            "items": items,
+        },
+    }
+
+
+def chained(data):
+    data = replace_value_in_dict(data, "leitweg_id", "LEITWEGID-12345ABCXYZ-00", 0)
+    data = replace_value_in_dict(data, "leitweg_id", "string", 0)
+    data = replace_value_in_dict(data, "tax_id", "321/312/54321", None)
+    data = replace_value_in_dict(data, "order_id", "SELLER-2019-0789", None)
+    data = replace_value_in_dict(data, "order_id", "BUYER-2019-0789", None)
+    data = remove_nulls(data)
+    data = format_dates(data)
+    return fix_settlement_tax(data)
+
+
+def timings(normalize, invoice, rounds):
+    seconds = []
+    for _ in range(rounds):
+        # Both variants may change their input, each round gets a fresh copy
+        data = copy.deepcopy(invoice)
+        start_time = time.perf_counter()
+        normalize(data)
+        seconds.append(time.perf_counter() - start_time)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    invoice = synthetic_invoice(args.lines)
+    if chained(copy.deepcopy(invoice)) != normalize_invoice(copy.deepcopy(invoice)):
+        sys.exit("The normalizer and the chained passes disagree")
+
+    print(f"{'variant':<12}  {'median ms':>10}  {'min ms':>8}")
+    medians = {}
+    for name, normalize in [("chained", chained), ("single-pass", normalize_invoice)]:
+        seconds = timings(normalize, invoice, args.rounds)
+        medians[name] = statistics.median(seconds)
+        print(f"{name:<12}  {medians[name] * 1000:>10.2f}  {min(seconds) * 1000:>8.2f}")
+    print(
+        f"\n{args.lines} lines, single pass is "
+        f"{medians['chained'] / medians['single-pass']:.1f}x faster"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Measure /ping latency while PDF conversions are in flight.
+
+Start the API first (``uvicorn main:app``), then run from the backend folder:
+
+    python benchmarks/ping_load.py --url http://localhost:8000 --conversions 8
+
+The ping latency is measured once on an idle server and once while
+``--conversions`` uploads of ``--pdf`` are running; both should stay flat.
+"""
+
+import time
+import asyncio
+import argparse
+import statistics
+from pathlib import Path
+
+import httpx
+
+ORIGIN = "https://pdftoxrechnung.de"
+
+
+async def ping_latencies(client, until, interval):
+    latencies = []
+    while not until.is_set():
+        start_time = time.perf_counter()
+        await client.get("/ping")
+        latencies.append(time.perf_counter() - start_time)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def upload(client, pdf, index):
+    start_time = time.perf_counter()
+    response = await client.post(
+        "/upload",
+        files={"file": (pdf.name, pdf.read_bytes(), "application/pdf")},
+        headers={
+            "X-Session-ID": f"load-test-{index}",
+            "X-Cache-Bypass": "1",
+            "Origin": ORIGIN,
+        },
+    )
+    return response.status_code, time.perf_counter() - start_time
+
+
+def report(name, latencies):
+    latencies = sorted(latency * 1000 for latency in latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else 0
+    print(
+        f"{name:<12} n={len(latencies):<5} p50={statistics.median(latencies):8.2f} ms"
+        f"  p95={p95:8.2f} ms  max={latencies[-1]:8.2f} ms"
+    )
+
+
+async def main(args):
+    async with httpx.AsyncClient(base_url=args.url, timeout=600) as client:
+        idle = asyncio.Event()
+        pinger = asyncio.create_task(ping_latencies(client, idle, args.interval))
+        await asyncio.sleep(args.idle_seconds)
+        idle.set()
+        report("idle", await pinger)
+
+        busy = asyncio.Event()
+        pinger = asyncio.create_task(ping_latencies(client, busy, args.interval))
+        uploads = await asyncio.gather(
+            *(upload(client, args.pdf, i) for i in range(args.conversions))
+        )
+        busy.set()
+        report("converting", await pinger)
+
+    for status, seconds in uploads:
+        print(f"upload -> {status} in {seconds:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--pdf", type=Path, default=Path("tests/samples/output.pdf"))
+    parser.add_argument("--conversions", type=int, default=8)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--idle-seconds", type=float, default=3)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,85 @@
+"""Compare extraction latency and prompt tokens with and without prompt caching.
+
+Needs GEMINI_API_KEY (gemini) or a running Ollama (ollama). Ollama caches
+the common prompt prefix on the server, its uncached run is the first one
+after the model was loaded. Run from the backend folder:
+
+    python benchmarks/prompt_cache.py --provider gemini --runs 5
+"""
+
+import sys
+import time
+import argparse
+import logging
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gemini_integration  # noqa: E402
+import ollama_integration  # noqa: E402
+from text_layer import read_text_layers  # noqa: E402
+
+
+def run(provider, pdf, pdf_text, runs):
+    latencies = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        if provider == "gemini":
+            gemini_integration.process_with_gemini(str(pdf), pdf_text)
+        else:
+            ollama_integration.process_with_ollama(pdf_text)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def stats(provider):
+    if provider == "gemini":
+        return gemini_integration.gemini_stats()
+    return ollama_integration.ollama_stats()
+
+
+def measure(provider, pdf, pdf_text, runs, cached):
+    if provider == "gemini":
+        gemini_integration.GEMINI_PROMPT_CACHE = cached
+    if cached:
+        # Cache creation / prefix evaluation is a one-off, keep it out of the numbers
+        run(provider, pdf, pdf_text, 1)
+
+    before = stats(provider)
+    latencies = run(provider, pdf, pdf_text, runs)
+    after = stats(provider)
+    calls = after["calls"] - before["calls"]
+    prompt_tokens = (after["prompt_tokens"] - before["prompt_tokens"]) / calls
+    line = (
+        f"{'cached' if cached else 'uncached':<9} "
+        f"median {statistics.median(latencies):7.3f} s  "
+        f"min {min(latencies):7.3f} s  "
+        f"prompt tokens/call {prompt_tokens:8.0f}"
+    )
+    if provider == "gemini":
+        cached_tokens = (after["cached_tokens"] - before["cached_tokens"]) / calls
+        line += f"  cached tokens/call {cached_tokens:8.0f}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--provider", choices=["gemini", "ollama"], default="gemini")
+    parser.add_argument("--pdf", type=Path, default=Path("tests/samples/output.pdf"))
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    pdf_text = "\n".join(page["text"] for page in read_text_layers(str(args.pdf)))
+    if args.provider == "gemini":
+        report = gemini_integration.prompt_token_report()
+        print(f"static prompt: {report['static_prompt_tokens']} tokens")
+        print(f"invoice text:  {len(pdf_text)} characters\n")
+
+    measure(args.provider, args.pdf, pdf_text, args.runs, cached=False)
+    measure(args.provider, args.pdf, pdf_text, args.runs, cached=True)
+
+
+if __name__ == "__main__":
+    main()
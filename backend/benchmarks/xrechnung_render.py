@@ -0,0 +1,97 @@
+"""Time the XRechnung rendering for invoices of 10 to 50,000 line items.
+
+Compares parsing the template per call (the old way), the cached template
+and the chunked stream, including the peak memory of each. Run from the
+backend folder:
+
+    python benchmarks/xrechnung_render.py [--rounds 3]
+"""
+
+import sys
+import copy
+import time
+import argparse
+import logging
+import statistics
+import tracemalloc
+from pathlib import Path
+
+from jinja2 import Template
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cii_reader import parse_cii, xrechnung_data  # noqa: E402
+from xrechnung_generator import (  # noqa: E402
+    TEMPLATE_FOLDER,
+    XRECHNUNG_TEMPLATE,
+    generate_xrechnung,
+    generate_xrechnung_stream,
+    xrechnung_invoice,
+)
+
+SAMPLE = Path("tests/samples/zugferd_2p1_EN16931_Einfach.xml")
+LINE_COUNTS = [10, 100, 1000, 10000, 50000]
+
+
+def uncached(invoice_data):
+    with open(Path(TEMPLATE_FOLDER) / XRECHNUNG_TEMPLATE) as f:
+        template = Template(f.read(), autoescape=True)
+    return template.render(data=xrechnung_invoice(invoice_data))
+
+
+def streamed(invoice_data):
+    # Drain the stream the way a response or a file would
+    size = 0
+    for chunk in generate_xrechnung_stream(invoice_data):
+        size += len(chunk)
+    return size
+
+
+def with_lines(invoice_data, lines):
+    data = copy.deepcopy(invoice_data)
+    item = data["trade"]["items"][0]
+    data["trade"]["items"] = [
+        {**item, "line_id": str(line)} for line in range(1, lines + 1)
+    ]
+    return data
+
+
+def measure(render, data, rounds):
+    seconds = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        render(data)
+        seconds.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    render(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(seconds), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--lines", type=int, nargs="*", default=LINE_COUNTS)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    invoice_data = xrechnung_data(parse_cii(SAMPLE))
+    variants = [
+        ("uncached", uncached),
+        ("cached", generate_xrechnung),
+        ("stream", streamed),
+    ]
+    print(f"{'lines':>6}  {'variant':<9}  {'median ms':>10}  {'peak MiB':>9}")
+    for lines in args.lines:
+        data = with_lines(invoice_data, lines)
+        for name, render in variants:
+            seconds, peak = measure(render, data, args.rounds)
+            print(
+                f"{lines:>6}  {name:<9}  {seconds * 1000:>10.2f}"
+                f"  {peak / 1024**2:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
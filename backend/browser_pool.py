@@ -0,0 +1,248 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager, suppress
+from selenium.common.exceptions import TimeoutException
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Browsers kept open per provider, each one converts one invoice at a time
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))
+# Browsers are restarted after this many invoices to keep memory in check
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "50"))
+BROWSER_CHECKOUT_TIMEOUT = float(os.getenv("BROWSER_CHECKOUT_TIMEOUT", "600"))
+SCREENSHOT_FOLDER = os.getenv("SCREENSHOT_FOLDER", "screenshots")
+# Waits for an answer are cut into slices this long to notice a cancellation
+BROWSER_CANCEL_POLL = float(os.getenv("BROWSER_CANCEL_POLL", "1"))
+
+# Resolves once more elements than ``count`` match ``selector``; the page is
+# watched with a MutationObserver instead of being polled.
+WAIT_FOR_NEW_ELEMENT = """
+const [selector, count, done] = arguments;
+const found = () => document.querySelectorAll(selector).length > count;
+if (found()) return done(true);
+const observer = new MutationObserver(() => {
+    if (found()) {
+        observer.disconnect();
+        done(true);
+    }
+});
+observer.observe(document.body, {childList: true, subtree: true, attributes: true});
+"""
+
+_pools = []
+
+
+class Cancelled(Exception):
+    """The caller no longer needs the answer (e.g. a hedge was won elsewhere)."""
+
+
+def count_elements(sb, selector):
+    return sb.execute_script(
+        "return document.querySelectorAll(arguments[0]).length", selector
+    )
+
+
+def check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise Cancelled()
+
+
+def wait_for_new_element(sb, selector, count, timeout, cancelled=None):
+    """Block until the page adds a ``selector`` match beyond the first ``count``.
+
+    With a ``cancelled`` event the wait gives up with ``Cancelled`` within
+    ``BROWSER_CANCEL_POLL`` seconds of it being set.
+    """
+    if cancelled is None:
+        sb.driver.set_script_timeout(timeout)
+        sb.driver.execute_async_script(WAIT_FOR_NEW_ELEMENT, selector, count)
+        return
+
+    deadline = time.monotonic() + timeout
+    while True:
+        check_cancelled(cancelled)
+        remaining = deadline - time.monotonic()
+        sb.driver.set_script_timeout(max(min(BROWSER_CANCEL_POLL, remaining), 0))
+        try:
+            sb.driver.execute_async_script(WAIT_FOR_NEW_ELEMENT, selector, count)
+            return
+        except TimeoutException:
+            if remaining <= BROWSER_CANCEL_POLL:
+                raise
+
+
+def is_responsive(sb):
+    with suppress(Exception):
+        return sb.execute_script("return document.readyState") == "complete"
+    return False
+
+
+class BrowserSession:
+    def __init__(self, manager, sb):
+        self.manager = manager  # the entered SB() context
+        self.sb = sb
+        self.uses = 0
+        self.created = time.monotonic()
+
+    def close(self):
+        with suppress(Exception):
+            self.manager.__exit__(None, None, None)
+
+
+class BrowserPool:
+    """Long-lived browser sessions that are reused between invoices.
+
+    ``open_session`` returns an unentered ``SB(...)`` context and ``prepare``
+    gets the new browser ready (captcha, login), so both only run when a
+    browser is started. Sessions that fail a health check, raise while
+    checked out or reached ``max_uses`` are closed and replaced.
+    """
+
+    def __init__(
+        self,
+        name,
+        open_session,
+        prepare=None,
+        size=BROWSER_POOL_SIZE,
+        max_uses=BROWSER_MAX_USES,
+        healthy=is_responsive,
+    ):
+        self.name = name
+        self.open_session = open_session
+        self.prepare = prepare
+        self.size = size
+        self.max_uses = max_uses
+        self.healthy = healthy
+        self.idle = []  # the most recently used browser (the last) is warmest
+        self.lock = threading.Lock()
+        # Notified whenever a browser is given back or closed
+        self.available = threading.Condition(self.lock)
+        self.open = 0
+        self.metrics = {"started": 0, "reused": 0, "replaced": 0, "failed": 0}
+        _pools.append(self)
+
+    def start_session(self):
+        start_time = time.perf_counter()
+        manager = self.open_session()
+        session = BrowserSession(manager, manager.__enter__())
+        try:
+            if self.prepare is not None:
+                self.prepare(session.sb)
+        except Exception:
+            self.screenshot(session, "start")
+            session.close()
+            raise
+        self.metrics["started"] += 1
+        logging.info(
+            f"Started {self.name} browser in "
+            f"{time.perf_counter() - start_time:.3f} seconds"
+        )
+        return session
+
+    def acquire(self):
+        """An idle browser, or a new one while fewer than ``size`` are open.
+
+        Waits for a browser to be given back or closed, whichever comes
+        first, at most ``BROWSER_CHECKOUT_TIMEOUT`` seconds in all.
+        """
+        deadline = time.monotonic() + BROWSER_CHECKOUT_TIMEOUT
+        while True:
+            with self.available:
+                while not self.idle and self.open >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No {self.name} browser became available")
+                    self.available.wait(remaining)
+                if not self.idle:
+                    self.open += 1
+                    break
+                session = self.idle.pop()
+            if self.healthy(session.sb):
+                self.metrics["reused"] += 1
+                return session
+            logging.warning(f"Replacing unresponsive {self.name} browser")
+            self.metrics["replaced"] += 1
+            self.discard(session)
+
+        try:
+            return self.start_session()
+        except Exception:
+            self.closed()
+            raise
+
+    def release(self, session):
+        session.uses += 1
+        if session.uses >= self.max_uses:
+            self.discard(session)
+            return
+        with self.available:
+            self.idle.append(session)
+            self.available.notify()
+
+    def discard(self, session):
+        session.close()
+        self.closed()
+
+    def closed(self):
+        """Count a browser as closed, a waiting ``acquire`` may start one."""
+        with self.available:
+            self.open -= 1
+            self.available.notify()
+
+    @contextmanager
+    def checkout(self):
+        """Lend a browser, a screenshot is only taken when the work failed.
+
+        Work stopped with ``Cancelled`` gives the browser back as it is, the
+        next invoice starts a new conversation anyway.
+        """
+        session = self.acquire()
+        try:
+            yield session.sb
+        except Cancelled:
+            self.release(session)
+            raise
+        except BaseException:
+            self.metrics["failed"] += 1
+            self.screenshot(session, "failure")
+            self.discard(session)
+            raise
+        self.release(session)
+
+    def screenshot(self, session, reason):
+        path = os.path.join(
+            SCREENSHOT_FOLDER, f"{self.name}_{reason}_{int(time.time())}.png"
+        )
+        with suppress(Exception):
+            os.makedirs(SCREENSHOT_FOLDER, exist_ok=True)
+            session.sb.save_screenshot(path)
+            logging.info(f"Saved screenshot {path}")
+
+    def close(self):
+        with self.lock:
+            sessions, self.idle = self.idle, []
+        for session in sessions:
+            self.discard(session)
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.metrics,
+                "open": self.open,
+                "idle": len(self.idle),
+                "size": self.size,
+            }
+
+
+def browser_stats():
+    return {pool.name: pool.stats() for pool in _pools}
+
+
+def close_browser_pools():
+    for pool in _pools:
+        pool.close()
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+META_FILE = "meta.json"
+
+
+def content_hash(*parts):
+    """SHA-256 over the given byte/str parts, used as content-addressed key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """Bounded content-addressed store on the local disk.
+
+    Every entry lives in ``<directory>/<key[:2]>/<key>/`` and consists of a
+    ``meta.json`` payload plus any number of attached files. Entries are
+    written to a temporary directory and renamed into place, so concurrent
+    uvicorn workers can share the same store. The mtime of ``meta.json`` is the
+    creation time used for the TTL, the mtime of the entry directory is the
+    LRU timestamp that every read touches. Eviction drops expired entries first
+    and then the least recently used ones until ``max_entries`` is respected.
+    """
+
+    def __init__(self, directory, max_entries=1000, ttl=7 * 24 * 3600):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.puts = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return self.directory / key[:2] / key
+
+    def get(self, key):
+        """Return ``(payload, entry_dir)`` or ``None`` on a miss."""
+        entry = self.path(key)
+        try:
+            if self.expired(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+            payload = json.loads((entry / META_FILE).read_text())
+            os.utime(entry)
+            return payload, entry
+        except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+            return None
+
+    def expired(self, entry, now=None):
+        created = (entry / META_FILE).stat().st_mtime
+        return (now or time.time()) - created > self.ttl
+
+    def put(self, key, payload, files=None):
+        entry = self.path(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = entry.parent / f".tmp-{uuid.uuid4().hex}"
+        tmp.mkdir()
+        try:
+            for name, source in (files or {}).items():
+                shutil.copyfile(source, tmp / name)
+            (tmp / META_FILE).write_text(json.dumps(payload))
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+        except OSError as e:
+            logging.warning(f"Could not store cache entry {key}: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        with self.lock:
+            self.puts += 1
+            evict = self.puts % 32 == 1
+        if evict:
+            self.evict()
+
+    def evict(self):
+        if not self.directory.is_dir():
+            return
+        now = time.time()
+        entries = []
+        for shard in self.directory.iterdir():
+            if not shard.is_dir():
+                continue
+            for entry in shard.iterdir():
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(".tmp-"):
+                    # Leftover of a crashed writer
+                    if now - mtime > 3600:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                try:
+                    expired = self.expired(entry, now)
+                except FileNotFoundError:
+                    expired = True
+                if expired:
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    entries.append((mtime, entry))
+
+        entries.sort()
+        for _, entry in entries[: max(0, len(entries) - self.max_entries)]:
+            shutil.rmtree(entry, ignore_errors=True)
@@ -3,37 +3,71 @@ import re
 import json
 import time
 import logging
-from contextlib import suppress
+import threading
 from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from seleniumbase import SB  # SB is a simple SeleniumBase driver
-from utils import PROMPT, remove_nulls
+from browser_pool import (
+    BrowserPool,
+    check_cancelled,
+    count_elements,
+    wait_for_new_element,
+)
+from utils import PROMPT, normalize_invoice
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     level=logging.INFO,
 )
 
+CHATGPT_URL = "https://chatgpt.com/"
+CHATGPT_TIMEOUT = int(os.getenv("CHATGPT_TIMEOUT", "300"))
+# Shown below every finished answer
+ANSWER_DONE = "button[data-testid='copy-turn-action-button']"
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def prepare_chatgpt(sb, test=False):
+    sb.uc_open_with_reconnect(CHATGPT_URL)
+    if test:
+        sb.sleep(1)
+        sb.uc_gui_click_captcha()
+        sb.sleep(1)
+        sb.uc_gui_handle_captcha()
+        sb.sleep(1)
+    sb.wait_for_element_visible("#prompt-textarea", timeout=60)
+
+
+def chatgpt_pool(test=False):
+    with _pools_lock:
+        if test not in _pools:
+            _pools[test] = BrowserPool(
+                "chatgpt" if not test else "chatgpt_test",
+                lambda: SB(
+                    uc=True,
+                    test=test,
+                    # user_data_dir="./user_data",  # Reuse Chrome profile to persist login
+                ),
+                prepare=lambda sb: prepare_chatgpt(sb, test),
+            )
+        return _pools[test]
 
-def process_with_chatgpt(pdf_text, test=False):
-    """Main function to automate chat while caching login"""
+
+def process_with_chatgpt(pdf_text, test=False, cancelled=None):
+    """Ask a warm ChatGPT browser from the pool to extract the invoice
+
+    Gives up with ``browser_pool.Cancelled`` once ``cancelled`` is set.
+    """
     logging.info(f"Starting ChatGPT extraction process ...")
-    with SB(
-        uc=True,
-        test=test,
-        # user_data_dir="./user_data",  # Reuse Chrome profile to persist login
-    ) as sb:
-        url = "https://chatgpt.com/"
-        sb.uc_open_with_reconnect(url)
-        if test:
-            sb.sleep(1)
-            sb.uc_gui_click_captcha()
-            sb.sleep(1)
-            sb.uc_gui_handle_captcha()
-            sb.sleep(1)
-        sb.save_screenshot("screenshots/01_chatgpt_on_site.png")
+    start_time = time.perf_counter()
+    with chatgpt_pool(test).checkout() as sb:
+        # Nothing was sent yet if the answer is no longer needed
+        check_cancelled(cancelled)
+        sb.open(CHATGPT_URL)  # New conversation
         sb.click_if_visible('button[aria-label="Close dialog"]')
         sb.wait_for_element_visible("#prompt-textarea", timeout=60)
+        answers = count_elements(sb, ANSWER_DONE)
         chat_text_area = sb.find_element("id", "prompt-textarea")
         sb.execute_script(
             "arguments[0].innerHTML=arguments[1]",
@@ -42,19 +76,14 @@ def process_with_chatgpt(pdf_text, test=False):
         )
         chat_text_area.send_keys(Keys.ENTER)
 
-        sb.sleep(100)
-
-        # Save a screenshot for debugging issues
-        # if test:
-        sb.save_screenshot("screenshots/02_chatgpt_started_extraction.png")
-
         logging.info("Extracting pdf data into json ...")
-        sb.wait_for_element_visible(
-            "//button[@data-testid='copy-turn-action-button']", timeout=180
-        )
+        wait_for_new_element(sb, ANSWER_DONE, answers, CHATGPT_TIMEOUT, cancelled)
 
-        response = sb.find_element("[data-message-author-role='assistant'] code").text
+        code_blocks = sb.find_elements("[data-message-author-role='assistant'] code")
+        response = code_blocks[-1].text
         json_match = re.search(r"({.*})", response, re.DOTALL)
         json_str = json_match.group(1)
         logging.info(f"JSON String:\n{json_str}")
-        return remove_nulls(json.loads(json_str))
+        invoice_data = normalize_invoice(json.loads(json_str))
+    logging.info(f"ChatGPT answered in {time.perf_counter() - start_time:.3f} seconds")
+    return invoice_data
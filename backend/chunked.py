@@ -0,0 +1,226 @@
+import io
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pypdf import PdfReader, PdfWriter
+from gemini_integration import submit_gemini_items
+from hedging import hedged_call, is_invoice, submit as submit_invoice
+from ollama_integration import client as ollama_client, extract_items_with_ollama
+from utils import fix_settlement_tax
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+CHUNKED_EXTRACTION = os.getenv("CHUNKED_EXTRACTION", "1") == "1"
+# Invoices with at least this many pages of text are extracted in chunks,
+# shorter ones fit one prompt with the whole PDF
+CHUNKED_MIN_PAGES = int(os.getenv("CHUNKED_MIN_PAGES", "12"))
+# Pages per line-item call
+CHUNK_PAGES = int(os.getenv("CHUNK_PAGES", "2"))
+# Browser providers answer one prompt at a time, chunks would only queue up
+CHUNKED_MODELS = {"gemini", "ollama"}
+# Hedged calls wait for their providers on these threads
+CHUNKED_HEDGE_THREADS = int(os.getenv("CHUNKED_HEDGE_THREADS", "16"))
+
+_hedge_threads = ThreadPoolExecutor(
+    max_workers=CHUNKED_HEDGE_THREADS, thread_name_prefix="chunked"
+)
+_stats_lock = threading.Lock()
+_stats = {
+    "invoices": 0,
+    "chunks": 0,
+    "items": 0,
+    "duplicates": 0,
+    "sum_mismatches": 0,
+    "fallbacks": 0,
+}
+
+
+def count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def submit_header(model, pdf_text, pdf_bytes=None, cancelled=None):
+    return submit_invoice(model, pdf_text, pdf_bytes=pdf_bytes, cancelled=cancelled)
+
+
+def submit_items(model, pdf_text, cancelled=None):
+    if model == "gemini":
+        return submit_gemini_items(pdf_text)
+    return ollama_client.submit(extract_items_with_ollama(pdf_text))
+
+
+def is_item_list(items):
+    return isinstance(items, list)
+
+
+def start(policy, start_call, accept, kind=None, answered_by=None):
+    """A future of the call, raced against the secondary provider if any."""
+    if not policy["secondary"]:
+        return start_call(policy["primary"], None)
+    return _hedge_threads.submit(
+        hedged_call, policy, start_call, accept, kind, answered_by
+    )
+
+
+def edge_pages_pdf(pdf_file=None, pdf_bytes=None):
+    """A PDF of only the first and the last page, ``None`` without a PDF.
+
+    Gives the header call the layout (and the scan) of the pages with the
+    parties and the totals without sending the whole document.
+    """
+    if pdf_file is None and pdf_bytes is None:
+        return None
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes) if pdf_bytes else pdf_file)
+        writer = PdfWriter()
+        writer.add_page(reader.pages[0])
+        if len(reader.pages) > 1:
+            writer.add_page(reader.pages[-1])
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+    except Exception as e:
+        logging.warning(f"Could not cut the first and last page, sending text: {e}")
+        return None
+
+
+def page_chunks(pages, size=CHUNK_PAGES):
+    return ["\n".join(pages[i : i + size]) for i in range(0, len(pages), size)]
+
+
+def line_total(items):
+    return sum(item.get("delivery_details", 0) for item in items)
+
+
+def sums_up(items, summation):
+    """Line totals match the net total (plus charges, minus allowances)."""
+    net_total = summation.get("net_total")
+    if net_total is None:
+        return True
+    expected = (
+        line_total(items)
+        + summation.get("charge_total", 0)
+        - summation.get("allowance_total", 0)
+    )
+    return abs(expected - net_total) <= 0.01 * len(items) + 0.005
+
+
+def merge_items(chunks, summation):
+    """Concatenate the items of all chunks, dropping repeated ``line_id``s.
+
+    Items are repeated when a row is cut by a page break or a table header is
+    reprinted. Some invoices restart the numbering per section though, so the
+    items are kept as read when only those add up to ``summation``.
+    """
+    items = [item for chunk in chunks for item in chunk]
+    unique = []
+    seen = set()
+    for item in items:
+        line_id = str(item.get("line_id") or "").strip()
+        if line_id and line_id in seen:
+            continue
+        seen.add(line_id)
+        unique.append(item)
+
+    if len(unique) < len(items):
+        if not sums_up(unique, summation) and sums_up(items, summation):
+            logging.info("Line ids repeat but all items add up, keeping them")
+            return items
+        count("duplicates", len(items) - len(unique))
+    if not sums_up(unique, summation):
+        count("sum_mismatches")
+        logging.warning(
+            f"Line items add up to {line_total(unique):.2f}, "
+            f"the net total is {summation.get('net_total')}"
+        )
+    return unique
+
+
+def extract_chunked(
+    pages, model, pdf_file=None, pdf_bytes=None, policy=None, answered_by=None
+):
+    """Extract a long invoice with one call per few pages.
+
+    Header, parties and totals are read from the first and last page (their
+    text and, if the PDF is given, the pages themselves), the line items of
+    ``CHUNK_PAGES`` pages each in parallel calls. With a ``policy`` (see
+    ``hedging.extraction_policy``) every call is hedged like a whole
+    invoice; the line item calls only with a secondary in ``CHUNKED_MODELS``.
+    The providers that won a hedged call are added to ``answered_by``.
+    Returns ``None`` when the invoice is too short or the model does not
+    support it, and when a call failed, so the whole text is sent in one
+    prompt instead.
+    """
+    if policy is not None:
+        model = policy["primary"]
+    else:
+        policy = {"primary": model, "secondary": None, "percentile": 0.9}
+    pages = [page for page in pages if page.strip()]
+    if (
+        not CHUNKED_EXTRACTION
+        or model not in CHUNKED_MODELS
+        or len(pages) < CHUNKED_MIN_PAGES
+    ):
+        return None
+
+    start_time = time.perf_counter()
+    chunks = page_chunks(pages)
+    header_text = f"{pages[0]}\n{pages[-1]}"
+    header_pdf = edge_pages_pdf(pdf_file, pdf_bytes)
+    header = start(
+        policy,
+        lambda model, cancelled: submit_header(
+            model, header_text, header_pdf, cancelled
+        ),
+        is_invoice,
+        answered_by=answered_by,
+    )
+    items_policy = dict(policy)
+    if items_policy["secondary"] not in CHUNKED_MODELS:
+        items_policy["secondary"] = None
+    futures = [
+        start(
+            items_policy,
+            lambda model, cancelled, chunk=chunk: submit_items(model, chunk, cancelled),
+            is_item_list,
+            kind="items",
+            answered_by=answered_by,
+        )
+        for chunk in chunks
+    ]
+    try:
+        invoice_data = header.result()
+        items = [future.result() for future in futures]
+    except Exception as e:
+        logging.warning(f"Chunked extraction failed, using one prompt: {e}")
+        for future in [header, *futures]:
+            future.cancel()
+        count("fallbacks")
+        return None
+
+    trade = invoice_data.setdefault("trade", {})
+    summation = trade.get("settlement", {}).get("monetary_summation", {})
+    trade["items"] = merge_items(items, summation)
+    invoice_data = fix_settlement_tax(invoice_data)
+
+    with _stats_lock:
+        _stats["invoices"] += 1
+        _stats["chunks"] += len(chunks)
+        _stats["items"] += len(trade["items"])
+    logging.info(
+        f"Extracted {len(pages)} pages in {len(chunks)} chunks "
+        f"({len(trade['items'])} items) in "
+        f"{time.perf_counter() - start_time:.3f} seconds"
+    )
+    return invoice_data
+
+
+def chunked_stats():
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,525 @@
+import io
+import time
+import logging
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from xrechnung_generator import generate_xrechnung
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# ZUGFeRD 1.0 element names and their CII D16B (ZUGFeRD 2.x / Factur-X) names
+ALIASES = {
+    "CrossIndustryDocument": "CrossIndustryInvoice",
+    "HeaderExchangedDocument": "ExchangedDocument",
+    "SpecifiedSupplyChainTradeTransaction": "SupplyChainTradeTransaction",
+    "ApplicableSupplyChainTradeAgreement": "ApplicableHeaderTradeAgreement",
+    "ApplicableSupplyChainTradeDelivery": "ApplicableHeaderTradeDelivery",
+    "ApplicableSupplyChainTradeSettlement": "ApplicableHeaderTradeSettlement",
+    "SpecifiedSupplyChainTradeAgreement": "SpecifiedLineTradeAgreement",
+    "SpecifiedSupplyChainTradeDelivery": "SpecifiedLineTradeDelivery",
+    "SpecifiedSupplyChainTradeSettlement": "SpecifiedLineTradeSettlement",
+    "ApplicablePercent": "RateApplicablePercent",
+    # Header and line summations are told apart by their position
+    "SpecifiedTradeSettlementHeaderMonetarySummation": "SpecifiedTradeSettlementMonetarySummation",
+    "SpecifiedTradeSettlementLineMonetarySummation": "SpecifiedTradeSettlementMonetarySummation",
+}
+
+TRANSACTION = "SupplyChainTradeTransaction"
+AGREEMENT = (TRANSACTION, "ApplicableHeaderTradeAgreement")
+DELIVERY = (TRANSACTION, "ApplicableHeaderTradeDelivery")
+SETTLEMENT = (TRANSACTION, "ApplicableHeaderTradeSettlement")
+
+
+def local_name(tag):
+    name = tag.rsplit("}", 1)[-1]
+    return ALIASES.get(name, name)
+
+
+def text(elem):
+    return (elem.text or "").strip()
+
+
+def amount(elem):
+    return float(text(elem))
+
+
+def quantity(elem):
+    value = amount(elem)
+    return int(value) if value.is_integer() else value
+
+
+def date(elem):
+    """Dates in format 102 (``20190508``) become ``2019-05-08``."""
+    value = text(elem)
+    if elem.get("format", "102") == "102" and len(value) == 8:
+        return f"{value[:4]}-{value[4:6]}-{value[6:]}"
+    return value
+
+
+def put(target, keys, value):
+    for key in keys[:-1]:
+        target = target.setdefault(key, {})
+    target[keys[-1]] = value
+
+
+def tax_registration(target, elem):
+    # FC: Steuernummer, VA: USt-IdNr.
+    key = "tax_id" if elem.get("schemeID") == "FC" else "vat_id"
+    target[key] = text(elem)
+
+
+def electronic_address(target, elem):
+    target["electronic_address"] = text(elem)
+    if elem.get("schemeID"):
+        target["electronic_address_type_code"] = elem.get("schemeID")
+
+
+ADDRESS_FIELDS = {
+    ("PostcodeCode",): ("postal_zone",),
+    ("LineOne",): ("street_name",),
+    ("LineTwo",): ("street_name2",),
+    ("LineThree",): ("additional_info",),
+    ("CityName",): ("city_name",),
+    ("CountryID",): ("country_code",),
+    ("CountrySubDivisionName",): ("state",),
+}
+
+
+def party_fields(phone, email):
+    fields = {
+        ("ID",): ("id",),
+        ("Name",): ("name",),
+        ("Description",): ("legal_info",),
+        ("SpecifiedLegalOrganization", "ID"): ("handels_register_number",),
+        ("SpecifiedLegalOrganization", "TradingBusinessName"): ("trade_name",),
+        ("DefinedTradeContact", "PersonName"): ("contact_name",),
+        ("DefinedTradeContact", "TelephoneUniversalCommunication", "CompleteNumber"): (
+            phone,
+        ),
+        ("DefinedTradeContact", "EmailURIUniversalCommunication", "URIID"): (email,),
+        ("URIUniversalCommunication", "URIID"): electronic_address,
+        ("SpecifiedTaxRegistration", "ID"): tax_registration,
+    }
+    for path, keys in ADDRESS_FIELDS.items():
+        fields[("PostalTradeAddress",) + path] = ("address",) + keys
+    return fields
+
+
+# Leaf paths from the document root to invoice keys (with an optional converter)
+DOCUMENT_FIELDS = {
+    ("ExchangedDocument", "ID"): ("header", "id"),
+    ("ExchangedDocument", "Name"): ("header", "name"),
+    ("ExchangedDocument", "TypeCode"): ("header", "type_code"),
+    ("ExchangedDocument", "LanguageID"): ("header", "languages"),
+    ("ExchangedDocument", "IssueDateTime", "DateTimeString"): (
+        ("header", "issue_date_time"),
+        date,
+    ),
+    AGREEMENT + ("BuyerReference",): ("header", "leitweg_id"),
+    AGREEMENT
+    + ("SellerOrderReferencedDocument", "IssuerAssignedID"): (
+        "trade",
+        "agreement",
+        "seller",
+        "order_id",
+    ),
+    AGREEMENT
+    + ("BuyerOrderReferencedDocument", "IssuerAssignedID"): (
+        "trade",
+        "agreement",
+        "buyer",
+        "order_id",
+    ),
+    AGREEMENT
+    + ("ContractReferencedDocument", "IssuerAssignedID"): (
+        "trade",
+        "agreement",
+        "contract_reference",
+    ),
+    AGREEMENT
+    + ("SpecifiedProcuringProject", "ID"): (
+        "trade",
+        "agreement",
+        "project_reference",
+    ),
+    DELIVERY
+    + ("ActualDeliverySupplyChainEvent", "OccurrenceDateTime", "DateTimeString"): (
+        ("trade", "delivery", "date"),
+        date,
+    ),
+    DELIVERY
+    + ("DespatchAdviceReferencedDocument", "IssuerAssignedID"): (
+        "trade",
+        "delivery",
+        "delivery_note_id",
+    ),
+    SETTLEMENT + ("InvoiceCurrencyCode",): ("trade", "settlement", "currency_code"),
+    SETTLEMENT + ("PaymentReference",): ("trade", "settlement", "payment_reference"),
+    SETTLEMENT + ("PayeeTradeParty", "Name"): ("trade", "settlement", "payee", "name"),
+    SETTLEMENT
+    + ("InvoiceeTradeParty", "Name"): ("trade", "settlement", "invoicee", "name"),
+    SETTLEMENT
+    + ("SpecifiedTradeSettlementPaymentMeans", "TypeCode"): (
+        "trade",
+        "settlement",
+        "payment_means",
+        "type_code",
+    ),
+    SETTLEMENT
+    + (
+        "SpecifiedTradeSettlementPaymentMeans",
+        "PayeePartyCreditorFinancialAccount",
+        "IBANID",
+    ): ("trade", "settlement", "payment_means", "iban"),
+    SETTLEMENT
+    + (
+        "SpecifiedTradeSettlementPaymentMeans",
+        "PayeePartyCreditorFinancialAccount",
+        "AccountName",
+    ): ("trade", "settlement", "payment_means", "account_name"),
+    SETTLEMENT
+    + (
+        "SpecifiedTradeSettlementPaymentMeans",
+        "PayeeSpecifiedCreditorFinancialInstitution",
+        "BICID",
+    ): ("trade", "settlement", "payment_means", "bic"),
+    SETTLEMENT
+    + ("BillingSpecifiedPeriod", "StartDateTime", "DateTimeString"): (
+        ("trade", "start_date"),
+        date,
+    ),
+    SETTLEMENT
+    + ("BillingSpecifiedPeriod", "EndDateTime", "DateTimeString"): (
+        ("trade", "end_date"),
+        date,
+    ),
+    SETTLEMENT
+    + ("SpecifiedTradePaymentTerms", "Description"): (
+        "trade",
+        "settlement",
+        "payment_terms",
+    ),
+    SETTLEMENT
+    + ("SpecifiedTradePaymentTerms", "DueDateDateTime", "DateTimeString"): (
+        ("trade", "settlement", "advance_payment_date"),
+        date,
+    ),
+    SETTLEMENT
+    + ("InvoiceReferencedDocument", "IssuerAssignedID"): (
+        "trade",
+        "agreement",
+        "previous_billing_reference",
+    ),
+    SETTLEMENT
+    + ("InvoiceReferencedDocument", "FormattedIssueDateTime", "DateTimeString"): (
+        ("trade", "agreement", "previous_billing_date"),
+        date,
+    ),
+}
+
+SUMMATION = SETTLEMENT + ("SpecifiedTradeSettlementMonetarySummation",)
+for name, key in {
+    "LineTotalAmount": "net_total",
+    "ChargeTotalAmount": "charge_total",
+    "AllowanceTotalAmount": "allowance_total",
+    "TaxBasisTotalAmount": "tax_basis_total",
+    "TaxTotalAmount": "tax_total",
+    "GrandTotalAmount": "grand_total",
+    "TotalPrepaidAmount": "paid_amount",
+    "RoundingAmount": "rounding_amount",
+    "DuePayableAmount": "due_amount",
+}.items():
+    DOCUMENT_FIELDS[SUMMATION + (name,)] = (
+        ("trade", "settlement", "monetary_summation", key),
+        amount,
+    )
+
+
+def tax_total(invoice, elem):
+    # A second TaxTotalAmount holds the tax in accounting currency
+    summation = invoice["trade"]["settlement"]["monetary_summation"]
+    summation.setdefault("tax_total", amount(elem))
+
+
+DOCUMENT_FIELDS[SUMMATION + ("TaxTotalAmount",)] = tax_total
+
+ITEM_FIELDS = {
+    ("AssociatedDocumentLineDocument", "LineID"): ("line_id",),
+    ("SpecifiedTradeProduct", "Name"): ("product_name",),
+    ("SpecifiedTradeProduct", "SellerAssignedID"): ("id",),
+    ("SpecifiedTradeProduct", "Description"): ("description",),
+    ("SpecifiedLineTradeAgreement", "NetPriceProductTradePrice", "ChargeAmount"): (
+        ("agreement_net_price",),
+        amount,
+    ),
+    ("SpecifiedLineTradeAgreement", "BuyerOrderReferencedDocument", "LineID"): (
+        "order_position",
+    ),
+    ("SpecifiedLineTradeDelivery", "BilledQuantity"): (("quantity",), quantity),
+    ("SpecifiedLineTradeSettlement", "ApplicableTradeTax", "CategoryCode"): (
+        "settlement_tax",
+        "category",
+    ),
+    ("SpecifiedLineTradeSettlement", "ApplicableTradeTax", "RateApplicablePercent"): (
+        ("settlement_tax", "rate"),
+        amount,
+    ),
+    (
+        "SpecifiedLineTradeSettlement",
+        "BillingSpecifiedPeriod",
+        "StartDateTime",
+        "DateTimeString",
+    ): (("period_start",), date),
+    (
+        "SpecifiedLineTradeSettlement",
+        "BillingSpecifiedPeriod",
+        "EndDateTime",
+        "DateTimeString",
+    ): (("period_end",), date),
+    (
+        "SpecifiedLineTradeSettlement",
+        "SpecifiedTradeSettlementMonetarySummation",
+        "LineTotalAmount",
+    ): (("delivery_details",), amount),
+}
+
+TAX_FIELDS = {
+    ("CalculatedAmount",): (("amount",), amount),
+    ("CategoryCode",): ("category",),
+    ("RateApplicablePercent",): (("rate",), amount),
+}
+
+ALLOWANCE_CHARGE_FIELDS = {
+    ("ChargeIndicator", "Indicator"): ("charge",),
+    ("CalculationPercent",): ("percent",),
+    ("BasisAmount",): ("basis_amount",),
+    ("ActualAmount",): ("amount",),
+    ("Reason",): ("reason",),
+    ("CategoryTradeTax", "CategoryCode"): ("tax_category",),
+    ("CategoryTradeTax", "RateApplicablePercent"): ("tax_rate",),
+}
+
+
+def finish_item(invoice, item):
+    item.setdefault("line_id", str(len(invoice["trade"]["items"]) + 1))
+    if "delivery_details" not in item and "agreement_net_price" in item:
+        item["delivery_details"] = round(
+            item["agreement_net_price"] * item.get("quantity", 1), 2
+        )
+    tax = item.setdefault("settlement_tax", {})
+    if "delivery_details" in item:
+        tax["amount"] = round(item["delivery_details"] * tax.get("rate", 0) / 100, 2)
+        item["total_amount"] = round(item["delivery_details"] + tax["amount"], 2)
+    invoice["trade"]["items"].append(item)
+
+
+def finish_allowance_charge(invoice, entry):
+    key = "charges" if entry.pop("charge", "false") == "true" else "allowances"
+    invoice["trade"].setdefault(key, []).append(entry)
+
+
+def finish_reference(invoice, entry):
+    # BT-18 (object identifier) is type 130, everything else a BT-17 style reference
+    key = (
+        "object_reference" if entry.get("type_code") == "130" else "document_reference"
+    )
+    if "id" in entry:
+        invoice["trade"]["agreement"].setdefault(key, entry["id"])
+
+
+def fixed(*keys):
+    def target(invoice):
+        for key in keys:
+            invoice = invoice.setdefault(key, {})
+        return invoice
+
+    return target
+
+
+def appended(invoice):
+    return {}
+
+
+# Sub-trees with their own field table: (target, fields, finish)
+CONTEXTS = {
+    AGREEMENT
+    + ("SellerTradeParty",): (
+        fixed("trade", "agreement", "seller"),
+        party_fields("phone", "email"),
+        None,
+    ),
+    AGREEMENT
+    + ("BuyerTradeParty",): (
+        fixed("trade", "agreement", "buyer"),
+        party_fields("contact_phone", "contact_email"),
+        None,
+    ),
+    AGREEMENT
+    + ("AdditionalReferencedDocument",): (
+        appended,
+        {("IssuerAssignedID",): ("id",), ("TypeCode",): ("type_code",)},
+        finish_reference,
+    ),
+    DELIVERY
+    + ("ShipToTradeParty",): (
+        fixed("trade", "delivery"),
+        {
+            ("ID",): ("location_id",),
+            ("Name",): ("recipient_name",),
+            **{
+                ("PostalTradeAddress",) + path: ("address",) + keys
+                for path, keys in ADDRESS_FIELDS.items()
+            },
+        },
+        None,
+    ),
+    SETTLEMENT
+    + ("ApplicableTradeTax",): (
+        appended,
+        TAX_FIELDS,
+        lambda invoice, tax: invoice["trade"]["settlement"]["trade_tax"].append(tax),
+    ),
+    SETTLEMENT
+    + ("SpecifiedTradeAllowanceCharge",): (
+        appended,
+        ALLOWANCE_CHARGE_FIELDS,
+        finish_allowance_charge,
+    ),
+    (TRANSACTION, "IncludedSupplyChainTradeLineItem"): (
+        appended,
+        ITEM_FIELDS,
+        finish_item,
+    ),
+}
+
+
+def assign(target, mapping, elem):
+    if callable(mapping):
+        mapping(target, elem)
+    elif isinstance(mapping[0], tuple):
+        keys, convert = mapping
+        put(target, keys, convert(elem))
+    else:
+        put(target, mapping, text(elem))
+
+
+def parse_cii(source):
+    """Map a ZUGFeRD/Factur-X CII document onto the invoice dict.
+
+    ``source`` is a file name, bytes or a binary file object. It is read
+    with ``iterparse``, line items are cleared as soon as they are mapped, so
+    memory stays flat for invoices with many lines. ZUGFeRD 1.0 documents are
+    read through ``ALIASES``.
+    """
+    invoice = {
+        "header": {"notes": []},
+        "trade": {
+            "agreement": {"seller": {"address": {}}, "buyer": {"address": {}}},
+            "settlement": {
+                "payment_means": {},
+                "trade_tax": [],
+                "monetary_summation": {},
+            },
+            "items": [],
+        },
+    }
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    path = []
+    context = None  # (depth, target, fields, finish)
+
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            path.append(local_name(elem.tag))
+            full_path = tuple(path[1:])
+            if context is None and full_path in CONTEXTS:
+                target, fields, finish = CONTEXTS[full_path]
+                context = (len(path), target(invoice), fields, finish)
+            continue
+
+        full_path = tuple(path[1:])
+        if context is not None:
+            depth, target, fields, finish = context
+            if len(path) == depth:
+                if finish is not None:
+                    finish(invoice, target)
+                context = None
+                elem.clear()
+            elif path[depth:] and tuple(path[depth:]) in fields:
+                assign(target, fields[tuple(path[depth:])], elem)
+        elif full_path == ("ExchangedDocument", "IncludedNote", "Content"):
+            invoice["header"]["notes"].append(text(elem))
+        elif full_path in DOCUMENT_FIELDS:
+            assign(invoice, DOCUMENT_FIELDS[full_path], elem)
+        path.pop()
+
+    return invoice
+
+
+def is_complete(invoice):
+    """Check that the mapped document carries what the XRechnung needs."""
+    header = invoice["header"]
+    trade = invoice["trade"]
+    summation = trade["settlement"]["monetary_summation"]
+    return bool(
+        header.get("id")
+        and header.get("issue_date_time")
+        and trade["agreement"]["seller"].get("name")
+        and trade["agreement"]["buyer"].get("name")
+        and "net_total" in summation
+        and "tax_total" in summation
+        and trade["items"]
+        and all("delivery_details" in item for item in trade["items"])
+    )
+
+
+def xrechnung_data(invoice):
+    """Fill what ``generate_xrechnung`` requires but lean profiles leave out.
+
+    MINIMUM and BASIC-WL documents have no line items and no line total, the
+    tax basis stands in for the net total there.
+    """
+    summation = invoice["trade"]["settlement"]["monetary_summation"]
+    if "net_total" not in summation:
+        summation["net_total"] = summation.get("tax_basis_total", 0.0)
+    summation.setdefault("tax_total", 0.0)
+    return invoice
+
+
+def convert_cii(source):
+    """Convert a CII document (see ``parse_cii``) to UBL XRechnung."""
+    return generate_xrechnung(xrechnung_data(parse_cii(source)))
+
+
+def convert_cii_files(paths, output_folder=None):
+    """Convert many CII files, one result dict per file in input order.
+
+    A broken file does not stop the batch, its result carries the ``error``.
+    With ``output_folder`` every XRechnung is written next to the others as
+    ``<stem>-xrechnung.xml``.
+    """
+    results = []
+    for path in paths:
+        path = Path(path)
+        start_time = time.perf_counter()
+        result = {"file": str(path)}
+        try:
+            xml_content = convert_cii(str(path))
+            if output_folder is not None:
+                output_file = Path(output_folder) / f"{path.stem}-xrechnung.xml"
+                output_file.write_text(xml_content)
+                result["output"] = str(output_file)
+            else:
+                result["xml_content"] = xml_content
+        except Exception as e:
+            logging.warning(f"Could not convert {path}: {e}")
+            result["error"] = str(e)
+        result["seconds"] = time.perf_counter() - start_time
+        results.append(result)
+
+    failed = sum("error" in result for result in results)
+    logging.info(f"Converted {len(results) - failed} of {len(results)} CII files")
+    return results
@@ -0,0 +1,334 @@
+import io
+import os
+import logging
+import threading
+from datetime import datetime
+import drafthorse
+from lxml import etree
+from drafthorse.models import NS_QDT, NS_RAM, NS_RSM, NS_UDT
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# "lxml" writes the CII directly, "drafthorse" builds the drafthorse Document
+CII_WRITER = os.getenv("CII_WRITER", "lxml")
+# Validate the written XML against the Factur-X EXTENDED schema
+CII_VALIDATE = os.getenv("CII_VALIDATE", "1") == "1"
+CII_SCHEMA = os.path.join(
+    os.path.dirname(drafthorse.__file__),
+    "schema",
+    "Factur-X_1.0.07_EXTENDED.xsd",
+)
+GUIDELINE_ID = "urn:cen.eu:en16931:2017#conformant#urn:factur-x.eu:1p0:extended"
+
+# Declared on the root like drafthorse does, even when unused
+NAMESPACES = {
+    "qdt": NS_QDT,
+    "ram": NS_RAM,
+    "rsm": NS_RSM,
+    "udt": NS_UDT,
+    "xs": "http://www.w3.org/2001/XMLSchema",
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+}
+
+_schema = None
+_schema_lock = threading.Lock()
+
+
+def rsm(tag):
+    return f"{{{NS_RSM}}}{tag}"
+
+
+def ram(tag):
+    return f"{{{NS_RAM}}}{tag}"
+
+
+def element(tag, *children, text=None, required=False, **attrib):
+    """A ``(tag, attrib, text, children)`` node, ``None`` when it is empty.
+
+    Mirrors drafthorse, which leaves out elements without text and children
+    unless they are required.
+    """
+    children = [child for child in children if child is not None]
+    text = "" if text is None else str(text)
+    if not children and not text and not required:
+        return None
+    return tag, attrib, text, children
+
+
+def emit(xf, node):
+    """Write ``node`` in the open ``xmlfile``, using the root's prefixes."""
+    tag, attrib, text, children = node
+    with xf.element(tag, attrib):
+        if text:
+            xf.write(text)
+        for child in children:
+            emit(xf, child)
+
+
+def date_time(tag, value, namespace=NS_UDT):
+    return element(
+        tag,
+        element(f"{{{namespace}}}DateTimeString", text=value, format="102"),
+    )
+
+
+def party(tag, name, address=None, tax_id="", required=False):
+    return element(
+        tag,
+        element(ram("Name"), text=name),
+        address,
+        element(
+            ram("SpecifiedTaxRegistration"),
+            element(ram("ID"), text=tax_id, schemeID="VA"),
+        ),
+        required=required,
+    )
+
+
+def order_document(tag, issue_date):
+    return element(
+        ram(tag), date_time(ram("FormattedIssueDateTime"), issue_date, NS_QDT)
+    )
+
+
+def line_item(item):
+    return element(
+        ram("IncludedSupplyChainTradeLineItem"),
+        element(
+            ram("AssociatedDocumentLineDocument"),
+            element(ram("LineID"), text=item.get("line_id", "")),
+            required=True,
+        ),
+        element(
+            ram("SpecifiedTradeProduct"),
+            element(ram("Name"), text=item.get("product_name", "")),
+        ),
+        element(
+            ram("SpecifiedLineTradeAgreement"),
+            element(
+                ram("GrossPriceProductTradePrice"),
+                element(
+                    ram("ChargeAmount"),
+                    text=round(item.get("agreement_net_price", 0), 2),
+                ),
+                element(
+                    ram("BasisQuantity"),
+                    text=round(item.get("quantity", 0)),
+                    unitCode="C62",
+                ),
+            ),
+            element(
+                ram("NetPriceProductTradePrice"),
+                element(
+                    ram("ChargeAmount"),
+                    text=round(item.get("agreement_net_price", 0), 2),
+                ),
+                element(
+                    ram("BasisQuantity"),
+                    text=round(item.get("agreement_net_price", 0)),
+                    unitCode="EUR",
+                ),
+            ),
+        ),
+        element(
+            ram("SpecifiedLineTradeDelivery"),
+            element(
+                ram("BilledQuantity"),
+                text=round(item.get("quantity", 0)),
+                unitCode="C62",
+            ),
+        ),
+        element(
+            ram("SpecifiedLineTradeSettlement"),
+            element(
+                ram("ApplicableTradeTax"),
+                element(ram("TypeCode"), text="VAT"),
+                element(
+                    ram("CategoryCode"),
+                    text=item["settlement_tax"].get("category", ""),
+                ),
+                element(
+                    ram("RateApplicablePercent"),
+                    text=round(item["settlement_tax"].get("rate", 0), 2),
+                ),
+            ),
+            element(
+                ram("SpecifiedTradeSettlementLineMonetarySummation"),
+                element(
+                    ram("LineTotalAmount"), text=round(item.get("total_amount", 0), 2)
+                ),
+            ),
+            required=True,
+        ),
+    )
+
+
+def header_elements(invoice_data, issue_date):
+    header = invoice_data["header"]
+    yield element(
+        rsm("ExchangedDocumentContext"),
+        element(
+            ram("GuidelineSpecifiedDocumentContextParameter"),
+            element(ram("ID"), text=GUIDELINE_ID),
+        ),
+        required=True,
+    )
+    yield element(
+        rsm("ExchangedDocument"),
+        element(ram("ID"), text=header.get("id", "")),
+        element(ram("Name"), text=header.get("name", "")),
+        element(ram("TypeCode"), text=header.get("type_code", "380")),
+        date_time(ram("IssueDateTime"), issue_date),
+        element(ram("LanguageID"), text=header.get("languages", "")),
+        *(
+            element(ram("IncludedNote"), element(ram("Content"), text=note))
+            for note in header.get("notes", [])
+        ),
+        required=True,
+    )
+
+
+def agreement_element(invoice_data, issue_date):
+    agreement = invoice_data["trade"]["agreement"]
+    seller = agreement["seller"]
+    return element(
+        ram("ApplicableHeaderTradeAgreement"),
+        party(
+            ram("SellerTradeParty"),
+            seller.get("name", ""),
+            element(
+                ram("PostalTradeAddress"),
+                element(
+                    ram("CountryID"), text=seller["address"].get("country_code", "")
+                ),
+                element(
+                    ram("CountrySubDivisionName"),
+                    text=seller["address"].get("region", ""),
+                ),
+            ),
+            tax_id=seller.get("tax_id", ""),
+            required=True,
+        ),
+        party(
+            ram("BuyerTradeParty"), agreement["buyer"].get("name", ""), required=True
+        ),
+        order_document("SellerOrderReferencedDocument", issue_date),
+        order_document("BuyerOrderReferencedDocument", issue_date),
+        order_document("UltimateCustomerOrderReferencedDocument", issue_date),
+        required=True,
+    )
+
+
+def settlement_element(invoice_data):
+    agreement = invoice_data["trade"]["agreement"]
+    settlement = invoice_data["trade"]["settlement"]
+    summation = settlement["monetary_summation"]
+    total = round(summation.get("total", 0), 2)
+    return element(
+        ram("ApplicableHeaderTradeSettlement"),
+        element(ram("InvoiceCurrencyCode"), text=settlement.get("currency_code", "")),
+        party(ram("InvoiceeTradeParty"), agreement["buyer"].get("name", "")),
+        party(ram("PayeeTradeParty"), agreement["seller"].get("name", "")),
+        element(
+            ram("SpecifiedTradeSettlementPaymentMeans"),
+            element(
+                ram("TypeCode"),
+                text=settlement["payment_means"].get("type_code", "ZZZ"),
+            ),
+        ),
+        *(
+            element(
+                ram("ApplicableTradeTax"),
+                element(ram("CalculatedAmount"), text=round(tax.get("amount", 0), 2)),
+                element(ram("TypeCode"), text="VAT"),
+                element(ram("BasisAmount"), text=total),
+                element(ram("CategoryCode"), text=tax.get("category", "")),
+                element(ram("ExemptionReasonCode"), text="VATEX-EU-AE"),
+                element(
+                    ram("RateApplicablePercent"), text=round(tax.get("rate", 0), 2)
+                ),
+            )
+            for tax in settlement.get("trade_tax", [])
+        ),
+        element(
+            ram("SpecifiedTradeSettlementHeaderMonetarySummation"),
+            element(ram("LineTotalAmount"), text=total),
+            element(ram("ChargeTotalAmount"), text=round(0.0, 2)),
+            element(ram("AllowanceTotalAmount"), text=round(0.0, 2)),
+            element(ram("TaxBasisTotalAmount"), text=total),
+            element(
+                ram("TaxTotalAmount"),
+                text=round(summation.get("tax_total", 0), 2),
+                currencyID="EUR",
+            ),
+            element(ram("GrandTotalAmount"), text=total),
+            element(ram("DuePayableAmount"), text=total),
+        ),
+        required=True,
+    )
+
+
+def write_cii(invoice_data, output):
+    """Write the Factur-X EXTENDED CII of ``invoice_data`` to ``output``.
+
+    Same content as ``pdf_parser.generate_invoice_xml``, but elements are
+    written as they are built: the header parts are small, and every line
+    item is serialized and dropped before the next one is built, so memory
+    does not grow with the number of items. ``output`` is a path or a
+    binary file object.
+    """
+    issue_date = datetime.strptime(
+        invoice_data["header"].get("issue_date_time", "2025-01-01"), "%Y-%m-%d"
+    ).strftime("%Y%m%d")
+    with etree.xmlfile(output, encoding="utf-8") as xf:
+        with xf.element(rsm("CrossIndustryInvoice"), nsmap=NAMESPACES):
+            for node in header_elements(invoice_data, issue_date):
+                emit(xf, node)
+            with xf.element(rsm("SupplyChainTradeTransaction")):
+                for item in invoice_data["trade"].get("items", []):
+                    emit(xf, line_item(item))
+                emit(xf, agreement_element(invoice_data, issue_date))
+                emit(xf, element(ram("ApplicableHeaderTradeDelivery"), required=True))
+                emit(xf, settlement_element(invoice_data))
+
+
+def cii_schema():
+    global _schema
+    with _schema_lock:
+        if _schema is None:
+            _schema = etree.XMLSchema(file=CII_SCHEMA)
+        return _schema
+
+
+def validate_cii(xml):
+    """Raise ``etree.DocumentInvalid`` when ``xml`` (bytes or path) breaks the schema."""
+    if isinstance(xml, bytes):
+        document = etree.fromstring(xml)
+    else:
+        document = etree.parse(xml)
+    cii_schema().assertValid(document)
+
+
+def generate_cii_xml(invoice_data, validate=CII_VALIDATE):
+    """The CII of ``invoice_data`` as a string, optionally schema validated."""
+    buffer = io.BytesIO()
+    write_cii(invoice_data, buffer)
+    xml = buffer.getvalue()
+    if validate:
+        validate_cii(xml)
+    return xml.decode("utf-8")
+
+
+def write_cii_file(invoice_data, path, validate=CII_VALIDATE):
+    """Stream the CII into ``path``, removed again if it fails validation."""
+    write_cii(invoice_data, path)
+    if validate:
+        try:
+            validate_cii(path)
+        except etree.DocumentInvalid:
+            os.remove(path)
+            raise
+    return path
@@ -3,10 +3,17 @@ import re
 import json
 import time
 import logging
+import threading
 from selenium.webdriver.common.keys import Keys
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from seleniumbase import SB  # SB is a simple SeleniumBase driver
-from utils import PROMPT, remove_nulls
+from browser_pool import (
+    BrowserPool,
+    check_cancelled,
+    count_elements,
+    wait_for_new_element,
+)
+from utils import PROMPT, normalize_invoice
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -17,56 +24,75 @@ logging.basicConfig(
 MAIL = os.environ.get("DEEPSEEK_MAIL", "your_email@example.com")
 PASSWORD = os.environ.get("DEEPSEEK_PASSWORD", "your_password")
 
+DEEPSEEK_URL = "https://chat.deepseek.com/"
+DEEPSEEK_TIMEOUT = int(os.getenv("DEEPSEEK_TIMEOUT", "300"))
+# Action bar added below every finished answer
+ANSWER_DONE = "div[class='ds-flex _965abe9']"
 
-def process_with_deepseek(pdf_text, test=False):
-    """Main function to automate chat while caching login"""
-    logging.info(f"Starting deepseek extraction process ...")
-    with SB(
-        uc=True,
-        ad_block=True,
-        xvfb=True,
-        test=test,
-        # user_data_dir="./user_data",  # Reuse Chrome profile to persist login
-    ) as sb:
-        url = "https://chat.deepseek.com/sign_in"
-        sb.uc_open_with_reconnect(url, 4)
-        if test:
-            sb.uc_gui_click_captcha()
-            sb.sleep(1)
-            sb.uc_gui_click_captcha()
-            sb.sleep(1)
-            sb.uc_gui_handle_captcha()
-            sb.sleep(1)
-        logged_in = False
-
-        # TODO: Readd this once headless mode works with user_data_dir to avoid login for every request
-        #   try:
-        #       sb.wait_for_element_visible("#chat-input", timeout=1)
-        #       logged_in = True
-        #   except Exception:
-        #       logged_in = False
-
-        # Check if already logged in
-        if not logged_in:
-            logging.info("Login required, proceeding with login.")
-
-            # if test:
-            sb.save_screenshot("screenshots/01_deepseek_before_login.png")
-
-            # Enter credentials only if login is needed
-            sb.send_keys("//input[@class='ds-input__input'][@type='text']", MAIL)
-            sb.send_keys(
-                "//input[@class='ds-input__input'][@type='password']", PASSWORD
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def login(sb):
+    logging.info("Login required, proceeding with login.")
+    sb.send_keys("//input[@class='ds-input__input'][@type='text']", MAIL)
+    sb.send_keys("//input[@class='ds-input__input'][@type='password']", PASSWORD)
+    # sb.click(".ds-checkbox-align-wrapper")
+    sb.click(".ds-button--primary")
+    sb.wait_for_element_visible("#chat-input", timeout=20)
+
+
+def prepare_deepseek(sb, test=False):
+    sb.uc_open_with_reconnect(f"{DEEPSEEK_URL}sign_in", 4)
+    if test:
+        sb.uc_gui_click_captcha()
+        sb.sleep(1)
+        sb.uc_gui_click_captcha()
+        sb.sleep(1)
+        sb.uc_gui_handle_captcha()
+        sb.sleep(1)
+    # Logged in once per browser, the session cookie is reused afterwards
+    login(sb)
+
+
+def deepseek_pool(test=False):
+    with _pools_lock:
+        if test not in _pools:
+            _pools[test] = BrowserPool(
+                "deepseek" if not test else "deepseek_test",
+                lambda: SB(
+                    uc=True,
+                    ad_block=True,
+                    xvfb=True,
+                    test=test,
+                ),
+                prepare=lambda sb: prepare_deepseek(sb, test),
             )
-            # sb.click(".ds-checkbox-align-wrapper")
-            sb.click(".ds-button--primary")
-            sb.wait_for_element_visible("#chat-input", timeout=20)
-        else:
-            logging.info("Already logged in, proceeding to chat.")
+        return _pools[test]
+
+
+def open_new_chat(sb):
+    sb.open(DEEPSEEK_URL)
+    try:
+        sb.wait_for_element_visible("#chat-input", timeout=10)
+    except (TimeoutException, NoSuchElementException):
+        # Session expired, we were sent back to the sign in page
+        sb.open(f"{DEEPSEEK_URL}sign_in")
+        login(sb)
 
-        # if test:
-        sb.save_screenshot("screenshots/02_deepseek_logged_in.png")
 
+def process_with_deepseek(pdf_text, test=False, cancelled=None):
+    """Ask a logged in DeepSeek browser from the pool to extract the invoice
+
+    Gives up with ``browser_pool.Cancelled`` once ``cancelled`` is set.
+    """
+    logging.info(f"Starting deepseek extraction process ...")
+    start_time = time.perf_counter()
+    with deepseek_pool(test).checkout() as sb:
+        # Nothing was sent yet if the answer is no longer needed
+        check_cancelled(cancelled)
+        open_new_chat(sb)
+        answers = count_elements(sb, ANSWER_DONE)
         chat_text_area = sb.find_element("id", "chat-input")
         sb.execute_script(
             """
@@ -77,30 +103,17 @@ def process_with_deepseek(pdf_text, test=False):
             chat_text_area,
             f"{PROMPT} {pdf_text}",
         )
-        # if test:
-        sb.save_screenshot("screenshots/03_deepseek_logged_in.png")
+        # Send button is enabled once the input event was handled
         sb.wait_for_element_visible("//div[@class='_7436101'][@aria-disabled='false']")
-        sb.sleep(1)
         chat_text_area.send_keys(Keys.ENTER)
 
-        if test:
-            sb.sleep(20)
-            sb.save_screenshot("screenshots/04_deepseek_started_extraction.png")
-
-        # Wait for response elements to load
         logging.info("Extracting pdf data into json ...")
-        sb.wait_for_element_visible("//div[@class='ds-flex _965abe9']", timeout=300)
-
-        # response = sb.find_element(".ds-markdown--block p").text
-        # if test:
-        sb.save_screenshot("screenshots/05_deepseek_after_extraction.png")
-        response = sb.find_element(".md-code-block pre").text
-
-        # Save a screenshot
-        # if test:
-        sb.save_screenshot("screenshots/06_deepseek_after_extraction.png")
+        wait_for_new_element(sb, ANSWER_DONE, answers, DEEPSEEK_TIMEOUT, cancelled)
 
+        response = sb.find_elements(".md-code-block pre")[-1].text
         json_match = re.search(r"({.*})", response, re.DOTALL)
         json_str = json_match.group(1)
         logging.info(f"JSON String:\n{json_str}")
-        return remove_nulls(json.loads(json_str))
+        invoice_data = normalize_invoice(json.loads(json_str))
+    logging.info(f"DeepSeek answered in {time.perf_counter() - start_time:.3f} seconds")
+    return invoice_data
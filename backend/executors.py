@@ -0,0 +1,149 @@
+import os
+import asyncio
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Number of uvicorn worker processes on this host, uvicorn reads it as the
+# default of --workers
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# CPU-bound stages (PDF parsing, XML rendering, OCR) run in worker processes
+# so they do not hold the GIL of the event loop; 0 runs them in the caller.
+# Every uvicorn worker has its own pool, together they get one per core
+CPU_WORKERS = int(
+    os.getenv("CPU_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+)
+# Blocking I/O (LLM calls, validator, file writes) runs on a bounded thread
+# pool, requests beyond it queue up instead of spawning threads
+IO_WORKERS = int(os.getenv("IO_WORKERS", "32"))
+
+_process_pool = None
+_thread_pool = None
+_pools_lock = threading.Lock()
+
+
+def _init_worker():
+    # Every worker already is one core, keep torch (OCR) and numpy from
+    # starting a thread per core each
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[name] = "1"
+
+
+def get_process_pool():
+    """The one process pool of this process, shared by OCR and CPU stages."""
+    global _process_pool
+    with _pools_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=CPU_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _process_pool
+
+
+def get_thread_pool():
+    global _thread_pool
+    with _pools_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(
+                max_workers=IO_WORKERS, thread_name_prefix="io"
+            )
+        return _thread_pool
+
+
+def run_cpu_bound(func, *args, **kwargs):
+    """Run ``func`` in the process pool and wait for it (from a worker thread).
+
+    ``func`` and its arguments must be picklable. A crashed worker breaks the
+    pool, it is replaced and the call is repeated in the current process.
+    """
+    call = partial(func, *args, **kwargs)
+    if CPU_WORKERS < 1:
+        return call()
+    try:
+        return get_process_pool().submit(call).result()
+    except BrokenProcessPool:
+        logging.warning(f"CPU worker died, running {func.__name__} in-process")
+        shutdown_process_pool()
+        return call()
+
+
+async def run_in_process(func, *args, **kwargs):
+    """Await ``func`` running in the process pool."""
+    if CPU_WORKERS < 1:
+        return await run_in_thread(func, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    call = partial(func, *args, **kwargs)
+    try:
+        return await loop.run_in_executor(get_process_pool(), call)
+    except BrokenProcessPool:
+        logging.warning(f"CPU worker died, running {func.__name__} in a thread")
+        shutdown_process_pool()
+        return await run_in_thread(call)
+
+
+class BackgroundLoop:
+    """Event loop on a daemon thread for async clients used from sync code.
+
+    Extraction runs on worker threads; handing its provider calls to one loop
+    lets them share connection pools and asyncio limiters. Subclasses create
+    their loop-bound state in ``setup``.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self.loop.run_forever, name=self.name, daemon=True
+                ).start()
+                asyncio.run_coroutine_threadsafe(self.setup(), self.loop).result()
+        return self.loop
+
+    async def setup(self):
+        pass
+
+    def submit(self, coroutine):
+        """Schedule ``coroutine``, cancelling the returned future cancels it."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start())
+
+    def run(self, coroutine):
+        """Run ``coroutine`` on the background loop and wait for its result."""
+        return self.submit(coroutine).result()
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """Await blocking ``func`` running on the bounded I/O thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_thread_pool(), partial(func, *args, **kwargs))
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _pools_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+
+def shutdown_executors():
+    global _thread_pool
+    shutdown_process_pool()
+    with _pools_lock:
+        if _thread_pool is not None:
+            _thread_pool.shutdown(wait=False, cancel_futures=True)
+            _thread_pool = None
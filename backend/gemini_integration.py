@@ -1,21 +1,55 @@
+import io
 import os
 import re
 import json
+import time
+import random
+import asyncio
 import logging
+import threading
+import statistics
+from collections import OrderedDict, deque
+import httpx
 import requests
 from google import genai
-from google.genai import types
-from schemas import Invoice
+from google.genai import errors, types
+from cache import content_hash
+from executors import BackgroundLoop
+from schemas import Invoice, ItemPage
+from stream_parser import SchemaStreamParser
 from utils import (
     PROMPT,
-    remove_nulls,
-    format_dates,
-    fix_settlement_tax,
-    replace_value_in_dict,
+    ITEMS_PROMPT,
+    PROMPT_VERSION,
+    normalize_invoice,
 )
 
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = "gemini-2.0-flash"
+# Per-request timeout of the HTTP client in seconds
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "120"))
+# PDFs up to this size are sent inline with the request, larger ones uploaded
+GEMINI_INLINE_MAX_BYTES = int(os.getenv("GEMINI_INLINE_MAX_BYTES", str(15 * 1024**2)))
+# Calls in flight and calls started per minute, shared by all threads
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+# Uploaded files live 48 hours on the Gemini side
+GEMINI_UPLOAD_REUSE_SECONDS = 47 * 3600
+# The static prompt (instructions, schema, example) is kept as cached content
+GEMINI_PROMPT_CACHE = os.getenv("GEMINI_PROMPT_CACHE", "1") == "1"
+GEMINI_PROMPT_CACHE_TTL = int(os.getenv("GEMINI_PROMPT_CACHE_TTL", "3600"))
+PROMPT_CACHE_NAME = f"pdftoxrechnung-prompt-{PROMPT_VERSION}"
+
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT * 1000)),
+)
 
 
 logging.basicConfig(
@@ -24,50 +58,320 @@ logging.basicConfig(
 )
 
 
-def process_with_gemini(pdf_file, pdf_text):
-    """Main function to automate chat using Gemini via HTTP"""
-    logging.info("Starting gemini extraction process ...")
-    invoice = client.files.upload(file=pdf_file)
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=[invoice, PROMPT, pdf_text],
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json",
-            response_schema=Invoice.model_json_schema(),
-            temperature=0,
-        ),
-    )
+class TokenBucket:
+    """Async token bucket: ``rate`` tokens per second, at most ``capacity``."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class GeminiLimiter(BackgroundLoop):
+    """Runs all Gemini calls of the process on one background event loop.
+
+    One semaphore and one token bucket throttle the calls of all worker
+    threads together, and the async client keeps its connections alive.
+    """
+
+    def __init__(self):
+        super().__init__("gemini")
+
+    async def setup(self):
+        self.semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+        self.bucket = TokenBucket(GEMINI_REQUESTS_PER_MINUTE / 60, GEMINI_BURST)
+
+
+limiter = GeminiLimiter()
+_uploads = OrderedDict()
+_stats_lock = threading.Lock()
+_stats = {
+    "calls": 0,
+    "errors": 0,
+    "retries": 0,
+    "uploads": 0,
+    "upload_reuses": 0,
+    "prompt_tokens": 0,
+    "output_tokens": 0,
+    "cached_tokens": 0,
+    "prompt_caches_created": 0,
+}
+_latencies = deque(maxlen=1000)
+
+
+def is_retryable(error):
+    if isinstance(error, errors.APIError):
+        return error.code in RETRY_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, requests.RequestException))
+
+
+def backoff_delay(attempt):
+    """Full jitter: a random wait up to the exponential backoff."""
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2**attempt))
+
+
+async def with_retries(call, what):
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == GEMINI_MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            with _stats_lock:
+                _stats["retries"] += 1
+            logging.warning(f"Gemini {what} failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def pdf_part(pdf_bytes):
+    """Inline data for small PDFs, an uploaded file for large ones.
+
+    Uploads are remembered by content hash, so retries of the same document
+    (also by the job queue) reuse the file instead of uploading it again.
+    """
+    if len(pdf_bytes) <= GEMINI_INLINE_MAX_BYTES:
+        return types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
+
+    key = content_hash(pdf_bytes)
+    uploaded = _uploads.get(key)
+    if uploaded and time.time() - uploaded[1] < GEMINI_UPLOAD_REUSE_SECONDS:
+        with _stats_lock:
+            _stats["upload_reuses"] += 1
+        return uploaded[0]
+
+    async def upload():
+        async with limiter.semaphore:
+            await limiter.bucket.acquire()
+            return await client.aio.files.upload(
+                file=io.BytesIO(pdf_bytes),
+                config=types.UploadFileConfig(mime_type="application/pdf"),
+            )
+
+    invoice = await with_retries(upload, "upload")
+    _uploads[key] = (invoice, time.time())
+    while len(_uploads) > 256:
+        _uploads.popitem(last=False)
+    with _stats_lock:
+        _stats["uploads"] += 1
+    return invoice
+
+
+def record_usage(latency, usage):
+    with _stats_lock:
+        _stats["calls"] += 1
+        _latencies.append(latency)
+        if usage is not None:
+            _stats["prompt_tokens"] += usage.prompt_token_count or 0
+            _stats["output_tokens"] += usage.candidates_token_count or 0
+            _stats["cached_tokens"] += usage.cached_content_token_count or 0
+
+
+class PromptCache:
+    """Gemini cached content holding ``PROMPT`` for the current prompt version.
+
+    Workers look for a live cache of the same prompt version before creating
+    one, and recreate it shortly before it expires. When caching is not
+    possible (model or prompt size not supported) the full prompt is sent and
+    creation is retried later.
+    """
+
+    def __init__(self):
+        self.name = None
+        self.expires = 0
+        self.retry_after = 0
+        self.lock = asyncio.Lock()
+
+    async def get(self):
+        if not GEMINI_PROMPT_CACHE:
+            return None
+        async with self.lock:
+            now = time.time()
+            if self.name and now < self.expires - 60:
+                return self.name
+            if now < self.retry_after:
+                return None
+            try:
+                self.name, self.expires = await self.find() or await self.create()
+            except Exception as e:
+                logging.warning(f"Gemini prompt cache unavailable: {e}")
+                self.name = None
+                self.retry_after = now + 600
+            return self.name
+
+    async def find(self):
+        async for cached in await client.aio.caches.list():
+            if cached.display_name != PROMPT_CACHE_NAME or not cached.expire_time:
+                continue
+            expires = cached.expire_time.timestamp()
+            if expires - time.time() > 300:
+                return cached.name, expires
+        return None
+
+    async def create(self):
+        cached = await client.aio.caches.create(
+            model=GEMINI_MODEL,
+            config=types.CreateCachedContentConfig(
+                display_name=PROMPT_CACHE_NAME,
+                contents=[PROMPT],
+                ttl=f"{GEMINI_PROMPT_CACHE_TTL}s",
+            ),
+        )
+        logging.info(f"Created Gemini prompt cache {cached.name}")
+        with _stats_lock:
+            _stats["prompt_caches_created"] += 1
+        return cached.name, time.time() + GEMINI_PROMPT_CACHE_TTL
+
+    def invalidate(self):
+        self.name = None
+
+
+prompt_cache = PromptCache()
+
+
+def request(invoice, pdf_text, cached_prompt, prompt=PROMPT, schema=Invoice):
+    """Contents and config of a call, with or without the cached prompt."""
+    config = {
+        "response_mime_type": "application/json",
+        "response_schema": schema.model_json_schema(),
+        "temperature": 0,
+    }
+    # Text only calls (chunks of long invoices) come without the PDF
+    attached = [invoice] if invoice is not None else []
+    if cached_prompt:
+        return [*attached, pdf_text], types.GenerateContentConfig(
+            cached_content=cached_prompt, **config
+        )
+    return [prompt, *attached, pdf_text], types.GenerateContentConfig(**config)
+
+
+async def generate(pdf_bytes, pdf_text, prompt=PROMPT, schema=Invoice):
+    invoice = await pdf_part(pdf_bytes) if pdf_bytes is not None else None
+
+    async def call():
+        # Only the invoice prompt is kept as cached content
+        cached_prompt = await prompt_cache.get() if prompt is PROMPT else None
+        contents, config = request(invoice, pdf_text, cached_prompt, prompt, schema)
+        async with limiter.semaphore:
+            await limiter.bucket.acquire()
+            start_time = time.perf_counter()
+            try:
+                response = await client.aio.models.generate_content(
+                    model=GEMINI_MODEL, contents=contents, config=config
+                )
+            except errors.ClientError as e:
+                if not cached_prompt or e.code not in (403, 404):
+                    raise
+                # Cache expired or was deleted in between, send the full prompt
+                prompt_cache.invalidate()
+                contents, config = request(invoice, pdf_text, None, prompt, schema)
+                response = await client.aio.models.generate_content(
+                    model=GEMINI_MODEL, contents=contents, config=config
+                )
+            latency = time.perf_counter() - start_time
+        record_usage(latency, response.usage_metadata)
+        logging.info(f"Gemini answered in {latency:.3f} seconds")
+        return response
+
+    # Every attempt takes a slot and a token of its own, the backoff between
+    # attempts holds neither
+    try:
+        return await with_retries(call, "generate_content")
+    except Exception:
+        with _stats_lock:
+            _stats["errors"] += 1
+        raise
+
+
+def prompt_token_report():
+    """Token counts of the static prompt, the part the prompt cache saves."""
+    response = client.models.count_tokens(model=GEMINI_MODEL, contents=[PROMPT])
+    with _stats_lock:
+        calls = _stats["calls"]
+        prompt_tokens = _stats["prompt_tokens"]
+        cached_tokens = _stats["cached_tokens"]
+    return {
+        "prompt_version": PROMPT_VERSION,
+        "static_prompt_tokens": response.total_tokens,
+        "calls": calls,
+        "prompt_tokens_per_call": round(prompt_tokens / calls) if calls else 0,
+        "cached_tokens_per_call": round(cached_tokens / calls) if calls else 0,
+    }
+
+
+def gemini_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+        latencies = sorted(_latencies)
+    if latencies:
+        stats["latency_p50"] = round(statistics.median(latencies), 3)
+        stats["latency_p95"] = round(latencies[int(0.95 * (len(latencies) - 1))], 3)
+    return stats
+
+
+def postprocess(raw_invoice_data):
+    preprocessed_invoice_data = normalize_invoice(raw_invoice_data)
+    logging.info(f"Preprocessed invoice data:\n{preprocessed_invoice_data}")
+    return preprocessed_invoice_data
+
+
+async def extract_with_gemini(pdf_bytes, pdf_text, validate=False):
+    """Extract the invoice on the limiter loop.
+
+    With ``validate`` the answer must match ``schemas.Invoice``, otherwise
+    ``MalformedOutput`` is raised.
+    """
+    response = await generate(pdf_bytes, pdf_text)
     json_str = response.text
     logging.info(f"JSON String:\n{json_str}")
+    if validate:
+        parser = SchemaStreamParser()
+        parser.feed(json_str)
+        raw_invoice_data = parser.result()
+    else:
+        raw_invoice_data = json.loads(json_str)
+    return postprocess(raw_invoice_data)
 
-    raw_invoice_data = json.loads(json_str)
-
-    # Replace default values
-    preprocessed_invoice_data = replace_value_in_dict(
-        raw_invoice_data, "leitweg_id", "LEITWEGID-12345ABCXYZ-00", 0
-    )
-    preprocessed_invoice_data = replace_value_in_dict(
-        preprocessed_invoice_data, "leitweg_id", "string", 0
-    )
-    preprocessed_invoice_data = replace_value_in_dict(
-        preprocessed_invoice_data, "tax_id", "321/312/54321", None
-    )
-    preprocessed_invoice_data = replace_value_in_dict(
-        preprocessed_invoice_data, "order_id", "SELLER-2019-0789", None
-    )
-    preprocessed_invoice_data = replace_value_in_dict(
-        preprocessed_invoice_data, "order_id", "BUYER-2019-0789", None
-    )
-
-    # Remove null
-    preprocessed_invoice_data = remove_nulls(preprocessed_invoice_data)
-
-    # Format dates
-    preprocessed_invoice_data = format_dates(preprocessed_invoice_data)
-
-    # Calculate the settlement tax amount
-    preprocessed_invoice_data = fix_settlement_tax(preprocessed_invoice_data)
 
-    logging.info(f"Preprocessed invoice data:\n{preprocessed_invoice_data}")
+def submit_gemini(pdf_file, pdf_text, pdf_bytes=None, validate=False):
+    """Start the extraction, cancelling the returned future aborts the call.
 
-    return preprocessed_invoice_data
+    Without ``pdf_file`` and ``pdf_bytes`` only the text is sent.
+    """
+    if pdf_bytes is None and pdf_file is not None:
+        with open(pdf_file, "rb") as f:
+            pdf_bytes = f.read()
+    return limiter.submit(extract_with_gemini(pdf_bytes, pdf_text, validate))
+
+
+async def extract_items_with_gemini(pdf_text):
+    """Line items of some pages of a long invoice, validated against ``ItemPage``."""
+    response = await generate(None, pdf_text, ITEMS_PROMPT, ItemPage)
+    parser = SchemaStreamParser(ItemPage.model_json_schema())
+    parser.feed(response.text)
+    return normalize_invoice(parser.result())["items"]
+
+
+def submit_gemini_items(pdf_text):
+    return limiter.submit(extract_items_with_gemini(pdf_text))
+
+
+def process_with_gemini(pdf_file, pdf_text, pdf_bytes=None):
+    """Main function to extract the invoice with Gemini"""
+    logging.info("Starting gemini extraction process ...")
+    return submit_gemini(pdf_file, pdf_text, pdf_bytes).result()
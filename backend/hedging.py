@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import logging
+import threading
+import statistics
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from browser_pool import BROWSER_POOL_SIZE
+from chatgpt_integration import process_with_chatgpt
+from deepseek_integration import process_with_deepseek
+from gemini_integration import submit_gemini
+from ollama_integration import client as ollama_client, extract_with_ollama
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Provider started next to the primary one once it is late, empty disables hedging
+HEDGE_SECONDARY = os.getenv("HEDGE_SECONDARY", "")
+# Policies per endpoint ("upload", "autoconvert", "jobs", "batch") overriding the
+# defaults, e.g. {"batch": {"secondary": null}, "upload": {"percentile": 0.75}}
+EXTRACTION_POLICIES = json.loads(os.getenv("EXTRACTION_POLICIES", "{}"))
+# Hedge delay before enough latencies of the primary are known
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "30"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+DEFAULT_POLICY = {"secondary": HEDGE_SECONDARY or None, "percentile": 0.9}
+
+# Browser providers block a thread and cannot be interrupted once started
+_browser_threads = ThreadPoolExecutor(
+    max_workers=2 * BROWSER_POOL_SIZE, thread_name_prefix="browser"
+)
+_stats = {}
+_stats_lock = threading.RLock()
+
+
+def extraction_policy(endpoint, model):
+    """Providers of ``endpoint``, ``model`` is the primary unless overridden."""
+    return {"primary": model, **DEFAULT_POLICY, **EXTRACTION_POLICIES.get(endpoint, {})}
+
+
+def provider_stats(model):
+    with _stats_lock:
+        if model not in _stats:
+            _stats[model] = {
+                "calls": 0,
+                "wins": 0,
+                "losses": 0,
+                "errors": 0,
+                "hedged": 0,
+                "latencies": deque(maxlen=LATENCY_WINDOW),
+            }
+        return _stats[model]
+
+
+def count(model, name, latency=None):
+    """Count ``name`` for ``model`` and remember the latency if there is one."""
+    with _stats_lock:
+        stats = provider_stats(model)
+        stats[name] += 1
+        if latency is not None:
+            stats["latencies"].append(latency)
+
+
+def submit(model, pdf_text, pdf_file=None, pdf_bytes=None, test=False, cancelled=None):
+    """Start an extraction, returns a future that validates against the schema.
+
+    Browser providers cannot be interrupted from outside their thread, they
+    check the ``cancelled`` event instead.
+    """
+    if model == "gemini":
+        return submit_gemini(pdf_file, pdf_text, pdf_bytes, validate=True)
+    if model == "ollama":
+        # Parsed against schemas.Invoice while it streams
+        return ollama_client.submit(extract_with_ollama(pdf_text))
+    if model == "deepseek":
+        return _browser_threads.submit(process_with_deepseek, pdf_text, test, cancelled)
+    return _browser_threads.submit(process_with_chatgpt, pdf_text, test, cancelled)
+
+
+def hedge_delay(model, percentile=0.9):
+    """The ``percentile`` latency of ``model``, waited before hedging."""
+    with _stats_lock:
+        latencies = list(provider_stats(model)["latencies"])
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    index = min(int(len(latencies) * percentile), len(latencies) - 1)
+    return max(HEDGE_MIN_DELAY, sorted(latencies)[index])
+
+
+def is_invoice(invoice_data):
+    return (
+        isinstance(invoice_data, dict)
+        and isinstance(invoice_data.get("header"), dict)
+        and isinstance(invoice_data.get("trade"), dict)
+    )
+
+
+def hedged_extract(
+    pdf_text, policy, pdf_file=None, pdf_bytes=None, test=False, answered_by=None
+):
+    """Race the primary provider against the secondary one once it is late.
+
+    The secondary provider is started when the primary did not answer within
+    its p90 latency (``policy["percentile"]``) or failed. The first valid
+    answer wins and the other call is cancelled, a browser provider through
+    its ``cancelled`` event. The winner is added to the ``answered_by`` set.
+    """
+
+    def start(model, cancelled):
+        return submit(model, pdf_text, pdf_file, pdf_bytes, test, cancelled)
+
+    return hedged_call(policy, start, is_invoice, answered_by=answered_by)
+
+
+def hedged_call(policy, start_call, accept, kind=None, answered_by=None):
+    """``hedged_extract`` for any call: ``start_call(model, cancelled)``
+    returns a future, ``accept(answer)`` tells whether the answer is usable.
+
+    Calls of another ``kind`` than full invoices (e.g. ``"items"``) keep
+    their own stats, so their latencies do not shift the invoice hedge delay.
+    """
+    primary, secondary = policy["primary"], policy["secondary"]
+    name = {
+        model: f"{model} {kind}" if kind else model for model in (primary, secondary)
+    }
+    started = {}
+    running = {}
+    cancelled = {}
+
+    def start(model):
+        count(name[model], "calls")
+        started[model] = time.perf_counter()
+        cancelled[model] = threading.Event()
+        running[start_call(model, cancelled[model])] = model
+
+    start(primary)
+    timeout = hedge_delay(name[primary], policy["percentile"]) if secondary else None
+    error = None
+    while running:
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        timeout = None
+        if not done:
+            logging.info(f"{primary} is late, hedging with {secondary}")
+            count(name[secondary], "hedged")
+            start(secondary)
+            continue
+
+        for future in done:
+            model = running.pop(future)
+            try:
+                answer = future.result()
+                if not accept(answer):
+                    raise ValueError(f"{model} returned no {kind or 'invoice'}")
+            except Exception as e:
+                logging.warning(f"Extraction with {model} failed: {e}")
+                count(name[model], "errors")
+                error = e
+                continue
+
+            seconds = time.perf_counter() - started[model]
+            count(name[model], "wins", seconds)
+            for loser, loser_model in running.items():
+                loser.cancel()
+                cancelled[loser_model].set()
+                # A lower bound, but keeps slow calls in the p90 window
+                count(
+                    name[loser_model],
+                    "losses",
+                    time.perf_counter() - started[loser_model],
+                )
+            logging.info(f"{model} won the extraction in {seconds:.3f} seconds")
+            if answered_by is not None:
+                answered_by.add(model)
+            return answer
+
+        if secondary and secondary not in started:
+            # The primary failed before its deadline
+            count(name[secondary], "hedged")
+            start(secondary)
+    raise error
+
+
+def hedging_stats():
+    stats = {}
+    with _stats_lock:
+        providers = {
+            model: (dict(provider), sorted(provider["latencies"]))
+            for model, provider in _stats.items()
+        }
+    for model, (provider, latencies) in providers.items():
+        stats[model] = {
+            key: value for key, value in provider.items() if key != "latencies"
+        }
+        if latencies:
+            stats[model]["p50_seconds"] = round(statistics.median(latencies), 3)
+            stats[model]["p90_seconds"] = round(
+                latencies[min(int(len(latencies) * 0.9), len(latencies) - 1)], 3
+            )
+        stats[model]["hedge_delay_seconds"] = round(hedge_delay(model), 3)
+    return stats
@@ -0,0 +1,375 @@
+import io
+import os
+import time
+import zlib
+import shutil
+import hashlib
+import logging
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+from pypdf import PdfReader
+from pypdf.generic import (
+    ArrayObject,
+    ByteStringObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    create_string_object,
+)
+from drafthorse.xmp_schema import XMP_SCHEMA
+from cii_writer import generate_cii_xml
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Read size when streaming the original PDF in front of the update
+HYBRID_CHUNK_SIZE = int(os.getenv("HYBRID_CHUNK_SIZE", str(1024 * 1024)))
+HYBRID_XML_NAME = "factur-x.xml"
+# Invoice attachments of the original are replaced, or readers pick either
+REPLACED_NAMES = {HYBRID_XML_NAME, "zugferd-invoice.xml", "xrechnung.xml"}
+# cii_writer always writes the EXTENDED profile
+HYBRID_PROFILE = "EXTENDED"
+
+
+def serialize(obj):
+    buffer = io.BytesIO()
+    obj.write_to_stream(buffer)
+    return buffer.getvalue()
+
+
+def runs(numbers):
+    """Consecutive object numbers as ``(first, count)`` xref subsections."""
+    sections = []
+    for number in sorted(numbers):
+        if sections and sections[-1][0] + sections[-1][1] == number:
+            sections[-1][1] += 1
+        else:
+            sections.append([number, 1])
+    return sections
+
+
+def last_xref(pdf_file):
+    """Size, last byte, offset of the last xref and whether it is a stream."""
+    pdf_file.seek(0, os.SEEK_END)
+    size = pdf_file.tell()
+    pdf_file.seek(max(0, size - 1024))
+    tail = pdf_file.read()
+    index = tail.rfind(b"startxref")
+    if index < 0:
+        raise ValueError("No startxref found, not a PDF")
+    offset = int(tail[index + 9 :].split()[0])
+    pdf_file.seek(offset)
+    is_stream = not pdf_file.read(32).lstrip().startswith(b"xref")
+    return size, tail[-1:], offset, is_stream
+
+
+class IncrementalUpdate:
+    """New revisions of PDF objects, written after the end of the original.
+
+    Nothing before ``start`` is read or rewritten: the update holds the
+    changed objects, an xref section for them only and a trailer pointing
+    back to the previous xref with ``/Prev``.
+    """
+
+    def __init__(self, start, next_number, separator=b""):
+        self.start = start
+        self.next_number = next_number
+        self.offsets = {}
+        self.buffer = io.BytesIO()
+        self.buffer.write(separator)
+
+    def reserve(self):
+        reference = IndirectObject(self.next_number, 0, None)
+        self.next_number += 1
+        return reference
+
+    def add(self, reference, obj, stream=None):
+        self.offsets[reference.idnum] = (
+            self.start + self.buffer.tell(),
+            reference.generation,
+        )
+        self.buffer.write(f"{reference.idnum} {reference.generation} obj\n".encode())
+        if stream is not None:
+            obj[NameObject("/Length")] = NumberObject(len(stream))
+        obj.write_to_stream(self.buffer)
+        if stream is not None:
+            self.buffer.write(b"\nstream\n" + stream + b"\nendstream")
+        self.buffer.write(b"\nendobj\n")
+        return reference
+
+    def close(self, trailer, xref_stream=False):
+        """Append the xref section and trailer, return the update bytes."""
+        trailer[NameObject("/Size")] = NumberObject(self.next_number)
+        if xref_stream:
+            self.close_with_stream(trailer)
+        else:
+            self.close_with_table(trailer)
+        return self.buffer.getvalue()
+
+    def close_with_table(self, trailer):
+        xref_offset = self.start + self.buffer.tell()
+        # Starting with the free list head, readers take the table as zero-indexed
+        self.buffer.write(b"xref\n0 1\n0000000000 65535 f\r\n")
+        for first, count in runs(self.offsets):
+            self.buffer.write(f"{first} {count}\n".encode())
+            for number in range(first, first + count):
+                offset, generation = self.offsets[number]
+                self.buffer.write(f"{offset:010d} {generation:05d} n\r\n".encode())
+        self.buffer.write(b"trailer\n" + serialize(trailer))
+        self.buffer.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+    def close_with_stream(self, trailer):
+        # An original with an xref stream gets an xref stream update as well
+        reference = self.reserve()
+        trailer[NameObject("/Size")] = NumberObject(self.next_number)
+        xref_offset = self.start + self.buffer.tell()
+        self.offsets[reference.idnum] = (xref_offset, 0)
+        width = max(4, (xref_offset.bit_length() + 7) // 8)
+        sections = runs(self.offsets)
+        rows = b"".join(
+            b"\x01"
+            + self.offsets[number][0].to_bytes(width, "big")
+            + self.offsets[number][1].to_bytes(2, "big")
+            for first, count in sections
+            for number in range(first, first + count)
+        )
+        trailer.update(
+            {
+                NameObject("/Type"): NameObject("/XRef"),
+                NameObject("/W"): ArrayObject(
+                    [NumberObject(1), NumberObject(width), NumberObject(2)]
+                ),
+                NameObject("/Index"): ArrayObject(
+                    NumberObject(value) for section in sections for value in section
+                ),
+            }
+        )
+        self.add(reference, trailer, rows)
+        self.buffer.write(f"startxref\n{xref_offset}\n%%EOF\n".encode())
+
+
+def replaced(name):
+    return str(name).lower() in REPLACED_NAMES
+
+
+def embedded_files(catalog, name, filespec):
+    """The catalog's ``/Names`` with ``filespec`` as the invoice attachment."""
+    names = DictionaryObject(catalog["/Names"]) if "/Names" in catalog else None
+    names = names or DictionaryObject()
+    pairs = []
+    if "/EmbeddedFiles" in names:
+        tree = names["/EmbeddedFiles"]
+        if "/Kids" in tree:
+            # Like drafthorse, nested name trees are replaced
+            logging.warning("Replacing a nested attachment tree of the PDF")
+        existing = list(tree.get("/Names", ArrayObject()).get_object())
+        pairs = [
+            (key.get_object(), value)
+            for key, value in zip(existing[::2], existing[1::2])
+            if not replaced(key.get_object())
+        ]
+    pairs.append((create_string_object(name), filespec))
+    pairs.sort(key=lambda pair: str(pair[0]))
+    names[NameObject("/EmbeddedFiles")] = DictionaryObject(
+        {NameObject("/Names"): ArrayObject(obj for pair in pairs for obj in pair)}
+    )
+    return names
+
+
+def associated_files(catalog, filespec):
+    """The catalog's ``/AF`` with ``filespec`` instead of older invoices."""
+    files = catalog["/AF"] if "/AF" in catalog else ArrayObject()
+    files = ArrayObject(
+        reference
+        for reference in files
+        if not replaced(reference.get_object().get("/F", ""))
+    )
+    files.append(filespec)
+    return files
+
+
+def xmp_metadata(metadata, profile, timestamp):
+    return XMP_SCHEMA.format(
+        title=escape(metadata.get("title", "")),
+        author=escape(metadata.get("author", "")),
+        subject=escape(metadata.get("subject", "")),
+        producer=escape(metadata.get("producer", "pypdf")),
+        creator_tool=escape(metadata.get("creator", "pdftoxrechnung")),
+        timestamp=timestamp.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+        urn="urn:factur-x:pdfa:CrossIndustryDocument:invoice:1p0#",
+        documenttype="INVOICE",
+        xml_filename=HYBRID_XML_NAME,
+        version="1.0",
+        xmp_level=profile,
+    ).encode("utf-8")
+
+
+def build_update(pdf_file, xml, metadata=None, profile=HYBRID_PROFILE):
+    """The incremental update that embeds ``xml`` in the PDF ``pdf_file``.
+
+    Only the xref sections, the trailer and the catalog are read from the
+    binary file object, so time and memory follow the XML size, not the
+    PDF size. Appending the returned bytes to the unchanged original gives
+    the Factur-X/ZUGFeRD hybrid, with the same attachment, associated file
+    and XMP entries as ``drafthorse.pdf.attach_xml``.
+    """
+    size, last_byte, prev, xref_stream = last_xref(pdf_file)
+    reader = PdfReader(pdf_file)
+    if reader.is_encrypted:
+        raise ValueError("Encrypted PDFs cannot be made hybrid")
+    metadata = metadata or {}
+    now = datetime.now(tz=timezone.utc)
+    modified = create_string_object(now.strftime("D:%Y%m%d%H%M%SZ"))
+
+    update = IncrementalUpdate(
+        size,
+        int(reader.trailer["/Size"]),
+        b"" if last_byte in (b"\n", b"\r") else b"\n",
+    )
+    compressed = zlib.compress(xml)
+    embedded_file = update.add(
+        update.reserve(),
+        DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/EmbeddedFile"),
+                NameObject("/Subtype"): NameObject("/text#2Fxml"),
+                NameObject("/Filter"): NameObject("/FlateDecode"),
+                NameObject("/Params"): DictionaryObject(
+                    {
+                        NameObject("/ModDate"): modified,
+                        NameObject("/Size"): NumberObject(len(xml)),
+                    }
+                ),
+            }
+        ),
+        compressed,
+    )
+    name = create_string_object(HYBRID_XML_NAME)
+    filespec = update.add(
+        update.reserve(),
+        DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Filespec"),
+                NameObject("/F"): name,
+                NameObject("/UF"): name,
+                NameObject("/AFRelationship"): NameObject(
+                    "/Data" if profile in ("BASIC-WL", "MINIMUM") else "/Alternative"
+                ),
+                NameObject("/Desc"): create_string_object(
+                    "Invoice metadata conforming to ZUGFeRD standard "
+                    "(https://www.ferd-net.de/)"
+                ),
+                NameObject("/EF"): DictionaryObject(
+                    {
+                        NameObject("/F"): embedded_file,
+                        NameObject("/UF"): embedded_file,
+                    }
+                ),
+            }
+        ),
+    )
+    xmp = update.add(
+        update.reserve(),
+        DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Metadata"),
+                NameObject("/Subtype"): NameObject("/XML"),
+            }
+        ),
+        xmp_metadata(metadata, profile, now),
+    )
+
+    info = DictionaryObject()
+    if "/Info" in reader.trailer:
+        info.update(reader.trailer["/Info"])
+    info.update(
+        {
+            NameObject("/Title"): create_string_object(metadata.get("title", "")),
+            NameObject("/Author"): create_string_object(metadata.get("author", "")),
+            NameObject("/Subject"): create_string_object(metadata.get("subject", "")),
+            NameObject("/Keywords"): create_string_object("Factur-X"),
+            NameObject("/Producer"): create_string_object(
+                metadata.get("producer", "pypdf")
+            ),
+            NameObject("/Creator"): create_string_object(
+                metadata.get("creator", "pdftoxrechnung")
+            ),
+            NameObject("/ModDate"): modified,
+        }
+    )
+    info_reference = update.add(update.reserve(), info)
+
+    # The catalog keeps its object number, the new revision replaces it
+    root = reader.trailer.raw_get("/Root")
+    catalog = DictionaryObject(reader.trailer["/Root"])
+    catalog.update(
+        {
+            NameObject("/Names"): embedded_files(catalog, HYBRID_XML_NAME, filespec),
+            NameObject("/AF"): associated_files(catalog, filespec),
+            NameObject("/Metadata"): xmp,
+            NameObject("/PageMode"): NameObject("/UseAttachments"),
+        }
+    )
+    if "/Version" not in catalog and reader.pdf_header < "%PDF-1.7":
+        catalog[NameObject("/Version")] = NameObject("/1.7")
+    update.add(IndirectObject(root.idnum, root.generation, None), catalog)
+
+    digest = hashlib.md5(compressed + str(size).encode()).digest()
+    original_id = reader.trailer.get("/ID")
+    original_id = original_id.get_object() if original_id else None
+    trailer = DictionaryObject(
+        {
+            NameObject("/Root"): IndirectObject(root.idnum, root.generation, None),
+            NameObject("/Info"): info_reference,
+            NameObject("/Prev"): NumberObject(prev),
+            NameObject("/ID"): ArrayObject(
+                [
+                    original_id[0] if original_id else ByteStringObject(digest),
+                    ByteStringObject(digest),
+                ]
+            ),
+        }
+    )
+    return update.close(trailer, xref_stream)
+
+
+def invoice_metadata(invoice_data):
+    invoice_id = invoice_data["header"].get("id", "")
+    return {
+        "title": invoice_id,
+        "author": invoice_data["trade"]["agreement"]["seller"].get("name", ""),
+        "subject": f"Rechnung {invoice_id}",
+    }
+
+
+def hybrid_update(pdf_path, invoice_data):
+    """Write the CII of ``invoice_data`` as an update to the PDF at ``pdf_path``."""
+    start_time = time.perf_counter()
+    xml = generate_cii_xml(invoice_data).encode("utf-8")
+    with open(pdf_path, "rb") as pdf_file:
+        update = build_update(pdf_file, xml, invoice_metadata(invoice_data))
+    logging.info(
+        f"Built a {len(update)} byte hybrid update for {pdf_path} in "
+        f"{time.perf_counter() - start_time:.6f} seconds"
+    )
+    return update
+
+
+def write_hybrid_pdf(pdf_path, invoice_data, output_path):
+    """Copy ``pdf_path`` to ``output_path`` and append the invoice update."""
+    update = hybrid_update(pdf_path, invoice_data)
+    shutil.copyfile(pdf_path, output_path)
+    with open(output_path, "ab") as output:
+        output.write(update)
+    return output_path
+
+
+def hybrid_pdf_chunks(pdf_path, update, chunk_size=HYBRID_CHUNK_SIZE):
+    """The original PDF as is, followed by ``update``, for a streamed response."""
+    with open(pdf_path, "rb") as pdf_file:
+        while chunk := pdf_file.read(chunk_size):
+            yield chunk
+    yield update
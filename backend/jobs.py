@@ -0,0 +1,354 @@
+import os
+import time
+import uuid
+import random
+import asyncio
+import logging
+import requests
+import httpx
+from pathlib import Path
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from google.genai import errors as genai_errors
+from executors import run_in_process, run_in_thread
+from pdf_parser import extract_invoice_data
+from xrechnung_generator import generate_xrechnung
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# "mongo" persists the queue in the jobs collection, "memory" is a local stand-in
+JOB_QUEUE = os.getenv("JOB_QUEUE", "mongo")
+# Jobs converted at the same time by one API process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+# A running job whose worker did not renew its lease within this time is
+# requeued; workers renew it every JOB_HEARTBEAT_INTERVAL while they convert
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "900"))
+JOB_HEARTBEAT_INTERVAL = float(
+    os.getenv("JOB_HEARTBEAT_INTERVAL", str(JOB_LEASE_SECONDS / 3))
+)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    requests.RequestException,
+    httpx.TransportError,
+    genai_errors.ServerError,
+)
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient(error):
+    """Network hiccups, rate limits and server errors are worth a retry."""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    return getattr(error, "code", None) in TRANSIENT_STATUS_CODES
+
+
+def new_job(pdf_key, session_id=None):
+    """A queued job for the PDF stored under ``pdf_key``."""
+    now = datetime.now()
+    return {
+        "_id": uuid.uuid4().hex,
+        "status": QUEUED,
+        "pdf": pdf_key,
+        "session_id": session_id,
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now,
+        "run_after": now,
+    }
+
+
+def public_job(job):
+    """The part of a job document that is returned to clients."""
+    response = {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+    }
+    if job["status"] == DONE:
+        response["result"] = job["result"]
+    if job.get("error"):
+        response["error"] = job["error"]
+    return response
+
+
+class MongoJobQueue:
+    """Jobs persisted in a Mongo collection, shared by all API processes.
+
+    Workers claim the oldest due job with an atomic ``find_one_and_update``,
+    so a job is only ever converted by one worker at a time.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def setup(self):
+        await self.collection.create_index([("status", 1), ("run_after", 1)])
+
+    async def put(self, job):
+        await self.collection.insert_one(job)
+        return job
+
+    async def get(self, job_id):
+        return await self.collection.find_one({"_id": job_id})
+
+    async def claim(self, worker):
+        now = datetime.now()
+        lease_expired = now - timedelta(seconds=JOB_LEASE_SECONDS)
+        return await self.collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": QUEUED, "run_after": {"$lte": now}},
+                    # Left behind by a worker that died
+                    {"status": RUNNING, "updated_at": {"$lt": lease_expired}},
+                ]
+            },
+            {
+                "$set": {"status": RUNNING, "worker": worker, "updated_at": now},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def renew(self, job_id, worker):
+        """Extend the lease of a running job, ``False`` if the worker lost it."""
+        result = await self.collection.update_one(
+            {"_id": job_id, "status": RUNNING, "worker": worker},
+            {"$set": {"updated_at": datetime.now()}},
+        )
+        return result.matched_count == 1
+
+    async def update(self, job_id, owner=None, **fields):
+        """Set ``fields``; with ``owner`` only while that worker runs the job."""
+        fields["updated_at"] = datetime.now()
+        query = {"_id": job_id}
+        if owner is not None:
+            query.update(status=RUNNING, worker=owner)
+        result = await self.collection.update_one(query, {"$set": fields})
+        return result.matched_count == 1
+
+    async def counts(self):
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        async for row in await self.collection.aggregate(
+            [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+        ):
+            counts[row["_id"]] = row["count"]
+        return counts
+
+
+class MemoryJobQueue:
+    """In-process stand-in for ``MongoJobQueue``, jobs are lost on restart."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = asyncio.Lock()
+
+    async def setup(self):
+        pass
+
+    async def put(self, job):
+        self.jobs[job["_id"]] = dict(job)
+        return job
+
+    async def get(self, job_id):
+        job = self.jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    async def claim(self, worker):
+        now = datetime.now()
+        lease_expired = now - timedelta(seconds=JOB_LEASE_SECONDS)
+        async with self.lock:
+            for job in sorted(self.jobs.values(), key=lambda job: job["created_at"]):
+                due = job["status"] == QUEUED and job["run_after"] <= now
+                stale = job["status"] == RUNNING and job["updated_at"] < lease_expired
+                if due or stale:
+                    job.update(status=RUNNING, worker=worker, updated_at=now)
+                    job["attempts"] += 1
+                    return dict(job)
+        return None
+
+    def owned(self, job_id, worker):
+        job = self.jobs[job_id]
+        return job["status"] == RUNNING and job.get("worker") == worker
+
+    async def renew(self, job_id, worker):
+        if not self.owned(job_id, worker):
+            return False
+        self.jobs[job_id]["updated_at"] = datetime.now()
+        return True
+
+    async def update(self, job_id, owner=None, **fields):
+        if owner is not None and not self.owned(job_id, owner):
+            return False
+        fields["updated_at"] = datetime.now()
+        self.jobs[job_id].update(fields)
+        return True
+
+    async def counts(self):
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        for job in self.jobs.values():
+            counts[job["status"]] += 1
+        return counts
+
+
+async def convert_job(job, storage):
+    """Convert the PDF of ``job``, read from ``storage`` on whichever node
+    claimed it."""
+    if "file" in job:
+        # Queued before job PDFs were put into the store
+        pdf_path = job["file"]
+    else:
+        pdf_path = str(await run_in_thread(storage.local_path, job["pdf"]))
+    invoice_data = await run_in_thread(extract_invoice_data, pdf_path, endpoint="jobs")
+    xml_content = await run_in_process(generate_xrechnung, invoice_data)
+    return {"invoice": invoice_data, "xml_content": xml_content}
+
+
+class JobWorkers:
+    """``JOB_WORKERS`` asyncio tasks draining the queue of this process.
+
+    ``handler(job)`` converts a job, e.g. ``convert_job`` with the storage.
+    """
+
+    def __init__(self, queue, handler, workers=JOB_WORKERS):
+        self.queue = queue
+        self.workers = workers
+        self.handler = handler
+        self.tasks = []
+        self.metrics = {
+            "completed": 0,
+            "failed": 0,
+            "retried": 0,
+            "seconds": 0.0,
+        }
+
+    async def start(self):
+        try:
+            await self.queue.setup()
+        except Exception as e:
+            logging.warning(f"Could not set up the job queue: {e}")
+        prefix = uuid.uuid4().hex[:6]
+        self.tasks = [
+            asyncio.create_task(self.run(f"{prefix}-{i}")) for i in range(self.workers)
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def run(self, worker):
+        while True:
+            try:
+                job = await self.queue.claim(worker)
+            except Exception as e:
+                logging.warning(f"Job worker {worker} could not claim a job: {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            await self.process(job)
+
+    async def process(self, job):
+        if job["attempts"] > JOB_MAX_ATTEMPTS:
+            # Lease ran out on the last attempt, the document keeps killing workers
+            await self.finish(job, "failed", status=FAILED, error="Job timed out")
+            return
+
+        logging.info(f"Starting job {job['_id']} (attempt {job['attempts']}) ...")
+        start_time = time.perf_counter()
+        heartbeat = asyncio.create_task(self.heartbeat(job))
+        try:
+            result = await self.handler(job)
+        except asyncio.CancelledError:
+            # Shutting down, let another worker pick it up again
+            await self.queue.update(job["_id"], owner=job["worker"], status=QUEUED)
+            raise
+        except Exception as e:
+            await self.fail(job, e)
+            return
+        finally:
+            heartbeat.cancel()
+            self.metrics["seconds"] += time.perf_counter() - start_time
+
+        if not await self.finish(
+            job, "completed", status=DONE, result=result, error=None
+        ):
+            return
+        logging.info(
+            f"Job {job['_id']} done in {time.perf_counter() - start_time:.3f} seconds"
+        )
+
+    async def heartbeat(self, job):
+        """Renew the lease of ``job`` until it is cancelled or the lease is lost."""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                if not await self.queue.renew(job["_id"], job["worker"]):
+                    logging.warning(f"Job {job['_id']} lost its lease")
+                    return
+            except Exception as e:
+                logging.warning(f"Could not renew the lease of job {job['_id']}: {e}")
+
+    async def finish(self, job, metric, **fields):
+        """Write the outcome and count it in ``metric`` if this worker still
+        holds the lease.
+
+        The stored PDF of a job is left to the retention, other sessions may
+        share it; only the local file of a job queued before the store is
+        removed once the job is done or failed.
+        """
+        if not await self.queue.update(job["_id"], owner=job["worker"], **fields):
+            logging.warning(
+                f"Job {job['_id']} was taken over by another worker, "
+                "dropping this attempt"
+            )
+            return False
+        self.metrics[metric] += 1
+        if fields["status"] in (DONE, FAILED) and "file" in job:
+            await run_in_thread(Path(job["file"]).unlink, missing_ok=True)
+        return True
+
+    async def fail(self, job, error):
+        if is_transient(error) and job["attempts"] < JOB_MAX_ATTEMPTS:
+            # Exponential backoff with jitter, so retries do not arrive together
+            delay = JOB_RETRY_DELAY * 2 ** (job["attempts"] - 1)
+            delay *= random.uniform(0.5, 1.5)
+            requeued = await self.finish(
+                job,
+                "retried",
+                status=QUEUED,
+                error=str(error),
+                run_after=datetime.now() + timedelta(seconds=delay),
+            )
+            if requeued:
+                logging.warning(
+                    f"Job {job['_id']} failed, retrying in {delay:.1f}s: {error}"
+                )
+            return
+
+        if await self.finish(job, "failed", status=FAILED, error=str(error)):
+            logging.error(f"Job {job['_id']} failed: {error}")
+
+    async def stats(self):
+        stats = dict(self.metrics)
+        stats["workers"] = self.workers
+        try:
+            stats["queue"] = await self.queue.counts()
+            stats["depth"] = stats["queue"][QUEUED] + stats["queue"][RUNNING]
+        except Exception as e:
+            stats["queue"] = {"error": str(e)}
+        return stats
@@ -0,0 +1,866 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import date, datetime
+from pathlib import Path
+from cache import content_hash
+from text_layer import read_words
+from utils import fix_settlement_tax
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Templates of recurring seller layouts, learned from confirmed extractions
+LAYOUTS = os.getenv("LAYOUTS", "1") == "1"
+LAYOUT_DIR = os.getenv("LAYOUT_DIR", "./uploads/.cache/layouts")
+# Share of label words a document needs in common with a template to use it
+LAYOUT_MIN_SCORE = float(os.getenv("LAYOUT_MIN_SCORE", "0.6"))
+# Share of the template fields that must be read back, below that the LLM runs
+LAYOUT_MIN_CONFIDENCE = float(os.getenv("LAYOUT_MIN_CONFIDENCE", "0.95"))
+# Confirmed extractions that must agree before a template is used
+LAYOUT_MIN_CONFIRMATIONS = int(os.getenv("LAYOUT_MIN_CONFIRMATIONS", "2"))
+
+LINE_TOLERANCE = 3  # points between the tops of words on one line
+VALUE_GAP = 15  # a wider gap ends a label or a text value
+COLUMN_TOLERANCE = 12
+HEADER_BAND = 0.15  # top share of the first page that makes up the fingerprint
+
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+DATE_FORMATS = ("%d.%m.%Y", "%d.%m.%y", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+SEPARATORS = {"|", "/", "-", "–", "·", "•"}
+# Code lists, the same on every invoice of a seller, kept even where they are
+# not printed
+CONSTANT_FIELDS = {
+    "type_code",
+    "currency_code",
+    "country_code",
+    "category",
+    "languages",
+    "quantity_unit",
+}
+# Seller and payment details without a label, only learned and replayed
+# where the invoice prints them (an IBAN is never filled in from the template)
+CONSTANT_PREFIXES = ("trade.agreement.seller.", "trade.settlement.payment_means.")
+# Usually one rate per seller, checked against the tax total when reused
+ITEM_CONSTANT_FIELDS = {"settlement_tax.rate"}
+# Computed by utils.fix_settlement_tax from delivery_details and the rate
+DERIVED_ITEM_FIELDS = {"total_amount", "settlement_tax.amount"}
+# The line net amount, every item row or block has one
+ROW_FIELD = "delivery_details"
+REQUIRED_FIELDS = ("header.id", "trade.settlement.monetary_summation.grand_total")
+
+_metrics = {"learned": 0, "matched": 0, "extracted": 0, "low_confidence": 0}
+
+
+# Words and values -----------------------------------------------------------
+
+
+def letters(text):
+    return sum(char.isalpha() for char in text)
+
+
+def digits(text):
+    return sum(char.isdigit() for char in text)
+
+
+def is_label_word(text):
+    return letters(text) >= 2 and not digits(text)
+
+
+def is_label(text):
+    words = text.split()
+    return any(letters(word) >= 2 for word in words) and all(
+        digits(word) < 3 for word in words
+    )
+
+
+def group_lines(pages):
+    """Words of all pages grouped into lines, in reading order."""
+    lines = []
+    for page in pages:
+        line = None
+        for word in sorted(page["words"], key=lambda word: (word["top"], word["x0"])):
+            if line is None or word["top"] - line["top"] > LINE_TOLERANCE:
+                line = {"page": page["page"], "top": word["top"], "words": []}
+                lines.append(line)
+            line["words"].append(word)
+    for line in lines:
+        line["words"].sort(key=lambda word: word["x0"])
+    return lines
+
+
+def line_text(line):
+    return " ".join(word["text"] for word in line["words"])
+
+
+def label_before(words, index):
+    """The words printed right before ``words[index]``, i.e. its label."""
+    label = []
+    for word in reversed(words[:index]):
+        if word["text"] in SEPARATORS or digits(word["text"]) >= 3:
+            break
+        if label and label[0]["x0"] - word["x1"] > VALUE_GAP:
+            break
+        label.insert(0, word)
+    return " ".join(word["text"] for word in label)
+
+
+def label_positions(lines, label):
+    """``(line, word)`` of the value after every place ``label`` is printed."""
+    target = label.split()
+    positions = []
+    for line_index, line in enumerate(lines):
+        texts = [word["text"] for word in line["words"]]
+        for word_index in range(len(texts) - len(target)):
+            if texts[word_index : word_index + len(target)] == target:
+                positions.append((line_index, word_index + len(target)))
+    return positions
+
+
+def text_run(words, start):
+    run = [words[start]]
+    for word in words[start + 1 :]:
+        if word["x0"] - run[-1]["x1"] > VALUE_GAP:
+            break
+        run.append(word)
+    return run
+
+
+def parse_number(text, decimal):
+    thousands = "." if decimal == "," else ","
+    cleaned = "".join(char for char in text if char.isdigit() or char in ",.")
+    cleaned = cleaned.replace(thousands, "").replace(decimal, ".").strip(".")
+    if not digits(cleaned):
+        return None
+    try:
+        number = float(cleaned)
+    except ValueError:
+        return None
+    stripped = text.strip()
+    return -number if stripped.startswith("-") or stripped.endswith("-") else number
+
+
+def parse_date(text):
+    text = text.strip(".,;:()")
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def field_kind(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str) and value.strip():
+        if ISO_DATE.match(value):
+            try:
+                date.fromisoformat(value[:10])
+                return "date"
+            except ValueError:
+                pass
+        return "text"
+    return None
+
+
+def number_format(value, text):
+    """The decimal separator that reads ``text`` as ``value``, if any."""
+    for decimal in (",", "."):
+        number = parse_number(text, decimal)
+        if number is not None and abs(number - value) < 0.005:
+            return decimal
+    return None
+
+
+def candidates(lines, value, kind):
+    """Yield ``(line, word, length, decimal)`` wherever ``value`` is printed."""
+    if kind == "date":
+        value = date.fromisoformat(value[:10])
+    for line_index, line in enumerate(lines):
+        words = line["words"]
+        for word_index, word in enumerate(words):
+            if kind == "number":
+                decimal = number_format(value, word["text"])
+                if decimal:
+                    yield line_index, word_index, 1, decimal
+            elif kind == "date":
+                if parse_date(word["text"]) == value:
+                    yield line_index, word_index, 1, None
+            else:
+                target = value.split()
+                texts = [word["text"] for word in words[word_index:]]
+                if texts[: len(target)] == target and len(
+                    text_run(words, word_index)
+                ) == len(target):
+                    yield line_index, word_index, len(target), None
+
+
+def read_value(words, index, spec):
+    if index >= len(words):
+        return None
+    if spec["kind"] == "text":
+        return " ".join(word["text"] for word in text_run(words, index))
+    if spec["kind"] == "date":
+        day = parse_date(words[index]["text"])
+        return day.isoformat() if day else None
+    number = parse_number(words[index]["text"], spec["decimal"])
+    if number is not None and spec.get("integer"):
+        number = int(round(number))
+    return number
+
+
+def flatten(value, path=""):
+    if isinstance(value, dict):
+        for key, child in value.items():
+            yield from flatten(child, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for index, child in enumerate(value):
+            yield from flatten(child, f"{path}.{index}")
+    elif field_kind(value) is not None:
+        yield path, value
+
+
+def set_path(data, path, value):
+    keys = path.split(".")
+    for key, next_key in zip(keys, keys[1:]):
+        container = [] if next_key.isdigit() else {}
+        if isinstance(data, list):
+            key = int(key)
+            while len(data) <= key:
+                data.append(container)
+            data = data[key]
+        else:
+            data = data.setdefault(key, container)
+    if isinstance(data, list):
+        key = int(keys[-1])
+        while len(data) <= key:
+            data.append(None)
+        data[key] = value
+    else:
+        data[keys[-1]] = value
+
+
+def is_code_list(path):
+    return path.rsplit(".", 1)[-1] in CONSTANT_FIELDS
+
+
+def is_printed(lines, value):
+    """Whether ``value`` is printed somewhere, spaces ignored (IBAN groups)."""
+    needle = re.sub(r"\s+", "", str(value))
+    return bool(needle) and any(
+        needle in "".join(word["text"] for word in line["words"]) for line in lines
+    )
+
+
+def is_constant(path, value, lines):
+    if not isinstance(value, str):
+        return False
+    if is_code_list(path):
+        return True
+    return path.startswith(CONSTANT_PREFIXES) and is_printed(lines, value)
+
+
+def page_size(pages):
+    return [pages[0]["width"], pages[0]["height"]]
+
+
+def label_words(pages):
+    return {word["text"] for word in pages[0]["words"] if is_label_word(word["text"])}
+
+
+def layout_fingerprint(pages):
+    """Hash of the page size and the labels printed in the letterhead."""
+    band = pages[0]["height"] * HEADER_BAND
+    header = sorted(
+        {
+            word["text"]
+            for word in pages[0]["words"]
+            if word["top"] < band and is_label_word(word["text"])
+        }
+    )
+    return content_hash(json.dumps(page_size(pages)), *header)
+
+
+def similarity(labels, other):
+    if not labels or not other:
+        return 0.0
+    return len(labels & other) / len(labels | other)
+
+
+# Learning -------------------------------------------------------------------
+
+
+def spec_for(value, kind, decimal):
+    spec = {"kind": kind}
+    if kind == "number":
+        spec["decimal"] = decimal
+        if isinstance(value, int):
+            spec["integer"] = True
+    return spec
+
+
+def item_fields(item):
+    return [
+        (path, value, field_kind(value))
+        for path, value in flatten(item)
+        if path not in DERIVED_ITEM_FIELDS
+    ]
+
+
+def item_constants(items, located):
+    constants = {}
+    for path, value, _ in item_fields(items[0]):
+        if path in located:
+            continue
+        is_code = isinstance(value, str) and is_code_list(path)
+        if not is_code and path not in ITEM_CONSTANT_FIELDS:
+            continue
+        if all(dict(flatten(item)).get(path) == value for item in items):
+            constants[path] = value
+    return constants
+
+
+def row_fields(item):
+    """The line amount first, then texts, so a small number like the quantity
+    does not claim the position number of the row."""
+    return sorted(
+        item_fields(item),
+        key=lambda field: (field[0] != ROW_FIELD, field[2] == "number"),
+    )
+
+
+def learn_item_table(lines, items, used):
+    """Items printed as table rows, one line per item."""
+    rows = []
+    start = 0
+    for item in items:
+        for line_index in range(start, len(lines)):
+            columns = {}
+            taken = set()
+            words = lines[line_index]["words"]
+            for path, value, kind in row_fields(item):
+                for _, word_index, length, decimal in candidates(
+                    [lines[line_index]], value, kind
+                ):
+                    cell = set(range(word_index, word_index + length))
+                    if (line_index, word_index) not in used and not cell & taken:
+                        taken |= cell
+                        columns[path] = {
+                            "x0": words[word_index]["x0"],
+                            "x1": words[word_index + length - 1]["x1"],
+                            **spec_for(value, kind, decimal),
+                        }
+                        break
+            numbers = sum(column["kind"] == "number" for column in columns.values())
+            if ROW_FIELD in columns and numbers >= 2:
+                rows.append((line_index, columns))
+                start = line_index + 1
+                break
+        else:
+            return None
+
+    first = rows[0][0]
+    if first == 0 or lines[first - 1]["page"] != lines[first]["page"]:
+        return None
+    header = line_text(lines[first - 1])
+    if not is_label(header):
+        return None
+
+    columns = {}
+    for path, column in rows[0][1].items():
+        row_columns = [row_columns.get(path) for _, row_columns in rows]
+        if all(row_column is not None for row_column in row_columns):
+            columns[path] = {
+                **column,
+                "x0": min(row_column["x0"] for row_column in row_columns),
+                "x1": max(row_column["x1"] for row_column in row_columns),
+            }
+    return {
+        "mode": "table",
+        "header": header,
+        "columns": columns,
+        "constants": item_constants(items, columns),
+    }
+
+
+def learn_item_blocks(lines, items, used):
+    """Items printed as blocks of labelled values, one block per item."""
+
+    def distance(candidate, pivot):
+        line, other = lines[candidate[0]], lines[pivot[0]]
+        return abs(line["page"] - other["page"]) * 10_000 + abs(
+            line["top"] - other["top"]
+        )
+
+    fields = None
+    for item in items:
+        located = {}
+        for path, value, kind in item_fields(item):
+            options = [
+                candidate
+                for candidate in candidates(lines, value, kind)
+                if candidate[:2] not in used
+                and is_label(label_before(lines[candidate[0]]["words"], candidate[1]))
+            ]
+            if options:
+                located[path] = (value, kind, options)
+        if ROW_FIELD not in located:
+            return None
+
+        # The value printed in the fewest places pins down the item's block
+        pivot = min(located.values(), key=lambda entry: len(entry[2]))[2][0]
+        block = {}
+        for path, (value, kind, options) in located.items():
+            line_index, word_index, _, decimal = min(
+                options, key=lambda candidate: distance(candidate, pivot)
+            )
+            used.add((line_index, word_index))
+            block[path] = {
+                "label": label_before(lines[line_index]["words"], word_index),
+                **spec_for(value, kind, decimal),
+            }
+        if fields is None:
+            fields = block
+        else:
+            fields = {
+                path: spec for path, spec in fields.items() if block.get(path) == spec
+            }
+
+    if ROW_FIELD not in fields:
+        return None
+    return {
+        "mode": "block",
+        "fields": fields,
+        "constants": item_constants(items, fields),
+    }
+
+
+def learn_template(pages, invoice_data):
+    """Template of where the confirmed ``invoice_data`` is printed in ``pages``.
+
+    Every value is located next to its label, e.g. the number after
+    "Rechnungsnummer:"; values without a label are not learned. Returns
+    ``None`` when the required fields or the items cannot be located.
+    """
+    lines = group_lines(pages)
+    used = set()
+    fields, constants = {}, {}
+    for path, value in flatten(invoice_data):
+        if path.startswith("trade.items."):
+            continue
+        kind = field_kind(value)
+        for line_index, word_index, _, decimal in candidates(lines, value, kind):
+            label = label_before(lines[line_index]["words"], word_index)
+            if (line_index, word_index) in used or not is_label(label):
+                continue
+            used.add((line_index, word_index))
+            page = lines[line_index]["page"]
+            ordinal = [
+                position
+                for position in label_positions(lines, label)
+                if lines[position[0]]["page"] == page
+            ].index((line_index, word_index))
+            fields[path] = {
+                "label": label,
+                "page": page,
+                "ordinal": ordinal,
+                **spec_for(value, kind, decimal),
+            }
+            break
+        else:
+            if is_constant(path, value, lines):
+                constants[path] = value
+
+    if any(path not in fields for path in REQUIRED_FIELDS):
+        return None
+
+    items = [item for item in invoice_data["trade"].get("items") or [] if item]
+    if items:
+        item_layout = learn_item_table(lines, items, used) or learn_item_blocks(
+            lines, items, used
+        )
+        if item_layout is None:
+            return None
+    else:
+        item_layout = {"mode": "none"}
+
+    return {
+        "id": layout_fingerprint(pages),
+        "size": page_size(pages),
+        "labels": sorted(label_words(pages)),
+        "fields": fields,
+        "constants": constants,
+        "items": item_layout,
+        "confirmations": 1,
+        "updated_at": datetime.now().isoformat(),
+    }
+
+
+def merge_items(old, new):
+    if old["mode"] != new["mode"]:
+        return new
+    constants = {
+        path: value
+        for path, value in old.get("constants", {}).items()
+        if new.get("constants", {}).get(path) == value
+    }
+    if new["mode"] == "block":
+        fields = {
+            path: spec
+            for path, spec in old["fields"].items()
+            if new["fields"].get(path) == spec
+        }
+        return {**new, "fields": fields, "constants": constants}
+    if new["mode"] == "table" and old["header"] == new["header"]:
+        columns = {}
+        for path, column in old["columns"].items():
+            other = new["columns"].get(path)
+            if other is not None and other["kind"] == column["kind"]:
+                columns[path] = {
+                    **column,
+                    "x0": min(column["x0"], other["x0"]),
+                    "x1": max(column["x1"], other["x1"]),
+                }
+        return {**new, "columns": columns, "constants": constants}
+    return new
+
+
+def merge_templates(old, new):
+    """Keep what two confirmations agree on, drops per-invoice coincidences."""
+    return {
+        **old,
+        "labels": sorted(set(old["labels"]) & set(new["labels"])),
+        "fields": {
+            path: spec
+            for path, spec in old["fields"].items()
+            if new["fields"].get(path) == spec
+        },
+        "constants": {
+            path: value
+            for path, value in old["constants"].items()
+            if new["constants"].get(path) == value
+        },
+        "items": merge_items(old["items"], new["items"]),
+        "confirmations": old["confirmations"] + 1,
+        "updated_at": new["updated_at"],
+    }
+
+
+# Extraction -----------------------------------------------------------------
+
+
+def read_item_blocks(lines, layout, claimed):
+    positions = {
+        path: [
+            position
+            for position in label_positions(lines, spec["label"])
+            if position not in claimed
+        ]
+        for path, spec in layout["fields"].items()
+    }
+    items, expected, read = [], 0, 0
+    for index in range(len(positions[ROW_FIELD])):
+        item = {}
+        for path, spec in layout["fields"].items():
+            expected += 1
+            if index >= len(positions[path]):
+                continue
+            line_index, word_index = positions[path][index]
+            value = read_value(lines[line_index]["words"], word_index, spec)
+            if value is not None:
+                set_path(item, path, value)
+                read += 1
+        items.append(item)
+    return items, expected, read
+
+
+def in_column(word, column, right):
+    if column["kind"] == "text":
+        return column["x0"] - COLUMN_TOLERANCE <= word["x0"] < right
+    return (
+        word["x1"] >= column["x0"] - COLUMN_TOLERANCE
+        and word["x0"] <= column["x1"] + COLUMN_TOLERANCE
+    )
+
+
+def read_item_table(lines, layout, stop_labels):
+    header = [
+        index for index, line in enumerate(lines) if line_text(line) == layout["header"]
+    ]
+    if not header:
+        return [], 1, 0
+
+    columns = layout["columns"]
+    rights = {
+        path: min(
+            [
+                other["x0"] - COLUMN_TOLERANCE
+                for other in columns.values()
+                if other["x0"] > column["x0"]
+            ],
+            default=float("inf"),
+        )
+        for path, column in columns.items()
+    }
+    items, expected, read = [], 0, 0
+    for line in lines[header[0] + 1 :]:
+        # The totals below the table end it
+        if line["page"] != lines[header[0]]["page"] or line_text(line).startswith(
+            stop_labels
+        ):
+            break
+        cells = {
+            path: [
+                word for word in line["words"] if in_column(word, column, rights[path])
+            ]
+            for path, column in columns.items()
+        }
+        if read_value(cells[ROW_FIELD], 0, columns[ROW_FIELD]) is None:
+            continue  # continued description
+        item = {}
+        for path, column in columns.items():
+            expected += 1
+            if not cells[path]:
+                continue
+            if column["kind"] == "text":
+                value = " ".join(word["text"] for word in cells[path])
+            else:
+                value = read_value(cells[path], 0, column)
+            if value is not None:
+                set_path(item, path, value)
+                read += 1
+        items.append(item)
+    return items, expected, read
+
+
+def extract_with_template(pages, template):
+    """Read the fields of ``template`` from ``pages``, returns ``(data, confidence)``."""
+    lines = group_lines(pages)
+    invoice_data = {}
+    claimed = set()
+    read = 0
+    for path, spec in template["fields"].items():
+        positions = [
+            position
+            for position in label_positions(lines, spec["label"])
+            if lines[position[0]]["page"] == spec["page"]
+        ]
+        if spec["ordinal"] >= len(positions):
+            continue
+        line_index, word_index = positions[spec["ordinal"]]
+        value = read_value(lines[line_index]["words"], word_index, spec)
+        if value is not None:
+            claimed.add((line_index, word_index))
+            set_path(invoice_data, path, value)
+            read += 1
+    expected = len(template["fields"])
+    for path, value in template["constants"].items():
+        if is_code_list(path):
+            set_path(invoice_data, path, value)
+            continue
+        # Counts as a field, a seller that is not printed leaves it to the LLM
+        expected += 1
+        if is_printed(lines, value):
+            set_path(invoice_data, path, value)
+            read += 1
+
+    layout = template["items"]
+    if layout["mode"] != "none":
+        if layout["mode"] == "block":
+            items, item_expected, item_read = read_item_blocks(lines, layout, claimed)
+        else:
+            stop_labels = tuple(spec["label"] for spec in template["fields"].values())
+            items, item_expected, item_read = read_item_table(
+                lines, layout, stop_labels
+            )
+        if not items:
+            item_expected += 1
+        for item in items:
+            for path, value in layout["constants"].items():
+                set_path(item, path, value)
+        invoice_data.setdefault("trade", {})["items"] = items
+        expected += item_expected
+        read += item_read
+
+    return invoice_data, read / expected if expected else 0.0
+
+
+def close(a, b, tolerance=0.015):
+    return abs(a - b) <= tolerance
+
+
+def is_consistent(invoice_data):
+    """The amounts read add up, the cheapest check that no field slipped."""
+    trade = invoice_data.get("trade", {})
+    summation = trade.get("settlement", {}).get("monetary_summation", {})
+    net_total = summation.get("net_total")
+    tax_total = summation.get("tax_total")
+    grand_total = summation.get("grand_total")
+    if None not in (net_total, tax_total, grand_total):
+        if not close(net_total + tax_total, grand_total):
+            return False
+
+    items = trade.get("items", [])
+    for item in items:
+        quantity = item.get("quantity")
+        price = item.get("agreement_net_price")
+        line_total = item.get(ROW_FIELD)
+        if None not in (quantity, price, line_total):
+            if not close(
+                quantity * price, line_total, max(0.015, abs(line_total) * 0.005)
+            ):
+                return False
+
+    rates = [item.get("settlement_tax", {}).get("rate") for item in items]
+    line_totals = [item.get(ROW_FIELD) for item in items]
+    if items and tax_total is not None and None not in rates + line_totals:
+        item_tax = sum(total * rate / 100 for total, rate in zip(line_totals, rates))
+        if not close(item_tax, tax_total, 0.01 * len(items) + 0.015):
+            return False
+
+    if items and net_total is not None and None not in line_totals:
+        expected = (
+            sum(line_totals)
+            + summation.get("charge_total", 0)
+            - summation.get("allowance_total", 0)
+        )
+        if not close(expected, net_total, 0.01 * len(items) + 0.005):
+            return False
+    return True
+
+
+class LayoutStore:
+    """Layout templates on the local disk, one JSON file per template.
+
+    All templates are kept in memory and reloaded when another process
+    changed the directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.templates = {}
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            mtime = self.directory.stat().st_mtime
+        except FileNotFoundError:
+            return self.templates
+        if mtime != self.loaded:
+            templates = {}
+            for path in self.directory.glob("*.json"):
+                try:
+                    template = json.loads(path.read_text())
+                    templates[template["id"]] = template
+                except (OSError, ValueError, KeyError) as e:
+                    logging.warning(f"Could not load layout template {path}: {e}")
+            self.templates, self.loaded = templates, mtime
+        return self.templates
+
+    def match(self, pages):
+        """Best template for ``pages`` and its score, ``(None, score)`` if none fits."""
+        templates = self.load()
+        template = templates.get(layout_fingerprint(pages))
+        if template is not None:
+            return template, 1.0
+
+        size, labels = page_size(pages), label_words(pages)
+        best, best_score = None, 0.0
+        for template in templates.values():
+            if template["size"] != size:
+                continue
+            score = similarity(labels, set(template["labels"]))
+            if score > best_score:
+                best, best_score = template, score
+        if best_score >= LAYOUT_MIN_SCORE:
+            return best, best_score
+        return None, best_score
+
+    def save(self, template):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{template['id']}.json"
+        tmp = self.directory / f".tmp-{uuid.uuid4().hex}"
+        tmp.write_text(json.dumps(template, ensure_ascii=False))
+        os.replace(tmp, path)
+        self.templates[template["id"]] = template
+
+    def learn(self, pages, invoice_data):
+        learned = learn_template(pages, invoice_data)
+        if learned is None:
+            return None
+        with self.lock:
+            existing, _ = self.match(pages)
+            template = (
+                learned if existing is None else merge_templates(existing, learned)
+            )
+            self.save(template)
+        return template
+
+
+layout_store = LayoutStore(LAYOUT_DIR)
+
+
+def extract_with_layout(pages):
+    """Deterministic extraction for a known seller layout, ``None`` otherwise."""
+    if not LAYOUTS or not pages or not pages[0]["words"]:
+        return None
+    start_time = time.perf_counter()
+    template, score = layout_store.match(pages)
+    if template is None or template["confirmations"] < LAYOUT_MIN_CONFIRMATIONS:
+        return None
+    _metrics["matched"] += 1
+
+    invoice_data, confidence = extract_with_template(pages, template)
+    missing = [
+        path
+        for path in REQUIRED_FIELDS
+        if dict(flatten(invoice_data)).get(path) is None
+    ]
+    if confidence < LAYOUT_MIN_CONFIDENCE or missing or not is_consistent(invoice_data):
+        _metrics["low_confidence"] += 1
+        logging.info(
+            f"Layout {template['id'][:12]} matched (score {score:.2f}) but read "
+            f"with confidence {confidence:.2f}, using the LLM"
+        )
+        return None
+
+    _metrics["extracted"] += 1
+    logging.info(
+        f"Extracted with layout {template['id'][:12]} in "
+        f"{time.perf_counter() - start_time:.6f} seconds"
+    )
+    return fix_settlement_tax(invoice_data)
+
+
+def learn_layout(pdf_file_path, invoice_data):
+    """Learn or refine the template of a PDF from its confirmed invoice data."""
+    if not LAYOUTS:
+        return None
+    try:
+        template = layout_store.learn(read_words(pdf_file_path), invoice_data)
+    except Exception as e:
+        logging.warning(f"Could not learn the layout of {pdf_file_path}: {e}")
+        return None
+    if template is not None:
+        _metrics["learned"] += 1
+        logging.info(
+            f"Learned layout {template['id'][:12]} from {pdf_file_path} "
+            f"({template['confirmations']} confirmations)"
+        )
+    return template
+
+
+def layout_stats():
+    stats = dict(_metrics)
+    stats["templates"] = len(layout_store.load())
+    return stats
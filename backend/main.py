@@ -1,10 +1,16 @@
 import os
+import shutil
+import logging
+import zipfile
+import threading
 import uvicorn
 import subprocess
 import uuid
 from datetime import datetime
-from pymongo import MongoClient
+from functools import partial
+from pymongo import AsyncMongoClient
 from fastapi import (
+    BackgroundTasks,
     FastAPI,
     File,
     UploadFile,
@@ -14,13 +20,36 @@ from fastapi import (
     Request,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-from pathlib import Path
-from pdf_parser import extract_invoice_data, generate_invoice_xml
-from validate import validate
-from xrechnung_generator import generate_xrechnung
+from pathlib import Path, PurePosixPath
+from gemini_integration import gemini_stats
+from ollama_integration import ollama_stats
+from browser_pool import browser_stats, close_browser_pools
+from layouts import layout_stats, learn_layout
+from hedging import hedging_stats
+from chunked import chunked_stats
+from pdf_parser import (
+    extract_invoice_data,
+    extraction_cache_stats,
+    generate_invoice_xml,
+)
+from validate import validate, failure, start_validator_daemon, stop_validator_daemon
+from ocr import preload_readers, ocr_stats
+from xrechnung_generator import generate_xrechnung, write_xrechnung
+from cii_reader import convert_cii
+from cii_writer import CII_WRITER, write_cii_file
+from hybrid_pdf import hybrid_pdf_chunks, hybrid_update
+from executors import run_in_process, run_in_thread, shutdown_executors
+from jobs import JOB_QUEUE, JobWorkers, MemoryJobQueue, MongoJobQueue
+from jobs import convert_job, new_job, public_job
+from batch import BATCH_MAX_FILES, count_batch_files, iter_batch_sources, stream_batch
+from uploads import UploadLimitMiddleware, UploadTooLarge
+from uploads import check_page_budget, save_upload
+from cache import file_hash
+from storage import RetentionCollector, artifact_key, derived_key, open_storage
+from storage import STORAGE_DIR, STORAGE_SCRATCH_DIR, scratch_path, storage_stats
 
 app = FastAPI()
 
@@ -28,6 +57,8 @@ DEBUG = False
 
 ORIGIN = "https://pdftoxrechnung.de" if not DEBUG else "http://localhost:3000"
 
+# Added before CORS so that its 413 answers carry the CORS headers too
+app.add_middleware(UploadLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[ORIGIN],
@@ -40,15 +71,50 @@ app.add_middleware(
 UPLOAD_FOLDER = Path("./uploads")
 UPLOAD_FOLDER.mkdir(exist_ok=True)
 
-RAPID_API_FOLDER = UPLOAD_FOLDER / "rapidapi"
-RAPID_API_FOLDER.mkdir(parents=True, exist_ok=True)
 RAPID_API_SECRET_KEY = os.getenv("RAPID_API_SECRET_KEY")
 
 MONGO_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-client = MongoClient(MONGO_URI)
+client = AsyncMongoClient(MONGO_URI)
 db = client["pdftoxrechnung"]
 sessions_collection = db["sessions"]
 
+BATCH_FOLDER = UPLOAD_FOLDER / "batches"
+BATCH_FOLDER.mkdir(parents=True, exist_ok=True)
+
+job_queue = MongoJobQueue(db["jobs"]) if JOB_QUEUE == "mongo" else MemoryJobQueue()
+
+# PDFs, XMLs and reports, content-addressed and collected after their TTL
+storage = open_storage()
+# Also collects the session folders of UPLOAD_FOLDER, which old sessions read
+# (and the uploads/jobs folder of jobs queued before the store), and batch
+# folders a crash left behind
+retention_collector = RetentionCollector(
+    storage,
+    legacy_roots=[UPLOAD_FOLDER, BATCH_FOLDER],
+    legacy_keep=[BATCH_FOLDER, STORAGE_DIR, STORAGE_SCRATCH_DIR],
+)
+# Job PDFs are in the store, any node can convert them
+job_workers = JobWorkers(job_queue, handler=partial(convert_job, storage=storage))
+
+
+@app.on_event("startup")
+async def startup():
+    start_validator_daemon()
+    # Load the OCR models in the background so startup is not delayed
+    threading.Thread(target=preload_readers, daemon=True).start()
+    await job_workers.start()
+    await retention_collector.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await job_workers.stop()
+    await retention_collector.stop()
+    stop_validator_daemon()
+    shutdown_executors()
+    close_browser_pools()
+    await client.close()
+
 
 def generate_unique_filename(prefix: str, extension: str) -> str:
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -56,6 +122,65 @@ def generate_unique_filename(prefix: str, extension: str) -> str:
     return f"{prefix}_{timestamp}_{unique_id}.{extension}"
 
 
+async def receive_pdf(file: UploadFile, file_path: Path) -> str:
+    """Streams an uploaded PDF to ``file_path`` and returns its SHA-256."""
+    try:
+        pdf_hash, _ = await save_upload(file, file_path)
+        await run_in_thread(check_page_budget, str(file_path))
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return pdf_hash
+
+
+async def store_file(kind: str, path: Path, digest: str = None) -> str:
+    """Puts a finished file into the store and returns its key."""
+    if digest is None:
+        digest = await run_in_thread(file_hash, str(path))
+    key = artifact_key(kind, digest, path.suffix)
+    await run_in_thread(storage.put_file, key, path)
+    return key
+
+
+async def stored_file(session_id: str, name: str) -> Path:
+    """Local path of a session artifact.
+
+    Sessions from before the store hold file names in the session folder.
+    """
+    if "/" not in name:
+        return UPLOAD_FOLDER / session_id / name
+    return await run_in_thread(storage.local_path, name)
+
+
+async def store_generated(path: Path):
+    """Stores a generated XML from the scratch folder.
+
+    Returns its key and the local path to serve it from.
+    """
+    try:
+        key = await store_file("xml", path)
+    finally:
+        await run_in_thread(path.unlink, missing_ok=True)
+    return key, await run_in_thread(storage.local_path, key)
+
+
+async def report_file(session_id: str, xml_name: str, suffix: str):
+    """Local path and download name of the validation report of an XML."""
+    if "/" not in xml_name:
+        filename = xml_name.replace(".xml", suffix)
+        return UPLOAD_FOLDER / session_id / filename, filename
+    key = derived_key(xml_name, "report", suffix)
+    return await run_in_thread(storage.local_path, key), PurePosixPath(key).name
+
+
+async def store_reports(xml_key: str, xml_file: Path, folder: Path):
+    """Stores the validation reports written next to ``xml_file``."""
+    for report in folder.glob(f"{xml_file.stem}-report.*"):
+        suffix = report.name[len(xml_file.stem) :]
+        await run_in_thread(
+            storage.put_file, derived_key(xml_key, "report", suffix), report
+        )
+
+
 async def verify_rapidapi_headers(
     rapidapi_secret: Optional[str] = Header(None, alias="X-RapidAPI-Proxy-Secret"),
     session_id: Optional[str] = Header(None, alias="X-Session-ID"),
@@ -88,27 +213,49 @@ async def ping():
     return {"message": "alive"}
 
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "ocr": ocr_stats(),
+        "extraction_cache": extraction_cache_stats(),
+        "jobs": await job_workers.stats(),
+        "gemini": gemini_stats(),
+        "ollama": ollama_stats(),
+        "browsers": browser_stats(),
+        "layouts": layout_stats(),
+        "hedging": hedging_stats(),
+        "chunked": chunked_stats(),
+        "storage": storage_stats(),
+    }
+
+
 @app.post("/autoconvert")
 async def auto_convert(
-    file: UploadFile = File(...), session_id: str = Depends(verify_rapidapi_headers)
+    file: UploadFile = File(...),
+    session_id: str = Depends(verify_rapidapi_headers),
+    cache_bypass: bool = Header(False, alias="X-Cache-Bypass"),
 ):
     # 📄 Check file type
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
 
-    # 📁 Create folder if does not exist
-    RAPID_API_FOLDER.mkdir(parents=True, exist_ok=True)
-
-    # 📁 Save uploaded file
-    unique_filename = generate_unique_filename("invoice", "pdf")
-    file_path = RAPID_API_FOLDER / unique_filename
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
-
-    # 🧠 Convert to structured invoice, generate XML
-    invoice_data = extract_invoice_data(str(file_path))
-    xml_content = generate_xrechnung(invoice_data)
+    # 📁 Save uploaded file, a PDF sent before is stored once
+    file_path = scratch_path(".pdf")
+    try:
+        pdf_hash = await receive_pdf(file, file_path)
+        await store_file("pdf", file_path, pdf_hash)
+
+        # 🧠 Convert to structured invoice, generate XML
+        invoice_data = await run_in_thread(
+            extract_invoice_data,
+            str(file_path),
+            bypass_cache=cache_bypass,
+            endpoint="autoconvert",
+            pdf_hash=pdf_hash,
+        )
+    finally:
+        await run_in_thread(file_path.unlink, missing_ok=True)
+    xml_content = await run_in_process(generate_xrechnung, invoice_data)
 
     # 📤 Return XML content as JSON
     return JSONResponse(
@@ -119,25 +266,114 @@ async def auto_convert(
     )
 
 
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(...), session_id: str = Depends(verify_rapidapi_headers)
+):
+    """Queues a PDF for conversion and returns the job id right away."""
+    if not file.filename.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Only PDF files are allowed")
+
+    file_path = scratch_path(".pdf")
+    try:
+        pdf_hash = await receive_pdf(file, file_path)
+        pdf_key = await store_file("pdf", file_path, pdf_hash)
+    finally:
+        await run_in_thread(file_path.unlink, missing_ok=True)
+
+    job = await job_queue.put(new_job(pdf_key, session_id))
+    return JSONResponse(
+        status_code=202,
+        content=public_job(job),
+        headers={"Location": f"/jobs/{job['_id']}"},
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, session_id: str = Depends(verify_rapidapi_headers)):
+    """Returns the status of a job, and its invoice and XML once it is done."""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return public_job(job)
+
+
+def store_batch_uploads(files, folder):
+    folder.mkdir(parents=True)
+    uploads = []
+    for index, file in enumerate(files):
+        extension = "zip" if file.filename.lower().endswith(".zip") else "pdf"
+        path = folder / f"upload_{index}.{extension}"
+        with open(path, "wb") as f:
+            shutil.copyfileobj(file.file, f)
+        uploads.append((file.filename, path))
+    return uploads
+
+
+@app.post("/batch")
+async def convert_batch(
+    files: List[UploadFile] = File(...),
+    session_id: str = Depends(verify_rapidapi_headers),
+):
+    """Converts a ZIP or a list of PDFs, streaming one NDJSON line per invoice."""
+    for file in files:
+        if not file.filename.lower().endswith((".pdf", ".zip")):
+            raise HTTPException(
+                status_code=400, detail="Only PDF and ZIP files are allowed"
+            )
+
+    folder = BATCH_FOLDER / uuid.uuid4().hex
+    try:
+        uploads = await run_in_thread(store_batch_uploads, files, folder)
+        count = await run_in_thread(count_batch_files, uploads)
+    except zipfile.BadZipFile:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise HTTPException(status_code=400, detail="Invalid ZIP file")
+    if count > BATCH_MAX_FILES:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise HTTPException(
+            status_code=413,
+            detail=f"A batch may contain at most {BATCH_MAX_FILES} invoices",
+        )
+
+    return StreamingResponse(
+        stream_batch(iter_batch_sources(uploads, folder), folder),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Size": str(count)},
+    )
+
+
 @app.post("/upload")
 async def upload_pdf(
     file: UploadFile = File(...),
     session_id: str = Header(..., alias="X-Session-ID"),
+    cache_bypass: bool = Header(False, alias="X-Cache-Bypass"),
     _: None = Depends(verify_origin_headers),
 ):
     """Accepts a PDF invoice, extracts text, and returns a structured JSON invoice."""
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
 
-    unique_filename = generate_unique_filename("invoice", "pdf")
-    session_folder = UPLOAD_FOLDER / session_id
-    session_folder.mkdir(exist_ok=True)
-    file_path = session_folder / unique_filename
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
-
-    invoice_data = extract_invoice_data(str(file_path))
+    file_path = scratch_path(".pdf")
+    try:
+        pdf_hash = await receive_pdf(file, file_path)
+        pdf_key = await store_file("pdf", file_path, pdf_hash)
+
+        invoice_data = await run_in_thread(
+            extract_invoice_data,
+            str(file_path),
+            bypass_cache=cache_bypass,
+            endpoint="upload",
+            pdf_hash=pdf_hash,
+        )
+    finally:
+        await run_in_thread(file_path.unlink, missing_ok=True)
+    # The confirmed data sent to /convert teaches the layout of this PDF
+    await sessions_collection.update_one(
+        {"session_id": session_id},
+        {"$set": {"pdf": pdf_key}, "$unset": {"learned": ""}},
+        upsert=True,
+    )
 
     # Explicitly add CORS headers
     response = JSONResponse(content=invoice_data)
@@ -153,11 +389,16 @@ async def convert_to_zugferd(
 ):
     """Receives JSON invoice data and converts it to XML."""
     try:
-        xml_content = generate_invoice_xml(invoice_data)
         unique_filename = generate_unique_filename("invoice_zugferd", "xml")
-        output_file_path = UPLOAD_FOLDER / unique_filename
-        with open(output_file_path, "w") as f:
-            f.write(xml_content)
+        output_file_path = scratch_path(".xml")
+        if CII_WRITER == "lxml":
+            # Streamed to disk, thousands of line items do not pile up in memory
+            await run_in_process(write_cii_file, invoice_data, str(output_file_path))
+        else:
+            # drafthorse is quick, a thread keeps pdf_parser out of the CPU workers
+            xml_content = await run_in_thread(generate_invoice_xml, invoice_data)
+            await run_in_thread(output_file_path.write_text, xml_content)
+        _, output_file_path = await store_generated(output_file_path)
         return FileResponse(
             output_file_path,
             media_type="application/xml",
@@ -167,22 +408,71 @@ async def convert_to_zugferd(
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 
+@app.post("/convert/hybrid")
+async def convert_to_hybrid(
+    invoice_data: dict,
+    session_id: str = Header(..., alias="X-Session-ID"),
+    _: None = Depends(verify_origin_headers),
+):
+    """Returns the uploaded PDF with the ZUGFeRD XML of the invoice embedded."""
+    session = await sessions_collection.find_one({"session_id": session_id})
+    if not session or not session.get("pdf"):
+        raise HTTPException(status_code=404, detail="No uploaded PDF for this session")
+
+    try:
+        pdf_path = await stored_file(session_id, session["pdf"])
+        # Appended to the untouched upload, the PDF itself is only streamed
+        update = await run_in_process(hybrid_update, str(pdf_path), invoice_data)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="The uploaded PDF has expired")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    unique_filename = generate_unique_filename("invoice_zugferd", "pdf")
+    response = StreamingResponse(
+        hybrid_pdf_chunks(str(pdf_path), update),
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{unique_filename}"',
+            "Content-Length": str(pdf_path.stat().st_size + len(update)),
+        },
+    )
+    response.headers["Access-Control-Allow-Origin"] = ORIGIN
+    return response
+
+
 @app.post("/convert")
 async def convert_to_xrechnung(
     invoice_data: dict,
+    background_tasks: BackgroundTasks,
     session_id: str = Header(..., alias="X-Session-ID"),
     _: None = Depends(verify_origin_headers),
 ):
     """Receives JSON invoice data and converts it to XML."""
-    xml_content = generate_xrechnung(invoice_data)
     unique_filename = generate_unique_filename("invoice_xrechnung", "xml")
-    output_file_path = UPLOAD_FOLDER / session_id / unique_filename
-    with open(output_file_path, "w") as f:
-        f.write(xml_content)
-
-    sessions_collection.update_one(
+    output_file_path = scratch_path(".xml")
+    await run_in_process(write_xrechnung, invoice_data, str(output_file_path))
+    xml_key, output_file_path = await store_generated(output_file_path)
+    session = await sessions_collection.find_one({"session_id": session_id})
+    # One confirmation per upload, the PDF stays for /convert/hybrid
+    pdf_key = session.get("pdf") if session else None
+    learn = pdf_key is not None and session.get("learned") != pdf_key
+    if learn:
+        try:
+            pdf_path = await stored_file(session_id, pdf_key)
+            background_tasks.add_task(learn_layout, str(pdf_path), invoice_data)
+        except FileNotFoundError:
+            logging.info(f"Upload of session {session_id} expired, nothing to learn")
+
+    await sessions_collection.update_one(
         {"session_id": session_id},
-        {"$set": {"xrechnung": unique_filename, "created_at": datetime.now()}},
+        {
+            "$set": {
+                "xrechnung": xml_key,
+                "created_at": datetime.now(),
+                **({"learned": pdf_key} if learn else {}),
+            },
+        },
         upsert=True,
     )
 
@@ -196,17 +486,62 @@ async def convert_to_xrechnung(
     return response
 
 
+@app.post("/convert/cii")
+async def convert_cii_to_xrechnung(
+    file: UploadFile = File(...),
+    session_id: str = Header(..., alias="X-Session-ID"),
+    _: None = Depends(verify_origin_headers),
+):
+    """Receives a ZUGFeRD/Factur-X CII XML and converts it to XRechnung (UBL)."""
+    if not file.filename.lower().endswith(".xml"):
+        raise HTTPException(status_code=400, detail="Only XML files are allowed")
+
+    cii_path = scratch_path(".xml")
+    try:
+        await save_upload(file, cii_path)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        # The worker reads the file, the upload is not pickled into the pool
+        xml_content = await run_in_process(convert_cii, str(cii_path))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid CII XML: {str(e)}")
+    finally:
+        cii_path.unlink(missing_ok=True)
+
+    unique_filename = generate_unique_filename("invoice_xrechnung", "xml")
+    output_file_path = scratch_path(".xml")
+    await run_in_thread(output_file_path.write_text, xml_content)
+    xml_key, output_file_path = await store_generated(output_file_path)
+
+    await sessions_collection.update_one(
+        {"session_id": session_id},
+        {"$set": {"xrechnung": xml_key, "created_at": datetime.now()}},
+        upsert=True,
+    )
+
+    response = FileResponse(
+        output_file_path,
+        media_type="application/xml",
+        filename=unique_filename,
+    )
+    response.headers["Access-Control-Allow-Origin"] = ORIGIN
+    return response
+
+
 @app.get("/validation-report-content")
 async def validation_report(
     session_id: str = Header(..., alias="X-Session-ID"),
 ):
-    session = sessions_collection.find_one({"session_id": session_id})
-    filename = (
-        session.get("xrechnung").replace(".xml", "-report.xml") if session else None
-    )
-    if filename is None:
+    session = await sessions_collection.find_one({"session_id": session_id})
+    if not session or not session.get("xrechnung"):
+        return {"message": "File not found", "status": 400}
+    try:
+        output_file_path, filename = await report_file(
+            session_id, session["xrechnung"], "-report.xml"
+        )
+    except FileNotFoundError:
         return {"message": "File not found", "status": 400}
-    output_file_path = UPLOAD_FOLDER / session_id / filename
     response = FileResponse(
         output_file_path,
         media_type="application/xml",
@@ -220,13 +555,15 @@ async def validation_report(
 async def download_report(
     session_id: str = Header(..., alias="X-Session-ID"),
 ):
-    session = sessions_collection.find_one({"session_id": session_id})
-    filename = (
-        session.get("xrechnung").replace(".xml", "-report.html") if session else None
-    )
-    if filename is None:
+    session = await sessions_collection.find_one({"session_id": session_id})
+    if not session or not session.get("xrechnung"):
+        return {"message": "File not found", "status": 400}
+    try:
+        output_file_path, filename = await report_file(
+            session_id, session["xrechnung"], "-report.html"
+        )
+    except FileNotFoundError:
         return {"message": "File not found", "status": 400}
-    output_file_path = UPLOAD_FOLDER / session_id / filename
     response = FileResponse(
         output_file_path,
         media_type="application/html",
@@ -241,11 +578,25 @@ async def validate_xml(
     session_id: str = Header(..., alias="X-Session-ID"),
     _: None = Depends(verify_origin_headers),
 ):
-    session = sessions_collection.find_one({"session_id": session_id})
-    xml_filename = session.get("xrechnung") if session else "invoice_xrechnung.xml"
-    session_folder = UPLOAD_FOLDER / session_id
-    xml_file = session_folder / xml_filename
-    return validate(xml_file, session_folder)
+    session = await sessions_collection.find_one({"session_id": session_id})
+    xml_name = session.get("xrechnung") if session else "invoice_xrechnung.xml"
+    if "/" not in xml_name:
+        session_folder = UPLOAD_FOLDER / session_id
+        return await run_in_thread(validate, session_folder / xml_name, session_folder)
+
+    try:
+        xml_file = await stored_file(session_id, xml_name)
+    except FileNotFoundError:
+        return failure(-99, "The XML has expired")
+    # The reports are written next to a working copy and stored with the XML
+    folder = scratch_path("")
+    folder.mkdir()
+    try:
+        result = await run_in_thread(validate, xml_file, folder)
+        await store_reports(xml_name, xml_file, folder)
+    finally:
+        await run_in_thread(shutil.rmtree, folder, ignore_errors=True)
+    return result
 
 
 if __name__ == "__main__":
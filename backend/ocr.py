@@ -0,0 +1,299 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import easyocr
+from pdf2image import convert_from_path, pdfinfo_from_path
+from executors import CPU_WORKERS, get_process_pool, shutdown_process_pool
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Readers are kept per language set, bounded by count and by model memory
+OCR_MAX_READERS = int(os.getenv("OCR_MAX_READERS", "3"))
+OCR_MAX_MEMORY_MB = int(os.getenv("OCR_MAX_MEMORY_MB", "1024"))
+# e.g. "de;en" preloads two readers, "de,en" one reader for both languages
+OCR_PRELOAD_LANGUAGES = os.getenv("OCR_PRELOAD_LANGUAGES", "")
+OCR_MIN_CONFIDENCE = 0.5
+# Pages are rendered one at a time at this resolution
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "1") == "1"
+
+# Page-parallel OCR: pages of a document fan out to the shared CPU pool of
+# executors.py, sized by CPU_WORKERS
+OCR_PARALLEL = os.getenv("OCR_PARALLEL", "1") == "1"
+# Upper bound of pages of one document in flight, keeps workers free for others
+OCR_MAX_PAGES_IN_FLIGHT = int(os.getenv("OCR_MAX_PAGES_IN_FLIGHT", "4"))
+
+
+class ReaderEntry:
+    def __init__(self, reader, memory):
+        self.reader = reader
+        self.memory = memory
+        # EasyOCR readers are not safe for concurrent readtext() calls
+        self.lock = threading.Lock()
+
+
+_readers = OrderedDict()
+_loading = {}
+_registry_lock = threading.Lock()
+_metrics = {
+    "loads": 0,
+    "load_seconds": 0.0,
+    "evictions": 0,
+    "inferences": 0,
+    "inference_seconds": 0.0,
+}
+# Model memory of the readers in the pool workers, by worker pid
+_worker_memory = {}
+
+
+def reader_key(languages):
+    if isinstance(languages, str):
+        languages = [languages]
+    return tuple(sorted(set(languages)))
+
+
+def model_memory(reader):
+    """Bytes held by the detection and recognition weights of a reader."""
+    total = 0
+    for model in (
+        getattr(reader, "detector", None),
+        getattr(reader, "recognizer", None),
+    ):
+        if model is None:
+            continue
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def memory_limit():
+    """Bytes of reader weights this process may keep.
+
+    Pool workers each load their own readers, they split the budget so the
+    process tree stays within ``OCR_MAX_MEMORY_MB``.
+    """
+    limit = OCR_MAX_MEMORY_MB * 1024 * 1024
+    if multiprocessing.parent_process() is not None:
+        limit //= max(CPU_WORKERS, 1)
+    return limit
+
+
+def _evict(keep):
+    limit = memory_limit()
+    while len(_readers) > 1 and (
+        len(_readers) > OCR_MAX_READERS
+        or sum(entry.memory for entry in _readers.values()) > limit
+    ):
+        key = next(iter(_readers))
+        if key == keep:
+            _readers.move_to_end(key)
+            continue
+        _readers.pop(key)
+        _metrics["evictions"] += 1
+        logging.info(f"Evicted EasyOCR reader {key}")
+
+
+def get_reader(languages):
+    """Return the shared reader entry for ``languages``, loading it once."""
+    key = reader_key(languages)
+    with _registry_lock:
+        entry = _readers.get(key)
+        if entry is not None:
+            _readers.move_to_end(key)
+            return entry
+        load_lock = _loading.setdefault(key, threading.Lock())
+
+    # Only one thread loads a language set, the others wait for it
+    with load_lock:
+        with _registry_lock:
+            entry = _readers.get(key)
+            if entry is not None:
+                _readers.move_to_end(key)
+                return entry
+
+        start_time = time.perf_counter()
+        reader = easyocr.Reader(list(key))
+        elapsed = time.perf_counter() - start_time
+        entry = ReaderEntry(reader, model_memory(reader))
+        logging.info(
+            f"Loaded EasyOCR reader {key} in {elapsed:.3f} seconds "
+            f"({entry.memory / 1024 / 1024:.1f} MB)"
+        )
+
+        with _registry_lock:
+            _metrics["loads"] += 1
+            _metrics["load_seconds"] += elapsed
+            _readers[key] = entry
+            _evict(keep=key)
+            _loading.pop(key, None)
+        return entry
+
+
+def readtext(image, languages, **kwargs):
+    entry = get_reader(languages)
+    with entry.lock:
+        start_time = time.perf_counter()
+        results = entry.reader.readtext(image, **kwargs)
+        elapsed = time.perf_counter() - start_time
+    with _registry_lock:
+        _metrics["inferences"] += 1
+        _metrics["inference_seconds"] += elapsed
+    return results
+
+
+def preload_readers(spec=OCR_PRELOAD_LANGUAGES):
+    for languages in filter(None, spec.split(";")):
+        get_reader([language.strip() for language in languages.split(",")])
+
+
+def ocr_stats():
+    with _registry_lock:
+        stats = dict(_metrics)
+        stats["readers"] = [",".join(key) for key in _readers]
+        stats["memory_mb"] = round(
+            sum(entry.memory for entry in _readers.values()) / 1024 / 1024, 1
+        )
+        stats["worker_memory_mb"] = round(sum(_worker_memory.values()) / 1024 / 1024, 1)
+    return stats
+
+
+def merge_worker_metrics(report):
+    """Add the counters a pool worker sent back with a page to ``_metrics``."""
+    with _registry_lock:
+        for name, value in report["metrics"].items():
+            _metrics[name] += value
+        _worker_memory[report["pid"]] = report["memory"]
+
+
+def rasterize_pages(pdf_file_path, page_numbers, dpi=OCR_DPI, grayscale=OCR_GRAYSCALE):
+    """Yield ``(page_number, pixels)`` for one rendered page at a time.
+
+    Only the current page is kept in memory. ``np.asarray`` copies the
+    pixels out of the PIL image, which is closed right away, so a page costs
+    one extra buffer only while it is converted; the array is dropped before
+    the next page is rendered.
+    """
+    for page_number in page_numbers:
+        images = convert_from_path(
+            pdf_file_path,
+            dpi=dpi,
+            grayscale=grayscale,
+            first_page=page_number,
+            last_page=page_number,
+        )
+        if not images:
+            continue
+        image = images.pop()
+        # A copy, the image can be closed before the pixels are used
+        pixels = np.asarray(image)
+        image.close()
+        del image, images
+        yield page_number, pixels
+        del pixels
+
+
+def recognize(pixels, language):
+    lines = []
+    for bbox, text, confidence in readtext(pixels, [language], detail=1):
+        if confidence > OCR_MIN_CONFIDENCE:
+            lines.append(text)
+    return "\n".join(lines)
+
+
+def ocr_page(pdf_file_path, page_number, language):
+    """Render and OCR a single page, returns its text and timing."""
+    empty = {"page": page_number, "text": "", "seconds": 0.0}
+    return next(_ocr_pages_sequential(pdf_file_path, [page_number], language), empty)
+
+
+def ocr_page_in_worker(pdf_file_path, page_number, language):
+    """``ocr_page`` for the process pool, reports the worker's metrics back.
+
+    The counters are deltas since the call started, the memory is the total
+    of the worker's readers.
+    """
+    with _registry_lock:
+        before = dict(_metrics)
+    page = ocr_page(pdf_file_path, page_number, language)
+    with _registry_lock:
+        page["worker"] = {
+            "pid": os.getpid(),
+            "metrics": {name: _metrics[name] - before[name] for name in _metrics},
+            "memory": sum(entry.memory for entry in _readers.values()),
+        }
+    return page
+
+
+def _ocr_pages_sequential(pdf_file_path, page_numbers, language):
+    start_time = time.perf_counter()
+    for page_number, pixels in rasterize_pages(pdf_file_path, page_numbers):
+        text = recognize(pixels, language)
+        # Release the page before the generator renders the next one
+        del pixels
+        yield {
+            "page": page_number,
+            "text": text,
+            "seconds": time.perf_counter() - start_time,
+        }
+        start_time = time.perf_counter()
+
+
+def _ocr_pages_parallel(pdf_file_path, page_numbers, language):
+    pool = get_process_pool()
+    results = {}
+    pending = {}
+    queue = list(page_numbers)
+    while queue or pending:
+        while queue and len(pending) < OCR_MAX_PAGES_IN_FLIGHT:
+            page_number = queue.pop(0)
+            future = pool.submit(
+                ocr_page_in_worker, pdf_file_path, page_number, language
+            )
+            pending[future] = page_number
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.pop(future)
+            page = future.result()
+            merge_worker_metrics(page.pop("worker"))
+            results[page["page"]] = page
+    return [results[page_number] for page_number in page_numbers]
+
+
+def ocr_pages(pdf_file_path, page_numbers=None, language="de", parallel=None):
+    """OCR the given 1-based pages of a PDF, in page order.
+
+    With ``parallel`` (default ``OCR_PARALLEL``) the pages are spread over the
+    shared process pool, at most ``OCR_MAX_PAGES_IN_FLIGHT`` of them at a time.
+    """
+    if page_numbers is None:
+        page_count = pdfinfo_from_path(pdf_file_path)["Pages"]
+        page_numbers = list(range(1, page_count + 1))
+    if parallel is None:
+        parallel = OCR_PARALLEL
+
+    start_time = time.perf_counter()
+    pages = None
+    if parallel and len(page_numbers) > 1 and CPU_WORKERS > 1:
+        try:
+            pages = _ocr_pages_parallel(pdf_file_path, page_numbers, language)
+        except BrokenProcessPool:
+            logging.warning("OCR worker died, retrying document sequentially")
+            shutdown_process_pool()
+    if pages is None:
+        pages = list(_ocr_pages_sequential(pdf_file_path, page_numbers, language))
+
+    timings = ", ".join(f"{page['page']}: {page['seconds']:.2f}s" for page in pages)
+    logging.info(
+        f"OCR of {len(pages)} pages took {time.perf_counter() - start_time:.3f} "
+        f"seconds (per page {timings})"
+    )
+    return pages
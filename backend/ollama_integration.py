@@ -1,49 +1,155 @@
-import re
-import subprocess
-import requests
 import os
 import json
+import time
+import asyncio
 import logging
-from schemas import Invoice
-from utils import PROMPT
+import httpx
+from executors import BackgroundLoop
+from schemas import Invoice, ItemPage
+from stream_parser import MalformedOutput, SchemaStreamParser
+from utils import ITEMS_PROMPT, PROMPT, normalize_invoice
 
 # mistral, deepseek-r1:14b, deepseek-r1:8b, deepseek-r1:1.5b, llama3.2:3b, llama3.1
-OLLAMA_MODEL = "llama3.1"  # Replace with your model of choice (ollama list)
-OLLAMA_CMD = "ollama run"  # Command to invoke the local Ollama model
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.1")  # see `ollama list`
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_API_URL = f"{OLLAMA_HOST}/api/generate"
+# Requests in flight, should match OLLAMA_NUM_PARALLEL of the Ollama server
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+# Longest pause between two streamed chunks (model loading included)
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "120"))
+# Keeps the model and its KV cache loaded between invoices, the server then
+# only evaluates what follows the PROMPT prefix it has already seen
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     level=logging.INFO,
 )
 
+_stats = {
+    "calls": 0,
+    "aborted": 0,
+    "prompt_tokens": 0,
+    "output_tokens": 0,
+    "prompt_eval_seconds": 0.0,
+    "total_seconds": 0.0,
+    "first_token_seconds": 0.0,
+}
 
-def query_ollama(model: str, prompt: str):
-    payload = {
+
+class OllamaClient(BackgroundLoop):
+    """Pooled async HTTP client for the Ollama API.
+
+    Connections are kept alive between calls and at most
+    ``OLLAMA_NUM_PARALLEL`` requests are sent at a time, more would only
+    queue up inside the Ollama server.
+    """
+
+    def __init__(self):
+        super().__init__("ollama")
+
+    async def setup(self):
+        self.slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=OLLAMA_NUM_PARALLEL,
+                max_keepalive_connections=OLLAMA_NUM_PARALLEL,
+            ),
+        )
+
+
+client = OllamaClient()
+
+
+def payload(model, prompt, schema=Invoice, **extra):
+    return {
         "model": model,
         "prompt": prompt,
         "seed": 42,
         "temperature": 0,  # Make the output deterministic
-        "stream": False,  # Set to True for streamed responses
-        "format": Invoice.model_json_schema(),
-        "keep_alive": "5m",
+        "format": schema.model_json_schema(),
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        **extra,
     }
-    response = requests.post(OLLAMA_API_URL, json=payload)
-    return response.json()
+
+
+def record_usage(result):
+    # Ollama reports durations in nanoseconds
+    _stats["prompt_tokens"] += result.get("prompt_eval_count", 0)
+    _stats["output_tokens"] += result.get("eval_count", 0)
+    _stats["prompt_eval_seconds"] += result.get("prompt_eval_duration", 0) / 1e9
+    _stats["total_seconds"] += result.get("total_duration", 0) / 1e9
+
+
+async def query_ollama(model: str, prompt: str, schema=Invoice):
+    """Stream a generation and parse it while it arrives.
+
+    The stream is closed as soon as the invoice object is complete (models
+    tend to pad schema-constrained output with whitespace) or as soon as the
+    output stops matching ``schema`` (``schemas.Invoice`` by default).
+    """
+    parser = SchemaStreamParser(schema.model_json_schema())
+
+    async with client.slots:
+        start_time = time.perf_counter()
+        first_token = None
+        _stats["calls"] += 1
+        async with client.http.stream(
+            "POST", OLLAMA_API_URL, json=payload(model, prompt, schema, stream=True)
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                message = json.loads(line)
+                if "error" in message:
+                    raise RuntimeError(f"Ollama error: {message['error']}")
+                if first_token is None and message.get("response"):
+                    first_token = time.perf_counter() - start_time
+                    _stats["first_token_seconds"] += first_token
+                try:
+                    done = parser.feed(message.get("response", ""))
+                except MalformedOutput:
+                    _stats["aborted"] += 1
+                    raise
+                if message.get("done"):
+                    record_usage(message)
+                    break
+                if done:
+                    break
+
+    logging.info(
+        f"Ollama answered in {time.perf_counter() - start_time:.3f} seconds "
+        f"(first token after {first_token or 0:.3f} seconds)"
+    )
+    return parser.result()
+
+
+async def extract_with_ollama(pdf_text: str, model: str = OLLAMA_MODEL) -> dict:
+    # The whole prompt every time: a context primed with PROMPT alone carries
+    # a finished chat turn and changes the answers. The server reuses the
+    # KV cache of the common PROMPT prefix by itself.
+    result = await query_ollama(model, f"{PROMPT} {pdf_text}")
+    return normalize_invoice(result)
+
+
+async def extract_items_with_ollama(pdf_text: str, model: str = OLLAMA_MODEL) -> list:
+    """Line items of some pages of a long invoice."""
+    result = await query_ollama(model, f"{ITEMS_PROMPT} {pdf_text}", schema=ItemPage)
+    return normalize_invoice(result)["items"]
+
+
+def ollama_stats():
+    stats = dict(_stats)
+    if stats["calls"]:
+        stats["prompt_tokens_per_call"] = round(stats["prompt_tokens"] / stats["calls"])
+    return stats
 
 
 def process_with_ollama(pdf_text: str) -> dict:
     logging.info(f"Starting ollama extraction process ...")
-    # Prepare the command to send to Ollama
-    try:
-        # Assuming the output is in a JSON-like format, you would parse it
-        # Ollama output example: {'invoice_number': '12345', 'invoice_date': '2025-02-23', ...}
-        logging.info(f"Prompt:\n{PROMPT} {pdf_text}")
-        response = query_ollama(OLLAMA_MODEL, f"{PROMPT} {pdf_text}")
-        json_match = re.search(r"({.*})", response.get("response"), re.DOTALL)
-        json_str = json_match.group(1)
-        logging.info(f"JSON String:\n{json_str}")
-        return json.loads(json_str)
-
-    except subprocess.CalledProcessError as e:
-        raise Exception(f"Error running Ollama model: {e.stderr}")
+    invoice_data = client.run(extract_with_ollama(pdf_text))
+    logging.info(f"Invoice data:\n{invoice_data}")
+    return invoice_data
@@ -1,17 +1,26 @@
+import io
 import os
+import hashlib
 import re
 import logging
 import time
-import numpy as np
+import threading
 from chatgpt_integration import process_with_chatgpt
 from deepseek_integration import process_with_deepseek
 from ollama_integration import process_with_ollama
 
-from gemini_integration import process_with_gemini
-from pdfplumber import open as open_pdf
+from gemini_integration import process_with_gemini, GEMINI_MODEL
+from hedging import extraction_policy, hedged_extract
+from chunked import extract_chunked
 from datetime import datetime, timezone
-import easyocr
-from pdf2image import convert_from_path
+from ocr import ocr_pages
+from text_layer import is_usable_text_layer, read_text_layers, read_words
+from layouts import LAYOUTS, extract_with_layout, layout_store
+from executors import run_cpu_bound
+from cii_reader import parse_cii, is_complete
+from pypdf import PdfReader
+from cache import DiskCache, content_hash, file_hash
+from utils import PROMPT_VERSION
 from drafthorse.models.accounting import ApplicableTradeTax
 from drafthorse.models.document import Document
 from drafthorse.models.note import IncludedNote
@@ -24,8 +33,39 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+EXTRACTION_MODEL = "gemini"
 
-def process(pdf_text, model="chatgpt", test=False, pdf_file=None):
+# Extraction results keyed on the PDF bytes, the model and the prompt version
+EXTRACTION_CACHE = os.getenv("EXTRACTION_CACHE", "1") == "1"
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR", "./uploads/.cache/extraction")
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "5000"))
+EXTRACTION_CACHE_TTL = int(os.getenv("EXTRACTION_CACHE_TTL", str(24 * 3600)))
+
+extraction_cache = DiskCache(
+    EXTRACTION_CACHE_DIR,
+    max_entries=EXTRACTION_CACHE_MAX_ENTRIES,
+    ttl=EXTRACTION_CACHE_TTL,
+)
+_cache_metrics_lock = threading.Lock()
+_cache_metrics = {"hits": 0, "misses": 0, "bypassed": 0, "uncached": 0}
+
+
+def count_cache(name):
+    with _cache_metrics_lock:
+        _cache_metrics[name] += 1
+
+
+def process(
+    pdf_text,
+    model="chatgpt",
+    test=False,
+    pdf_file=None,
+    pdf_bytes=None,
+    policy=None,
+    answered_by=None,
+):
+    if policy is not None and policy["secondary"]:
+        return hedged_extract(pdf_text, policy, pdf_file, pdf_bytes, test, answered_by)
 
     if model == "ollama":
         return process_with_ollama(pdf_text)
@@ -34,7 +74,7 @@ def process(pdf_text, model="chatgpt", test=False, pdf_file=None):
     elif model == "chatgpt":
         return process_with_chatgpt(pdf_text, test)
     elif model == "gemini":
-        return process_with_gemini(pdf_file, pdf_text)
+        return process_with_gemini(pdf_file, pdf_text, pdf_bytes)
     return process_with_chatgpt(pdf_text, test)
 
 
@@ -145,44 +185,187 @@ def preprocess_invoice_text(text):
     return text
 
 
+def extract_pages_from_pdf(pdf_file_path: str, language: str = "de") -> list:
+    """Extract every page from its text layer, or with OCR where it has none.
+
+    Returns one dict per page with its ``text``, the ``source`` it came from
+    ("text" or "ocr") and the ``seconds`` spent on it. Parsing the text layer
+    runs in the CPU process pool, OCR in its own pool.
+    """
+    pages = run_cpu_bound(read_text_layers, pdf_file_path)
+
+    ocr_page_numbers = [page["page"] for page in pages if page["source"] == "ocr"]
+    if ocr_page_numbers:
+        ocr_results = ocr_pages(pdf_file_path, ocr_page_numbers, language=language)
+        for result in ocr_results:
+            page = pages[result["page"] - 1]
+            page["text"] = result["text"]
+            page["seconds"] += result["seconds"]
+
+    logging.info(
+        f"Extracted {len(pages)} pages of {pdf_file_path}: "
+        f"{len(pages) - len(ocr_page_numbers)} from the text layer, "
+        f"{len(ocr_page_numbers)} with OCR"
+    )
+    return pages
+
+
+def extract_page_texts(pdf_file_path: str, language: str = "de") -> list:
+    pages = extract_pages_from_pdf(pdf_file_path, language)
+    return [preprocess_invoice_text(page["text"]) for page in pages if page["text"]]
+
+
 def extract_text_from_pdf(pdf_file_path: str, language: str = "de") -> str:
-    # Extract text from the PDF using pdfplumber
-    with open_pdf(pdf_file_path) as pdf:
-        pdf_text = ""
-        for page in pdf.pages:
-            pdf_text += page.extract_text()
+    return "\n".join(extract_page_texts(pdf_file_path, language))
+
+
+# Attachment names of the hybrid formats (ZUGFeRD 1.0/2.x, Factur-X, XRechnung)
+EMBEDDED_XML_NAMES = {"factur-x.xml", "zugferd-invoice.xml", "xrechnung.xml"}
 
-    if not pdf_text:
-        # Convert PDF to images
-        images = convert_from_path(pdf_file_path)
 
-        # Initialize EasyOCR reader (English and numbers)
-        reader = easyocr.Reader([language])
+def find_embedded_invoice_xml(pdf_file_path: str):
+    """Return the bytes of an embedded ZUGFeRD/Factur-X XML, or ``None``."""
+    try:
+        attachments = PdfReader(pdf_file_path).attachments
+        for name in attachments:
+            if name.lower() in EMBEDDED_XML_NAMES:
+                return attachments[name][0]
+    except Exception as e:
+        logging.warning(f"Could not read attachments of {pdf_file_path}: {e}")
+    return None
 
-        # Extract text from each image
-        extracted_text = []
-        for img in images:
-            results = reader.readtext(
-                np.array(img), detail=1
-            )  # Extract text (detail=0 returns only text)
-            for bbox, text, confidence in results:
-                if confidence > 0.5:
-                    extracted_text.append(text)
 
-        # Join extracted text into a single string
-        pdf_text = "\n".join(extracted_text)
+def extract_embedded_invoice_data(pdf_file_path: str):
+    """Map an embedded invoice XML to the invoice dict, ``None`` if unusable."""
+    xml = find_embedded_invoice_xml(pdf_file_path)
+    if xml is None:
+        return None
+
+    start_time = time.perf_counter()
+    try:
+        invoice_data = parse_cii(io.BytesIO(xml))
+    except Exception as e:
+        logging.warning(f"Could not parse embedded XML of {pdf_file_path}: {e}")
+        return None
+    if not is_complete(invoice_data):
+        logging.info(f"Embedded XML of {pdf_file_path} is incomplete, using the LLM")
+        return None
+    logging.info(
+        f"Read embedded XML of {pdf_file_path} in "
+        f"{time.perf_counter() - start_time:.6f} seconds"
+    )
+    return invoice_data
+
+
+def extract_layout_invoice_data(pdf_file_path: str):
+    """Read a PDF of a known seller layout without the LLM, ``None`` if unsure."""
+    if not LAYOUTS or not layout_store.load():
+        return None
+    try:
+        pages = run_cpu_bound(read_words, pdf_file_path)
+    except Exception as e:
+        logging.warning(f"Could not read the words of {pdf_file_path}: {e}")
+        return None
+    return extract_with_layout(pages)
+
+
+def model_name(model):
+    return f"gemini:{GEMINI_MODEL}" if model == "gemini" else model
 
-    return preprocess_invoice_text(pdf_text)
 
+def extraction_cache_key(
+    pdf_file_path, model=EXTRACTION_MODEL, pdf_bytes=None, pdf_hash=None
+):
+    if pdf_hash is None and pdf_bytes is not None:
+        pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    elif pdf_hash is None:
+        pdf_hash = file_hash(pdf_file_path)
+    return content_hash(pdf_hash, model_name(model), PROMPT_VERSION)
 
-def extract_invoice_data(pdf_file_path: str) -> str:
+
+def extraction_cache_stats():
+    with _cache_metrics_lock:
+        stats = dict(_cache_metrics)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+    return stats
+
+
+def extract_invoice_data(
+    pdf_file_path: str,
+    bypass_cache: bool = False,
+    pdf_bytes: bytes = None,
+    endpoint: str = "default",
+    pdf_hash: str = None,
+) -> str:
+    """Extract the invoice dict from a PDF.
+
+    Hybrid PDFs are read from their embedded XML, PDFs of a seller layout
+    learned from confirmed extractions with its template, long invoices in
+    chunks of pages (see ``chunked.extract_chunked``). Results of the LLM
+    path are cached on the PDF content, so retries of the same upload do not
+    pay for OCR and the model again. ``bypass_cache`` skips the lookup but still
+    refreshes the entry. ``pdf_bytes`` spares providers reading the upload
+    from disk again, ``pdf_hash`` (its SHA-256, as computed while the upload
+    was saved) hashing it again. ``endpoint`` selects the hedging policy,
+    see ``hedging.extraction_policy``.
+    """
     logging.info(f"Starting processing {pdf_file_path} ...")
 
+    # Hybrid PDFs already carry the structured invoice
+    invoice_data = extract_embedded_invoice_data(pdf_file_path)
+    if invoice_data is not None:
+        return invoice_data
+
+    key = None
+    if EXTRACTION_CACHE:
+        key = extraction_cache_key(
+            pdf_file_path, pdf_bytes=pdf_bytes, pdf_hash=pdf_hash
+        )
+        if bypass_cache:
+            count_cache("bypassed")
+        else:
+            cached = extraction_cache.get(key)
+            if cached is not None:
+                count_cache("hits")
+                logging.info(f"Extraction cache hit for {pdf_file_path}")
+                return cached[0]
+            count_cache("misses")
+
+    invoice_data = extract_layout_invoice_data(pdf_file_path)
+    if invoice_data is not None:
+        return invoice_data
+
     # Send extracted text to Ollama model for field recognition
-    processed_text = extract_text_from_pdf(pdf_file_path)
+    page_texts = extract_page_texts(pdf_file_path)
     start_time = time.perf_counter()
-    invoice_data = process(processed_text, model="gemini", pdf_file=pdf_file_path)
+    policy = extraction_policy(endpoint, EXTRACTION_MODEL)
+    answered_by = set()
+    invoice_data = extract_chunked(
+        page_texts,
+        EXTRACTION_MODEL,
+        pdf_file=pdf_file_path,
+        pdf_bytes=pdf_bytes,
+        policy=policy,
+        answered_by=answered_by,
+    )
+    if invoice_data is None:
+        invoice_data = process(
+            "\n".join(page_texts),
+            model=EXTRACTION_MODEL,
+            pdf_file=pdf_file_path,
+            pdf_bytes=pdf_bytes,
+            policy=policy,
+            answered_by=answered_by,
+        )
     logging.info(
         f"Execution time of data extraction: {time.perf_counter() - start_time:.6f} seconds"
     )
+    if key is not None and answered_by - {EXTRACTION_MODEL}:
+        # The key names the primary model, a hedged answer of another
+        # provider must not be replayed as its result
+        count_cache("uncached")
+        logging.info(f"Not caching the answer of {', '.join(sorted(answered_by))}")
+    elif key is not None:
+        extraction_cache.put(key, invoice_data)
     return invoice_data
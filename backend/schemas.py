@@ -169,4 +169,8 @@ class Header(BaseModel):
 class Invoice(BaseModel):
     header: Header = Field(description="Header information (Kopfzeileninformationen)")
     trade: Trade = Field(description="Trade information (Handelsinformationen)")
+
+
+class ItemPage(BaseModel):
+    items: List[Item] = Field(description="Invoice items on these pages (Rechnungspositionen auf diesen Seiten)")
 # fmt: on
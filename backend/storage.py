@@ -0,0 +1,552 @@
+import os
+import time
+import hmac
+import uuid
+import fcntl
+import shutil
+import asyncio
+import hashlib
+import logging
+import threading
+import requests
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from pathlib import Path, PurePosixPath
+from urllib.parse import quote, urlparse
+from executors import run_in_thread
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# "local" keeps artifacts under STORAGE_DIR, "s3" in an S3-compatible bucket
+# (AWS, MinIO, ...) shared by every node
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_DIR = os.getenv("STORAGE_DIR", "./uploads/store")
+# Node-local working copies: incoming uploads, generated files, S3 downloads
+STORAGE_SCRATCH_DIR = os.getenv("STORAGE_SCRATCH_DIR", "./uploads/.scratch")
+STORAGE_SCRATCH_TTL = int(os.getenv("STORAGE_SCRATCH_TTL", "3600"))
+S3_ENDPOINT = os.getenv("S3_ENDPOINT", "http://localhost:9000")
+S3_BUCKET = os.getenv("S3_BUCKET", "pdftoxrechnung")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY", "")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY", "")
+S3_TIMEOUT = float(os.getenv("S3_TIMEOUT", "30"))
+
+# Retention per artifact kind, in seconds since the artifact was last stored
+STORAGE_TTLS = {
+    "pdf": int(os.getenv("STORAGE_TTL_PDF", str(7 * 24 * 3600))),
+    "xml": int(os.getenv("STORAGE_TTL_XML", str(30 * 24 * 3600))),
+    "report": int(os.getenv("STORAGE_TTL_REPORT", str(30 * 24 * 3600))),
+}
+# Session folders (uploads/<session_id>) from before the store and batch
+# folders left by a crash, collected once nothing in them changed for this long
+STORAGE_TTL_LEGACY = int(os.getenv("STORAGE_TTL_LEGACY", str(7 * 24 * 3600)))
+STORAGE_GC_INTERVAL = float(os.getenv("STORAGE_GC_INTERVAL", "3600"))
+# Only the uvicorn worker holding this lock runs the collection on this host
+STORAGE_GC_LOCK_FILE = os.getenv("STORAGE_GC_LOCK_FILE", "./uploads/.gc.lock")
+
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+_gc_metrics = {
+    "runs": 0,
+    "deleted": 0,
+    "bytes_reclaimed": 0,
+    "bytes_reclaimed_by_kind": {kind: 0 for kind in [*STORAGE_TTLS, "legacy"]},
+    "scratch_deleted": 0,
+    "legacy_deleted": 0,
+    "last_run_seconds": 0.0,
+}
+_gc_lock = threading.Lock()
+
+
+def artifact_key(kind, digest, suffix):
+    """``<kind>/<ab>/<cd>/<digest><suffix>``, sharded on the content hash.
+
+    Equal content gets the same key, so duplicates are stored once.
+    """
+    return f"{kind}/{digest[:2]}/{digest[2:4]}/{digest}{suffix}"
+
+
+def derived_key(key, kind, suffix):
+    """Key of another artifact of the same content, e.g. the report of an XML."""
+    digest = PurePosixPath(key).name.split(".")[0]
+    return artifact_key(kind, digest, suffix)
+
+
+def scratch_path(suffix, directory=STORAGE_SCRATCH_DIR):
+    """A fresh path in the scratch folder, for a file on its way to the store."""
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    return Path(directory) / f"{uuid.uuid4().hex}{suffix}"
+
+
+def link_or_copy(source, target):
+    """Put ``source`` at ``target`` atomically, as a hard link when possible."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.parent / f".tmp-{uuid.uuid4().hex}"
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+
+
+class LocalStorage:
+    """Artifacts as files under ``directory``, the key is the relative path."""
+
+    def __init__(self, directory=STORAGE_DIR):
+        self.directory = Path(directory)
+
+    def path(self, key):
+        return self.directory / key
+
+    def exists(self, key):
+        return self.path(key).is_file()
+
+    def put_file(self, key, source):
+        """Store the file at ``source``, ``False`` if the key was already there.
+
+        A duplicate only refreshes the retention of the stored copy.
+        """
+        target = self.path(key)
+        if target.is_file():
+            os.utime(target)
+            return False
+        link_or_copy(source, target)
+        return True
+
+    def local_path(self, key):
+        path = self.path(key)
+        if not path.is_file():
+            raise FileNotFoundError(key)
+        return path
+
+    def delete(self, key):
+        self.path(key).unlink(missing_ok=True)
+
+    def list(self, prefix):
+        """``(key, size, mtime)`` of every artifact under ``prefix``."""
+        root = self.path(prefix)
+        if not root.is_dir():
+            return
+        for path in root.rglob("*"):
+            if path.name.startswith(".tmp-"):
+                continue
+            try:
+                if not path.is_file():
+                    continue
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            key = path.relative_to(self.directory).as_posix()
+            yield key, stat.st_size, stat.st_mtime
+
+
+def hmac_sha256(key, message):
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+
+def canonical_query(params):
+    return "&".join(
+        f"{quote(key, safe='-_.~')}={quote(str(value), safe='-_.~')}"
+        for key, value in sorted((params or {}).items())
+    )
+
+
+def sign_v4(
+    method,
+    url,
+    headers,
+    access_key,
+    secret_key,
+    region,
+    payload_hash=UNSIGNED_PAYLOAD,
+    params=None,
+    now=None,
+):
+    """The headers of an AWS Signature Version 4 signed S3 request.
+
+    Every header in ``headers`` is signed along with the host, the date and
+    the payload hash.
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = now.strftime("%Y%m%d")
+    parsed = urlparse(url)
+    signed = {key.lower(): str(value).strip() for key, value in headers.items()}
+    signed.update(
+        {
+            "host": parsed.netloc,
+            "x-amz-date": amz_date,
+            "x-amz-content-sha256": payload_hash,
+        }
+    )
+    names = sorted(signed)
+    canonical_request = "\n".join(
+        [
+            method,
+            quote(parsed.path or "/", safe="/-_.~"),
+            canonical_query(params),
+            "".join(f"{name}:{signed[name]}\n" for name in names),
+            ";".join(names),
+            payload_hash,
+        ]
+    )
+    scope = f"{date}/{region}/s3/aws4_request"
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+        ]
+    )
+    key = f"AWS4{secret_key}".encode("utf-8")
+    for part in (date, region, "s3", "aws4_request"):
+        key = hmac_sha256(key, part)
+    signature = hmac.new(
+        key, string_to_sign.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+    return {
+        **headers,
+        "x-amz-date": amz_date,
+        "x-amz-content-sha256": payload_hash,
+        "Authorization": (
+            f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+            f"SignedHeaders={';'.join(names)}, Signature={signature}"
+        ),
+    }
+
+
+class S3Storage:
+    """Artifacts in an S3-compatible bucket, addressed path-style.
+
+    Speaks the few S3 calls it needs over ``requests`` with Signature V4,
+    which AWS and MinIO both accept. Files needed on this node (for
+    pdfplumber, the validator or a FileResponse) are downloaded once into
+    the scratch folder.
+    """
+
+    def __init__(
+        self,
+        endpoint=S3_ENDPOINT,
+        bucket=S3_BUCKET,
+        region=S3_REGION,
+        access_key=S3_ACCESS_KEY,
+        secret_key=S3_SECRET_KEY,
+        scratch_dir=STORAGE_SCRATCH_DIR,
+    ):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.scratch_dir = Path(scratch_dir) / "s3"
+        self.session = requests.Session()
+
+    def request(self, method, key="", headers=None, params=None, **kwargs):
+        url = f"{self.endpoint}/{self.bucket}"
+        if key:
+            url = f"{url}/{quote(key, safe='/-_.~')}"
+        signed = sign_v4(
+            method,
+            url,
+            headers or {},
+            self.access_key,
+            self.secret_key,
+            self.region,
+            params=params,
+        )
+        if params:
+            # Sent exactly as signed, requests would encode it its own way
+            url = f"{url}?{canonical_query(params)}"
+        return self.session.request(
+            method, url, headers=signed, timeout=S3_TIMEOUT, **kwargs
+        )
+
+    def exists(self, key):
+        response = self.request("HEAD", key)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    def touch(self, key):
+        # Copying an object onto itself is the only way to renew LastModified
+        response = self.request(
+            "PUT",
+            key,
+            headers={
+                "x-amz-copy-source": f"/{self.bucket}/{quote(key, safe='/-_.~')}",
+                "x-amz-metadata-directive": "REPLACE",
+            },
+        )
+        response.raise_for_status()
+
+    def put_file(self, key, source):
+        if self.exists(key):
+            self.touch(key)
+            return False
+        with open(source, "rb") as body:
+            response = self.request(
+                "PUT",
+                key,
+                headers={"Content-Length": str(os.path.getsize(source))},
+                data=body,
+            )
+        response.raise_for_status()
+        # Whoever stored it is likely to serve it next, keep the local copy
+        link_or_copy(source, self.scratch_dir / key)
+        return True
+
+    def local_path(self, key):
+        """The local copy of ``key``, its mtime bumped so the scratch pruning
+        leaves it alone while it is served."""
+        path = self.scratch_dir / key
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        response = self.request("GET", key, stream=True)
+        if response.status_code == 404:
+            raise FileNotFoundError(key)
+        response.raise_for_status()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.parent / f".tmp-{uuid.uuid4().hex}"
+        with open(tmp, "wb") as f:
+            for chunk in response.iter_content(1024 * 1024):
+                f.write(chunk)
+        os.replace(tmp, path)
+        return path
+
+    def delete(self, key):
+        self.request("DELETE", key).raise_for_status()
+        (self.scratch_dir / key).unlink(missing_ok=True)
+
+    def list(self, prefix):
+        params = {"list-type": "2", "prefix": prefix}
+        while True:
+            response = self.request("GET", params=params)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            for item in root.iter(f"{S3_NAMESPACE}Contents"):
+                modified = datetime.fromisoformat(
+                    item.findtext(f"{S3_NAMESPACE}LastModified").replace("Z", "+00:00")
+                )
+                yield (
+                    item.findtext(f"{S3_NAMESPACE}Key"),
+                    int(item.findtext(f"{S3_NAMESPACE}Size")),
+                    modified.timestamp(),
+                )
+            token = root.findtext(f"{S3_NAMESPACE}NextContinuationToken")
+            if root.findtext(f"{S3_NAMESPACE}IsTruncated") != "true" or not token:
+                return
+            params = {**params, "continuation-token": token}
+
+
+def open_storage(backend=STORAGE_BACKEND):
+    if backend == "s3":
+        return S3Storage()
+    return LocalStorage()
+
+
+def remove_if_unused(path, ttl, now):
+    """Unlink ``path`` if it was not used (its mtime bumped) within ``ttl``.
+
+    The file is moved aside before the final check, so a request that bumps
+    it in between (``S3Storage.local_path``) gets it put back.
+    """
+    if now - path.stat().st_mtime <= ttl:
+        return 0
+    aside = path.with_name(f".gc-{uuid.uuid4().hex}")
+    os.rename(path, aside)
+    if now - aside.stat().st_mtime <= ttl:
+        os.replace(aside, path)
+        return 0
+    size = aside.stat().st_size
+    aside.unlink()
+    return size
+
+
+def prune_scratch(directory=STORAGE_SCRATCH_DIR, ttl=STORAGE_SCRATCH_TTL, now=None):
+    """Remove working copies not used within ``ttl``, e.g. left by crashes."""
+    now = now or time.time()
+    deleted = 0
+    root = Path(directory)
+    if not root.is_dir():
+        return deleted
+    for path in root.rglob("*"):
+        try:
+            if path.is_file() and not path.is_symlink():
+                deleted += remove_if_unused(path, ttl, now) > 0
+        except FileNotFoundError:
+            continue
+    return deleted
+
+
+def collect_legacy(root, ttl=STORAGE_TTL_LEGACY, keep=(), now=None):
+    """Remove the folders under ``root`` nothing changed in for ``ttl``.
+
+    Hidden folders (caches, scratch) and those in or around a path of
+    ``keep`` are left alone. Returns the number of removed folders and
+    their bytes.
+    """
+    now = now or time.time()
+    keep = {Path(path).resolve() for path in keep}
+    deleted = reclaimed = 0
+    root = Path(root)
+    if not root.is_dir():
+        return deleted, reclaimed
+    for folder in root.iterdir():
+        if folder.name.startswith(".") or not folder.is_dir():
+            continue
+        if folder.is_symlink() or any(
+            path == folder.resolve() or folder.resolve() in path.parents
+            for path in keep
+        ):
+            continue
+        try:
+            files = [path.stat() for path in folder.rglob("*") if path.is_file()]
+            newest = max([folder.stat().st_mtime, *(stat.st_mtime for stat in files)])
+        except FileNotFoundError:
+            continue
+        if now - newest <= ttl:
+            continue
+        shutil.rmtree(folder, ignore_errors=True)
+        deleted += 1
+        reclaimed += sum(stat.st_size for stat in files)
+    return deleted, reclaimed
+
+
+def collect(storage, ttls=STORAGE_TTLS, now=None, legacy_roots=(), legacy_keep=()):
+    """Delete the artifacts older than the TTL of their kind.
+
+    The folders in each of ``legacy_roots`` are collected too, e.g. old
+    session folders or batch folders left by a crash (see
+    ``collect_legacy``). Returns the number of deleted artifacts and
+    the bytes reclaimed, which also add up in ``storage_stats``.
+    """
+    start_time = time.perf_counter()
+    now = now or time.time()
+    deleted = 0
+    reclaimed = {kind: 0 for kind in ttls}
+    for kind, ttl in ttls.items():
+        # Listed first, deleting while a listing is paged skips entries
+        expired = [
+            (key, size)
+            for key, size, modified in storage.list(f"{kind}/")
+            if now - modified > ttl
+        ]
+        for key, size in expired:
+            try:
+                storage.delete(key)
+            except Exception as e:
+                logging.warning(f"Could not delete {key}: {e}")
+                continue
+            deleted += 1
+            reclaimed[kind] += size
+    scratch_deleted = prune_scratch(now=now)
+    legacy_deleted = 0
+    if legacy_roots:
+        reclaimed["legacy"] = 0
+    for root in legacy_roots:
+        folders, size = collect_legacy(root, keep=legacy_keep, now=now)
+        legacy_deleted += folders
+        reclaimed["legacy"] += size
+
+    with _gc_lock:
+        _gc_metrics["runs"] += 1
+        _gc_metrics["deleted"] += deleted
+        _gc_metrics["bytes_reclaimed"] += sum(reclaimed.values())
+        for kind, size in reclaimed.items():
+            by_kind = _gc_metrics["bytes_reclaimed_by_kind"]
+            by_kind[kind] = by_kind.get(kind, 0) + size
+        _gc_metrics["scratch_deleted"] += scratch_deleted
+        _gc_metrics["legacy_deleted"] += legacy_deleted
+        _gc_metrics["last_run_seconds"] = time.perf_counter() - start_time
+    logging.info(
+        f"Retention removed {deleted} artifacts and {legacy_deleted} legacy "
+        f"folders, {sum(reclaimed.values())} bytes"
+    )
+    return deleted, sum(reclaimed.values())
+
+
+def storage_stats():
+    with _gc_lock:
+        stats = dict(_gc_metrics)
+        stats["bytes_reclaimed_by_kind"] = dict(_gc_metrics["bytes_reclaimed_by_kind"])
+    stats["backend"] = STORAGE_BACKEND
+    return stats
+
+
+class RetentionCollector:
+    """Runs ``collect`` every ``interval`` seconds in the background.
+
+    Every uvicorn worker starts one, but only the worker that holds the lock
+    file collects; the others keep trying, so another one takes over when it
+    exits. With S3 every host still collects the shared bucket, deletes of
+    the same key are harmless there.
+    """
+
+    def __init__(
+        self,
+        storage,
+        interval=STORAGE_GC_INTERVAL,
+        ttls=STORAGE_TTLS,
+        lock_file=STORAGE_GC_LOCK_FILE,
+        legacy_roots=(),
+        legacy_keep=(),
+    ):
+        self.storage = storage
+        self.interval = interval
+        self.ttls = ttls
+        self.lock_file = Path(lock_file)
+        self.legacy_roots = legacy_roots
+        self.legacy_keep = legacy_keep
+        self.lock = None
+        self.task = None
+
+    def owns_lock(self):
+        if self.lock is not None:
+            return True
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        lock = open(self.lock_file, "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        logging.info("This worker runs the storage retention")
+        self.lock = lock
+        return True
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.lock is not None:
+            # Closing the file releases the lock
+            self.lock.close()
+            self.lock = None
+
+    async def run(self):
+        while True:
+            try:
+                if self.owns_lock():
+                    await run_in_thread(
+                        collect,
+                        self.storage,
+                        self.ttls,
+                        legacy_roots=self.legacy_roots,
+                        legacy_keep=self.legacy_keep,
+                    )
+            except Exception as e:
+                logging.warning(f"Retention collection failed: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,232 @@
+import json
+from schemas import Invoice
+
+WHITESPACE = " \t\n\r"
+LITERALS = {"true": "boolean", "false": "boolean", "null": "null"}
+NUMBER_CHARS = set("+-0123456789.eE")
+
+
+class MalformedOutput(ValueError):
+    pass
+
+
+class Frame:
+    def __init__(self, kind, schema, path):
+        self.kind = kind  # "object" or "array"
+        self.schema = schema
+        self.path = path
+        self.state = "first"  # first, key, colon, value, comma
+        self.key = None
+        self.keys = set()
+
+
+class SchemaStreamParser:
+    """Incremental JSON parser that checks the output against a JSON schema.
+
+    ``feed`` takes the model output chunk by chunk as it is streamed. Syntax
+    errors, values of the wrong type and keys forbidden by the schema raise
+    ``MalformedOutput`` right away, so a generation that went off the rails
+    can be cancelled instead of being read to the end. ``done`` turns true
+    when the top-level object is closed; anything after it is ignored.
+    """
+
+    def __init__(self, schema=None, max_chars=200_000):
+        self.root = schema if schema is not None else Invoice.model_json_schema()
+        self.definitions = self.root.get("$defs", {})
+        self.max_chars = max_chars
+        self.chars = []
+        self.stack = []
+        self.token = None  # pending string, number or literal
+        self.token_kind = None
+        self.escape = False
+        self.started = False
+        self.done = False
+
+    # Schema helpers ---------------------------------------------------------
+
+    def resolve(self, schema):
+        while "$ref" in schema:
+            schema = self.definitions[schema["$ref"].rsplit("/", 1)[-1]]
+        return schema
+
+    def variants(self, schema):
+        schema = self.resolve(schema)
+        if "anyOf" in schema:
+            return [self.resolve(option) for option in schema["anyOf"]]
+        return [schema]
+
+    def allowed_types(self, schema):
+        types = set()
+        for option in self.variants(schema):
+            if "type" not in option:
+                return None  # anything goes
+            kind = option["type"]
+            types.update(kind if isinstance(kind, list) else [kind])
+        if "integer" in types:
+            types.add("number")
+        return types
+
+    def option_for(self, schema, kind):
+        for option in self.variants(schema):
+            if option.get("type") == kind:
+                return option
+        return {}
+
+    def child_schema(self, frame):
+        if frame.kind == "array":
+            return frame.schema.get("items", {})
+        return frame.schema.get("properties", {}).get(frame.key, {})
+
+    def child_path(self, frame):
+        if frame.kind == "array":
+            return f"{frame.path}[]"
+        return f"{frame.path}.{frame.key}" if frame.path else frame.key
+
+    # Parsing ----------------------------------------------------------------
+
+    def fail(self, message):
+        raise MalformedOutput(f"{message} after {len(self.text)} characters")
+
+    @property
+    def text(self):
+        return "".join(self.chars)
+
+    def feed(self, chunk):
+        """Consume the next chunk, returns ``done``."""
+        for char in chunk:
+            if self.done:
+                break
+            self.chars.append(char)
+            if len(self.chars) > self.max_chars:
+                self.fail("Output is too long")
+            self.consume(char)
+        return self.done
+
+    def result(self):
+        if not self.done:
+            self.fail("Output ended before the JSON was complete")
+        return json.loads(self.text.strip())
+
+    def consume(self, char):
+        if self.token_kind == "string":
+            self.string_char(char)
+            return
+        if self.token_kind is not None:
+            if char.isalnum() or char in NUMBER_CHARS:
+                self.token.append(char)
+                return
+            self.finish_scalar()
+
+        if char in WHITESPACE:
+            return
+        if not self.started:
+            if char != "{":
+                self.fail(f"Expected a JSON object, got {char!r}")
+            self.started = True
+            self.chars = ["{"]
+            self.open_container("object", self.root, "")
+            return
+
+        frame = self.stack[-1]
+        if frame.kind == "object" and frame.state in ("first", "key"):
+            if char == "}" and frame.state == "first":
+                self.close_container("object")
+            elif char == '"':
+                self.token_kind, self.token = "string", []
+            else:
+                self.fail(f"Expected a key at {frame.path or 'top level'}")
+        elif frame.state == "colon":
+            if char != ":":
+                self.fail(f"Expected ':' after {self.child_path(frame)}")
+            frame.state = "value"
+        elif frame.state == "comma":
+            if char == ",":
+                frame.state = "key" if frame.kind == "object" else "value"
+            elif char == ("}" if frame.kind == "object" else "]"):
+                self.close_container(frame.kind)
+            else:
+                self.fail(f"Expected ',' in {frame.path or 'top level'}")
+        elif frame.kind == "array" and frame.state == "first" and char == "]":
+            self.close_container("array")
+        else:
+            self.start_value(frame, char)
+
+    def start_value(self, frame, char):
+        if char == "{":
+            kind = "object"
+        elif char == "[":
+            kind = "array"
+        elif char == '"':
+            kind = "string"
+        elif char in NUMBER_CHARS:
+            kind = "number"
+        elif char.isalpha():
+            kind = "literal"
+        else:
+            self.fail(f"Unexpected {char!r} in {frame.path or 'top level'}")
+
+        schema = self.child_schema(frame)
+        path = self.child_path(frame)
+        if kind in ("object", "array"):
+            self.check_type(schema, kind, path)
+            frame.state = "comma"
+            self.open_container(kind, self.option_for(schema, kind), path)
+        else:
+            self.token_kind, self.token = kind, [] if kind == "string" else [char]
+
+    def string_char(self, char):
+        if self.escape:
+            self.escape = False
+        elif char == "\\":
+            self.escape = True
+        elif char == '"':
+            self.finish_scalar()
+            return
+        self.token.append(char)
+
+    def finish_scalar(self):
+        kind, token = self.token_kind, "".join(self.token)
+        self.token_kind, self.token = None, None
+        frame = self.stack[-1]
+
+        if kind == "string" and frame.kind == "object" and frame.state != "value":
+            properties = frame.schema.get("properties", {})
+            if (
+                token not in properties
+                and frame.schema.get("additionalProperties") is False
+            ):
+                self.fail(f"Unknown key {token!r} in {frame.path or 'top level'}")
+            frame.key = token
+            frame.keys.add(token)
+            frame.state = "colon"
+            return
+
+        if kind == "number":
+            try:
+                float(token)
+            except ValueError:
+                self.fail(f"Invalid number {token!r}")
+        elif kind == "literal":
+            if token not in LITERALS:
+                self.fail(f"Invalid literal {token!r}")
+            kind = LITERALS[token]
+        self.check_type(self.child_schema(frame), kind, self.child_path(frame))
+        frame.state = "comma"
+
+    def check_type(self, schema, kind, path):
+        allowed = self.allowed_types(schema)
+        if allowed is not None and kind not in allowed:
+            self.fail(f"{path} must be {' or '.join(sorted(allowed))}, got {kind}")
+
+    def open_container(self, kind, schema, path):
+        self.stack.append(Frame(kind, schema, path))
+
+    def close_container(self, kind):
+        frame = self.stack.pop()
+        # Only the top-level object is strict, nested ones may be partial
+        if kind == "object" and not frame.path:
+            missing = set(frame.schema.get("required", [])) - frame.keys
+            if missing:
+                self.fail(f"Missing {', '.join(sorted(missing))}")
+        if not self.stack:
+            self.done = True
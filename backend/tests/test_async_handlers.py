@@ -0,0 +1,53 @@
+import time
+import asyncio
+import httpx
+import main
+from storage import LocalStorage
+
+
+class FakeSessions:
+    async def update_one(self, query, update, upsert=False):
+        pass
+
+
+def test_ping_is_not_blocked_by_conversion(tmp_path, monkeypatch):
+    def slow_extract(pdf_file_path, **kwargs):
+        # Blocking like pdfplumber/OCR/Gemini would
+        time.sleep(1)
+        return {"header": {"id": "1"}}
+
+    monkeypatch.setattr(main, "UPLOAD_FOLDER", tmp_path)
+    monkeypatch.setattr(main, "extract_invoice_data", slow_extract)
+    monkeypatch.setattr(main, "sessions_collection", FakeSessions())
+    monkeypatch.setattr(main, "storage", LocalStorage(tmp_path / "store"))
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            conversions = [
+                asyncio.create_task(
+                    client.post(
+                        "/upload",
+                        files={"file": ("invoice.pdf", b"%PDF-1.4", "application/pdf")},
+                        headers={"X-Session-ID": f"s{i}", "Origin": main.ORIGIN},
+                    )
+                )
+                for i in range(4)
+            ]
+            await asyncio.sleep(0.1)
+
+            start_time = time.perf_counter()
+            ping = await client.get("/ping")
+            ping_seconds = time.perf_counter() - start_time
+
+            responses = await asyncio.gather(*conversions)
+            return ping, ping_seconds, responses, time.perf_counter() - start_time
+
+    ping, ping_seconds, responses, total_seconds = asyncio.run(scenario())
+    assert ping.json() == {"message": "alive"}
+    assert ping_seconds < 0.5
+    assert [response.json() for response in responses] == [{"header": {"id": "1"}}] * 4
+    # The four conversions ran side by side, not one after another
+    assert total_seconds < 3
@@ -0,0 +1,122 @@
+import io
+import asyncio
+import json
+import zipfile
+import pytest
+from fastapi.testclient import TestClient
+import batch
+import main
+from cii_reader import parse_cii
+
+PDF = open("tests/samples/output.pdf", "rb").read()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    def fake_extract(pdf_file_path, **kwargs):
+        if open(pdf_file_path, "rb").read() != PDF:
+            raise ValueError("not an invoice")
+        return parse_cii("tests/samples/zugferd_2p1_EN16931_Einfach.xml")
+
+    monkeypatch.setattr(batch, "extract_invoice_data", fake_extract)
+    monkeypatch.setattr(batch, "validate", lambda xml, folder: {"return_code": 0})
+    monkeypatch.setattr(main, "BATCH_FOLDER", tmp_path)
+    monkeypatch.setattr(main, "RAPID_API_SECRET_KEY", "secret")
+    return TestClient(main.app)
+
+
+def post_batch(client, files):
+    with client.stream(
+        "POST",
+        "/batch",
+        files=files,
+        headers={"X-RapidAPI-Proxy-Secret": "secret"},
+    ) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        return [json.loads(line) for line in response.iter_lines() if line]
+
+
+def test_zip_batch_streams_one_line_per_invoice(client, tmp_path):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("march/a.pdf", PDF)
+        zip_file.writestr("march/b.pdf", PDF)
+        zip_file.writestr("march/broken.pdf", b"%PDF-1.4 garbage")
+        zip_file.writestr("march/readme.txt", b"ignored")
+        zip_file.writestr("__MACOSX/march/._a.pdf", b"ignored")
+
+    lines = post_batch(client, {"files": ("march.zip", archive.getvalue())})
+
+    results = {line["file"]: line for line in lines[:-1]}
+    assert set(results) == {"march/a.pdf", "march/b.pdf", "march/broken.pdf"}
+    assert results["march/a.pdf"]["status"] == "ok"
+    assert results["march/a.pdf"]["invoice"]["header"]["id"] == "471102"
+    assert "<cbc:ID>471102</cbc:ID>" in results["march/a.pdf"]["xml_content"]
+    assert results["march/a.pdf"]["validation"] == {"return_code": 0}
+    assert results["march/broken.pdf"]["error"] == "not an invoice"
+    assert lines[-1]["summary"]["ok"] == 2
+    assert lines[-1]["summary"]["error"] == 1
+    # Nothing of the batch is left on disk
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_multipart_batch(client):
+    files = [("files", (f"{i}.pdf", PDF, "application/pdf")) for i in range(3)]
+    lines = post_batch(client, files)
+    assert sorted(line["file"] for line in lines[:-1]) == ["0.pdf", "1.pdf", "2.pdf"]
+    assert lines[-1]["summary"]["ok"] == 3
+
+
+def test_batch_size_limit(client, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_FILES", 1)
+    files = [("files", (f"{i}.pdf", PDF, "application/pdf")) for i in range(2)]
+    response = client.post(
+        "/batch", files=files, headers={"X-RapidAPI-Proxy-Secret": "secret"}
+    )
+    assert response.status_code == 413
+
+
+def test_oversized_entries_are_reported(client, monkeypatch):
+    monkeypatch.setattr(batch, "UPLOAD_MAX_BYTES", len(PDF))
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("a.pdf", PDF)
+        zip_file.writestr("bomb.pdf", b"\0" * (len(PDF) + 1))
+
+    lines = post_batch(client, {"files": ("march.zip", archive.getvalue())})
+
+    results = {line["file"]: line for line in lines[:-1]}
+    assert results["a.pdf"]["status"] == "ok"
+    assert results["bomb.pdf"]["status"] == "error"
+    assert "limited to" in results["bomb.pdf"]["error"]
+
+
+def test_page_budget_per_pdf(client, monkeypatch):
+    def check_page_budget(path):
+        raise batch.UploadTooLarge("PDFs are limited to 1 pages, got 2")
+
+    monkeypatch.setattr(batch, "check_page_budget", check_page_budget)
+    files = [("files", ("a.pdf", PDF, "application/pdf"))]
+
+    lines = post_batch(client, files)
+
+    assert lines[0]["status"] == "error"
+    assert lines[-1]["summary"]["error"] == 1
+
+
+def test_failing_source_ends_with_an_error_line(tmp_path):
+    def sources():
+        yield "a.pdf", ValueError("not an invoice")
+        raise OSError("disk full")
+
+    async def collect():
+        return [
+            json.loads(line) async for line in batch.stream_batch(sources(), tmp_path)
+        ]
+
+    lines = asyncio.run(collect())
+
+    assert {"status": "error", "error": "disk full"} in lines
+    assert any(line.get("file") == "a.pdf" for line in lines)
+    assert lines[-1]["summary"]["error"] == 2
@@ -0,0 +1,165 @@
+import time
+import threading
+import pytest
+import browser_pool
+from browser_pool import BrowserPool
+
+
+class FakeSB:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.screenshots = []
+
+    def execute_script(self, script, *args):
+        if not self.alive:
+            raise ConnectionError("browser is gone")
+        return "complete"
+
+    def save_screenshot(self, path):
+        self.screenshots.append(path)
+
+
+class FakeContext:
+    """Stands in for the ``SB(...)`` context manager."""
+
+    def __init__(self, browsers):
+        self.browsers = browsers
+
+    def __enter__(self):
+        self.sb = FakeSB()
+        self.browsers.append(self.sb)
+        return self.sb
+
+    def __exit__(self, *exc):
+        self.sb.closed = True
+
+
+@pytest.fixture
+def browsers(tmp_path, monkeypatch):
+    monkeypatch.setattr(browser_pool, "SCREENSHOT_FOLDER", str(tmp_path))
+    return []
+
+
+def make_pool(browsers, **kwargs):
+    logins = []
+    pool = BrowserPool(
+        "fake", lambda: FakeContext(browsers), prepare=logins.append, **kwargs
+    )
+    return pool, logins
+
+
+def test_browsers_are_reused_and_prepared_once(browsers):
+    pool, logins = make_pool(browsers, size=2)
+    for _ in range(5):
+        with pool.checkout() as sb:
+            assert sb is browsers[0]
+    assert len(browsers) == 1
+    assert logins == browsers
+    assert pool.stats()["reused"] == 4
+    assert not browsers[0].screenshots
+
+
+def test_failed_work_discards_the_browser_with_a_screenshot(browsers):
+    pool, _ = make_pool(browsers)
+    with pytest.raises(ValueError):
+        with pool.checkout():
+            raise ValueError("no answer")
+    assert browsers[0].closed
+    assert len(browsers[0].screenshots) == 1
+    with pool.checkout() as sb:
+        assert sb is browsers[1]
+
+
+def test_unresponsive_and_worn_out_browsers_are_replaced(browsers):
+    pool, _ = make_pool(browsers, max_uses=2)
+    with pool.checkout():
+        pass
+    browsers[0].alive = False
+    with pool.checkout() as sb:
+        assert sb is browsers[1]
+    with pool.checkout():
+        pass
+    assert browsers[1].closed  # second use reached max_uses
+    assert pool.stats()["replaced"] == 1
+    assert pool.stats()["open"] == 0
+
+
+def test_pool_size_bounds_open_browsers(browsers):
+    pool, _ = make_pool(browsers, size=2)
+    lock = threading.Lock()
+    running = {"now": 0, "max": 0}
+
+    def convert():
+        with pool.checkout():
+            with lock:
+                running["now"] += 1
+                running["max"] = max(running["max"], running["now"])
+            time.sleep(0.01)
+            with lock:
+                running["now"] -= 1
+
+    threads = [threading.Thread(target=convert) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert running["max"] == 2
+    assert len(browsers) == 2
+
+
+def test_discarded_browser_wakes_a_waiting_checkout(browsers):
+    pool, _ = make_pool(browsers, size=1)
+    checked_out = threading.Event()
+    started = []
+
+    def failing():
+        with pytest.raises(ValueError):
+            with pool.checkout():
+                checked_out.set()
+                time.sleep(0.05)
+                raise ValueError("no answer")
+
+    def waiting():
+        with pool.checkout() as sb:
+            started.append(time.perf_counter())
+            assert sb is browsers[1]
+
+    thread = threading.Thread(target=failing)
+    thread.start()
+    checked_out.wait()
+    start_time = time.perf_counter()
+    waiting()
+    thread.join()
+    # Woken by the discard, not by the checkout timeout
+    assert started[0] - start_time < 1
+    assert pool.stats()["open"] == 1
+
+
+class SlowDriver:
+    """Never sees the answer, every wait runs into the script timeout."""
+
+    def set_script_timeout(self, timeout):
+        self.timeout = timeout
+
+    def execute_async_script(self, script, *args):
+        time.sleep(self.timeout)
+        raise browser_pool.TimeoutException("script timeout")
+
+
+def test_cancelled_wait_gives_the_browser_back(browsers, monkeypatch):
+    monkeypatch.setattr(browser_pool, "BROWSER_CANCEL_POLL", 0.02)
+    pool, _ = make_pool(browsers)
+    cancelled = threading.Event()
+    threading.Timer(0.05, cancelled.set).start()
+
+    start_time = time.perf_counter()
+    with pytest.raises(browser_pool.Cancelled):
+        with pool.checkout() as sb:
+            sb.driver = SlowDriver()
+            browser_pool.wait_for_new_element(sb, "div", 0, 300, cancelled)
+    assert time.perf_counter() - start_time < 1
+    # Not a failure: no screenshot and the browser is reused
+    assert not browsers[0].screenshots
+    with pool.checkout() as sb:
+        assert sb is browsers[0]
@@ -0,0 +1,41 @@
+import os
+import time
+from cache import DiskCache, content_hash
+
+
+def test_cache_roundtrip(tmp_path):
+    cache = DiskCache(tmp_path / "cache")
+    report = tmp_path / "report.xml"
+    report.write_text("<report/>")
+
+    key = content_hash(b"<Invoice/>", "validator-version")
+    assert cache.get(key) is None
+
+    cache.put(key, {"return_code": 0}, {"report.xml": report})
+    payload, entry = cache.get(key)
+    assert payload == {"return_code": 0}
+    assert (entry / "report.xml").read_text() == "<report/>"
+
+
+def test_cache_key_depends_on_version():
+    assert content_hash(b"<Invoice/>", "a") != content_hash(b"<Invoice/>", "b")
+
+
+def test_cache_ttl_and_lru_eviction(tmp_path):
+    cache = DiskCache(tmp_path / "cache", max_entries=2, ttl=60)
+    keys = [content_hash(str(i)) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, {"i": i})
+        old = time.time() - 10 + i
+        os.utime(cache.path(key), (old, old))
+
+    # Reading the oldest entry makes it the most recently used one
+    assert cache.get(keys[0]) is not None
+    cache.evict()
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+
+    expired = time.time() - 120
+    os.utime(cache.path(keys[2]) / "meta.json", (expired, expired))
+    assert cache.get(keys[2]) is None
@@ -0,0 +1,153 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pypdf import PdfReader
+import chunked
+import hedging
+
+threads = ThreadPoolExecutor(max_workers=8)
+
+
+def item(line_id, amount, rate=19.0):
+    return {
+        "line_id": line_id,
+        "product_name": f"Position {line_id}",
+        "quantity": 1,
+        "agreement_net_price": amount,
+        "delivery_details": amount,
+        "settlement_tax": {"category": "S", "rate": rate},
+    }
+
+
+def header(net_total):
+    return {
+        "header": {"id": "R-2024-1"},
+        "trade": {
+            "items": [item("1", 999.0)],
+            "settlement": {"monetary_summation": {"net_total": net_total}},
+        },
+    }
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Fake provider answering items per page, page texts are "page <n>"."""
+    calls = {
+        "header": [],
+        "header_pdf": [],
+        "items": [],
+        "item_models": [],
+        "concurrent": 0,
+        "max_concurrent": 0,
+    }
+    lock = threading.Lock()
+    page_items = {}
+
+    def answer_items(pdf_text):
+        with lock:
+            calls["concurrent"] += 1
+            calls["max_concurrent"] = max(calls["max_concurrent"], calls["concurrent"])
+        threading.Event().wait(0.05)
+        with lock:
+            calls["concurrent"] -= 1
+        pages = [int(line.split()[1]) for line in pdf_text.splitlines()]
+        return [entry for page in pages for entry in page_items.get(page, [])]
+
+    def submit_header(model, pdf_text, pdf_bytes=None, cancelled=None):
+        calls["header"].append(pdf_text)
+        calls["header_pdf"].append(pdf_bytes)
+        return threads.submit(lambda: header(calls["net_total"]))
+
+    def submit_items(model, pdf_text, cancelled=None):
+        calls["items"].append(pdf_text)
+        calls["item_models"].append(model)
+        return threads.submit(answer_items, pdf_text)
+
+    monkeypatch.setattr(chunked, "submit_header", submit_header)
+    monkeypatch.setattr(chunked, "submit_items", submit_items)
+    monkeypatch.setattr(chunked, "CHUNKED_MIN_PAGES", 4)
+    calls["page_items"] = page_items
+    return calls
+
+
+PAGES = [f"page {n}" for n in range(1, 7)]
+
+
+def test_short_invoices_are_not_chunked(calls):
+    assert chunked.extract_chunked(PAGES[:3], "gemini") is None
+    assert chunked.extract_chunked(PAGES, "chatgpt") is None
+    assert calls["header"] == calls["items"] == []
+
+
+def test_items_are_extracted_in_parallel_and_merged(calls):
+    calls["net_total"] = 60.0
+    calls["page_items"].update(
+        {1: [item("1", 10.0)], 2: [item("2", 20.0)], 4: [item("3", 30.0)]}
+    )
+
+    invoice_data = chunked.extract_chunked(PAGES, "gemini")
+
+    assert calls["header"] == ["page 1\npage 6"]
+    assert calls["items"] == ["page 1\npage 2", "page 3\npage 4", "page 5\npage 6"]
+    assert calls["max_concurrent"] > 1
+    items = invoice_data["trade"]["items"]
+    assert [entry["line_id"] for entry in items] == ["1", "2", "3"]
+    assert items[2]["total_amount"] == 35.7
+    assert invoice_data["header"]["id"] == "R-2024-1"
+
+
+def test_repeated_line_ids_are_dropped(calls):
+    # Row 2 is cut by the page break and read by both chunks
+    calls["net_total"] = 30.0
+    calls["page_items"].update(
+        {1: [item("1", 10.0)], 2: [item("2", 20.0)], 3: [item("2", 20.0)]}
+    )
+
+    items = chunked.extract_chunked(PAGES, "ollama")["trade"]["items"]
+
+    assert [entry["line_id"] for entry in items] == ["1", "2"]
+
+
+def test_restarted_numbering_is_kept_when_it_adds_up(calls):
+    calls["net_total"] = 45.0
+    calls["page_items"].update(
+        {1: [item("1", 10.0), item("2", 20.0)], 3: [item("1", 5.0), item("2", 10.0)]}
+    )
+
+    items = chunked.extract_chunked(PAGES, "gemini")["trade"]["items"]
+
+    assert len(items) == 4
+
+
+def test_failed_chunk_falls_back_to_one_prompt(calls, monkeypatch):
+    def fail(model, pdf_text, cancelled=None):
+        return threads.submit(lambda: 1 / 0)
+
+    monkeypatch.setattr(chunked, "submit_items", fail)
+    calls["net_total"] = 0.0
+
+    assert chunked.extract_chunked(PAGES, "gemini") is None
+
+
+def test_header_call_gets_the_first_and_last_page(calls):
+    calls["net_total"] = 0.0
+    pdf = open("tests/samples/output.pdf", "rb").read()
+
+    chunked.extract_chunked(PAGES, "gemini", pdf_bytes=pdf)
+
+    header_pdf = PdfReader(io.BytesIO(calls["header_pdf"][0]))
+    assert len(header_pdf.pages) == 2
+
+
+def test_late_item_chunks_are_hedged(calls, monkeypatch):
+    monkeypatch.setattr(hedging, "HEDGE_DEFAULT_DELAY", 0.01)
+    monkeypatch.setattr(hedging, "_stats", {})
+    calls["net_total"] = 0.0
+    policy = {"primary": "gemini", "secondary": "ollama", "percentile": 0.9}
+
+    assert chunked.extract_chunked(PAGES, "gemini", policy=policy) is not None
+
+    # Every chunk took longer than the hedge delay and was raced
+    assert calls["item_models"].count("ollama") == 3
+    assert hedging.hedging_stats()["ollama items"]["hedged"] == 3
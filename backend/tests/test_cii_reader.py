@@ -0,0 +1,86 @@
+import io
+import glob
+import pytest
+import xml.etree.ElementTree as ET
+import pdf_parser
+from cii_reader import parse_cii, is_complete, convert_cii_files
+from drafthorse.pdf import attach_xml
+from pdf_parser import extract_invoice_data, find_embedded_invoice_xml
+
+
+def test_parse_en16931():
+    invoice = parse_cii("tests/samples/zugferd_2p1_EN16931_Einfach.xml")
+    assert is_complete(invoice)
+
+    assert invoice["header"]["id"] == "471102"
+    assert invoice["header"]["issue_date_time"] == "2018-03-05"
+    seller = invoice["trade"]["agreement"]["seller"]
+    assert seller["name"] == "Lieferant GmbH"
+    assert seller["tax_id"] == "201/113/40209"
+    assert seller["vat_id"] == "DE123456789"
+    assert seller["address"]["city_name"] == "München"
+
+    settlement = invoice["trade"]["settlement"]
+    assert settlement["currency_code"] == "EUR"
+    assert settlement["monetary_summation"]["net_total"] == 473.0
+    assert settlement["monetary_summation"]["tax_total"] == 56.87
+    assert [tax["rate"] for tax in settlement["trade_tax"]] == [7.0, 19.0]
+
+    items = invoice["trade"]["items"]
+    assert [item["line_id"] for item in items] == ["1", "2"]
+    assert items[0]["quantity"] == 20
+    assert items[0]["agreement_net_price"] == 9.9
+    assert items[0]["delivery_details"] == 198.0
+
+
+def test_zugferd1_basic_is_incomplete():
+    xml = find_embedded_invoice_xml("tests/samples/zugferd1_invoice_pdfa3b.pdf")
+    assert xml is not None
+
+    invoice = parse_cii(io.BytesIO(xml))
+    assert invoice["header"]["id"]
+    assert invoice["trade"]["agreement"]["seller"]["name"]
+    # BASIC 1.0 lines carry no prices, the LLM has to fill the gaps
+    assert not is_complete(invoice)
+
+
+def test_hybrid_pdf_skips_llm(tmp_path, monkeypatch):
+    with open("tests/samples/output.pdf", "rb") as f:
+        pdf = f.read()
+    with open("tests/samples/zugferd_2p1_EN16931_Einfach.xml", "rb") as f:
+        xml = f.read()
+    hybrid = tmp_path / "hybrid.pdf"
+    hybrid.write_bytes(attach_xml(pdf, xml))
+
+    def fail(*args, **kwargs):
+        pytest.fail("LLM must not be called for hybrid PDFs")
+
+    monkeypatch.setattr(pdf_parser, "process", fail)
+    monkeypatch.setattr(pdf_parser, "extract_page_texts", fail)
+
+    invoice = extract_invoice_data(str(hybrid))
+    assert invoice["header"]["id"] == "471102"
+    assert len(invoice["trade"]["items"]) == 2
+
+
+def test_convert_sample_corpus(tmp_path):
+    paths = sorted(glob.glob("tests/samples/zugferd_*.xml"))
+    results = convert_cii_files(paths, output_folder=tmp_path)
+
+    assert [result["file"] for result in results] == paths
+    for path, result in zip(paths, results):
+        assert "error" not in result, path
+        ubl = ET.parse(result["output"]).getroot()
+        assert ubl.tag.endswith("}Invoice")
+        invoice_id = ubl.find("{*}ID").text
+        assert invoice_id == parse_cii(path)["header"]["id"]
+
+
+def test_convert_reports_broken_files(tmp_path):
+    broken = tmp_path / "broken.xml"
+    broken.write_text("<rsm:CrossIndustryInvoice")
+    results = convert_cii_files(
+        [broken, "tests/samples/zugferd_2p1_EN16931_Einfach.xml"]
+    )
+    assert "error" in results[0]
+    assert "471102" in results[1]["xml_content"]
@@ -0,0 +1,58 @@
+import copy
+import pytest
+from lxml import etree
+from cii_writer import generate_cii_xml, write_cii_file
+from pdf_parser import generate_invoice_xml
+from test_create_xrechnung import invoice_data
+
+parser = etree.XMLParser(remove_blank_text=True)
+
+
+def canonical(xml):
+    return etree.tostring(etree.fromstring(xml.encode(), parser), method="c14n")
+
+
+def variant(**changes):
+    data = copy.deepcopy(invoice_data)
+    seller = data["trade"]["agreement"]["seller"]
+    if "tax_id" in changes:
+        seller["tax_id"] = changes["tax_id"]
+    if "region" in changes:
+        seller["address"]["region"] = changes["region"]
+    if "notes" in changes:
+        data["header"]["notes"] = changes["notes"]
+    if "items" in changes:
+        data["trade"]["items"] *= changes["items"]
+    return data
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        invoice_data,
+        variant(tax_id="", notes=["", "Lieferung frei Haus"]),
+        variant(region="BY"),
+        variant(items=50),
+    ],
+)
+def test_same_content_as_drafthorse(data):
+    assert canonical(generate_cii_xml(data)) == canonical(generate_invoice_xml(data))
+
+
+def test_sample_output_is_reproduced():
+    with open("tests/samples/output.xml") as xml:
+        assert canonical(generate_cii_xml(invoice_data)) == canonical(xml.read())
+
+
+def test_invalid_invoices_are_rejected_when_validating(tmp_path):
+    data = copy.deepcopy(invoice_data)
+    data["trade"]["items"] = []
+
+    assert generate_cii_xml(data, validate=False)
+    with pytest.raises(etree.DocumentInvalid):
+        generate_cii_xml(data, validate=True)
+
+    path = tmp_path / "invoice.xml"
+    with pytest.raises(etree.DocumentInvalid):
+        write_cii_file(data, str(path), validate=True)
+    assert not path.exists()
@@ -2,7 +2,13 @@ import pytest
 from datetime import datetime, timezone
 from decimal import Decimal
 from pdf_parser import generate_invoice_xml
-from xrechnung_generator import generate_xrechnung
+import copy
+import xrechnung_generator
+from xrechnung_generator import (
+    generate_xrechnung,
+    generate_xrechnung_stream,
+    write_xrechnung,
+)
 from pdfplumber import open as open_pdf
 
 invoice_data = {
@@ -280,3 +286,37 @@ def test_xrechnung_creation():
     # with open("tests/samples/xrechnungen/zugferd1_invoice_pdfa3b.xml", "w") as f:
     #     f.write(xml_content)
     assert xml_string == xml_content
+
+
+def test_xrechnung_stream_matches_render(tmp_path):
+    many_items = copy.deepcopy(invoice_data)
+    many_items["trade"]["items"] *= 200
+
+    chunks = list(generate_xrechnung_stream(many_items, buffer_size=64))
+    assert len(chunks) > 1
+    assert "".join(chunks) == generate_xrechnung(many_items)
+
+    path = tmp_path / "invoice.xml"
+    write_xrechnung(many_items, str(path))
+    assert path.read_text(encoding="utf-8") == generate_xrechnung(many_items)
+
+
+def test_xrechnung_stream_fails_before_the_first_chunk():
+    broken = copy.deepcopy(invoice_data)
+    del broken["trade"]["agreement"]["seller"]
+
+    with pytest.raises(KeyError):
+        generate_xrechnung_stream(broken)
+
+
+def test_template_cache_folder_is_optional(tmp_path, monkeypatch):
+    # A file where the folder should be, like a read-only working directory
+    blocked = tmp_path / "uploads"
+    blocked.write_text("")
+    monkeypatch.setattr(
+        xrechnung_generator, "TEMPLATE_CACHE_DIR", str(blocked / "jinja")
+    )
+    monkeypatch.setattr(xrechnung_generator, "_template", None)
+
+    assert generate_xrechnung(copy.deepcopy(invoice_data))
+    assert xrechnung_generator.xrechnung_template().environment.bytecode_cache is None
@@ -0,0 +1,80 @@
+import hashlib
+import pytest
+import pdf_parser
+from cache import DiskCache
+from pdf_parser import extract_invoice_data, extraction_cache_stats
+
+PDF = "tests/samples/output.pdf"
+
+
+@pytest.fixture
+def answers():
+    """Providers that won the hedged calls, one set per call."""
+    return []
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch, answers):
+    calls = []
+
+    def fake_process(pdf_text, model="chatgpt", test=False, pdf_file=None, **kwargs):
+        calls.append(pdf_file)
+        kwargs["answered_by"].update(answers.pop(0) if answers else ())
+        return {"header": {"id": f"call-{len(calls)}"}}
+
+    monkeypatch.setattr(pdf_parser, "process", fake_process)
+    monkeypatch.setattr(pdf_parser, "extract_page_texts", lambda path: ["text"])
+    monkeypatch.setattr(pdf_parser, "EXTRACTION_CACHE", True)
+    monkeypatch.setattr(pdf_parser, "extraction_cache", DiskCache(tmp_path))
+    monkeypatch.setattr(
+        pdf_parser,
+        "_cache_metrics",
+        {"hits": 0, "misses": 0, "bypassed": 0, "uncached": 0},
+    )
+    return calls
+
+
+def test_repeated_upload_hits_cache(calls, tmp_path):
+    # Same bytes under another name are the same document
+    copy = tmp_path / "retry.pdf"
+    copy.write_bytes(open(PDF, "rb").read())
+
+    assert extract_invoice_data(PDF)["header"]["id"] == "call-1"
+    assert extract_invoice_data(str(copy))["header"]["id"] == "call-1"
+    assert len(calls) == 1
+
+    stats = extraction_cache_stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_uploaded_bytes_share_the_key(calls):
+    extract_invoice_data(PDF)
+    pdf_bytes = open(PDF, "rb").read()
+    assert extract_invoice_data(PDF, pdf_bytes=pdf_bytes)["header"]["id"] == "call-1"
+
+
+def test_upload_hash_shares_the_key(calls):
+    extract_invoice_data(PDF)
+    pdf_hash = hashlib.sha256(open(PDF, "rb").read()).hexdigest()
+    assert extract_invoice_data(PDF, pdf_hash=pdf_hash)["header"]["id"] == "call-1"
+
+
+def test_bypass_refreshes_entry(calls):
+    extract_invoice_data(PDF)
+    assert extract_invoice_data(PDF, bypass_cache=True)["header"]["id"] == "call-2"
+    assert extract_invoice_data(PDF)["header"]["id"] == "call-2"
+    assert extraction_cache_stats()["bypassed"] == 1
+
+
+def test_prompt_version_is_part_of_key(calls, monkeypatch):
+    extract_invoice_data(PDF)
+    monkeypatch.setattr(pdf_parser, "PROMPT_VERSION", "changed")
+    assert extract_invoice_data(PDF)["header"]["id"] == "call-2"
+
+
+def test_hedged_answer_of_another_provider_is_not_cached(calls, answers):
+    answers.append({"chatgpt"})
+    extract_invoice_data(PDF)
+    assert extract_invoice_data(PDF)["header"]["id"] == "call-2"
+    assert extract_invoice_data(PDF)["header"]["id"] == "call-2"
+    assert extraction_cache_stats()["uncached"] == 1
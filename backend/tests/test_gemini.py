@@ -0,0 +1,169 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import pytest
+from google.genai import errors
+import gemini_integration
+from gemini_integration import GeminiLimiter, PromptCache, TokenBucket
+from gemini_integration import process_with_gemini
+from utils import PROMPT
+
+PDF = open("tests/samples/output.pdf", "rb").read()
+
+
+class FakeAio:
+    def __init__(self, failures=0, delay=0, caching=False):
+        self.failures = failures
+        self.caching = caching
+        self.caches_created = 0
+        self.deleted = False
+        self.delay = delay
+        self.contents = []
+        self.uploads = 0
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.models = SimpleNamespace(generate_content=self.generate_content)
+        self.files = SimpleNamespace(upload=self.upload)
+        self.caches = SimpleNamespace(list=self.list_caches, create=self.create_cache)
+
+    async def list_caches(self):
+        async def empty():
+            return
+            yield
+
+        return empty()
+
+    async def create_cache(self, model, config):
+        if not self.caching:
+            raise errors.ClientError(400, {"error": {"message": "too few tokens"}})
+        self.caches_created += 1
+        assert config.contents == [PROMPT]
+        return SimpleNamespace(name=f"cachedContents/{self.caches_created}")
+
+    async def upload(self, file, config):
+        self.uploads += 1
+        return SimpleNamespace(uri="files/invoice", mime_type="application/pdf")
+
+    async def generate_content(self, model, contents, config):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        await asyncio.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        self.contents.append((contents, config.cached_content))
+        if self.deleted and config.cached_content:
+            raise errors.ClientError(404, {"error": {"message": "cache not found"}})
+        if self.failures:
+            self.failures -= 1
+            raise errors.ServerError(503, {"error": {"message": "overloaded"}})
+        usage = SimpleNamespace(
+            prompt_token_count=1000,
+            candidates_token_count=100,
+            cached_content_token_count=0,
+        )
+        return SimpleNamespace(text='{"header": {"id": "1"}}', usage_metadata=usage)
+
+
+@pytest.fixture
+def fake_aio(monkeypatch):
+    def install(**kwargs):
+        aio = FakeAio(**kwargs)
+        monkeypatch.setattr(gemini_integration, "client", SimpleNamespace(aio=aio))
+        monkeypatch.setattr(gemini_integration, "limiter", GeminiLimiter())
+        monkeypatch.setattr(gemini_integration, "_uploads", {})
+        monkeypatch.setattr(gemini_integration, "prompt_cache", PromptCache())
+        monkeypatch.setattr(gemini_integration, "GEMINI_BACKOFF_BASE", 0)
+        monkeypatch.setattr(gemini_integration, "GEMINI_REQUESTS_PER_MINUTE", 60000)
+        return aio
+
+    return install
+
+
+def test_small_pdf_is_sent_inline_and_retried(fake_aio):
+    aio = fake_aio(failures=1)
+    retries = gemini_integration.gemini_stats()["retries"]
+
+    assert process_with_gemini(None, "text", PDF) == {"header": {"id": "1"}}
+    assert len(aio.contents) == 2
+    contents, cached_content = aio.contents[0]
+    # No cache could be created, the full prompt goes with the request
+    assert cached_content is None
+    assert contents[0] == PROMPT
+    assert contents[1].inline_data.data == PDF
+    assert aio.uploads == 0
+    assert gemini_integration.gemini_stats()["retries"] == retries + 1
+
+
+def test_large_pdf_is_uploaded_once(fake_aio, monkeypatch):
+    monkeypatch.setattr(gemini_integration, "GEMINI_INLINE_MAX_BYTES", 0)
+    aio = fake_aio(failures=2)
+
+    process_with_gemini(None, "text", PDF)
+    process_with_gemini(None, "text", PDF)
+    assert aio.uploads == 1
+    assert len(aio.contents) == 4
+    assert all(contents[1].uri == "files/invoice" for contents, _ in aio.contents)
+
+
+def test_static_prompt_is_cached(fake_aio):
+    aio = fake_aio(caching=True)
+
+    process_with_gemini(None, "text", PDF)
+    process_with_gemini(None, "text", PDF)
+    assert aio.caches_created == 1
+    for contents, cached_content in aio.contents:
+        assert cached_content == "cachedContents/1"
+        assert PROMPT not in contents
+        assert contents[-1] == "text"
+
+    # An expired cache falls back to the full prompt and is recreated
+    aio.deleted = True
+    process_with_gemini(None, "text", PDF)
+    contents, cached_content = aio.contents[-1]
+    assert cached_content is None
+    assert contents[0] == PROMPT
+    aio.deleted = False
+    process_with_gemini(None, "text", PDF)
+    assert aio.contents[-1][1] == "cachedContents/2"
+
+
+def test_concurrent_calls_are_bounded(fake_aio, monkeypatch):
+    monkeypatch.setattr(gemini_integration, "GEMINI_MAX_CONCURRENCY", 2)
+    aio = fake_aio(delay=0.05)
+
+    with ThreadPoolExecutor(6) as pool:
+        list(pool.map(lambda i: process_with_gemini(None, "text", PDF), range(6)))
+    assert aio.peak == 2
+
+
+def test_token_bucket_paces_calls():
+    async def acquire_three():
+        bucket = TokenBucket(rate=10, capacity=1)
+        start_time = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - start_time
+
+    assert asyncio.run(acquire_three()) >= 0.19
+
+
+def test_backoff_does_not_hold_a_slot(fake_aio, monkeypatch):
+    monkeypatch.setattr(gemini_integration, "GEMINI_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(gemini_integration, "backoff_delay", lambda attempt: 0.3)
+    aio = fake_aio(failures=1)
+    finished = []
+
+    def extract(name):
+        process_with_gemini(None, "text", PDF)
+        finished.append(name)
+
+    with ThreadPoolExecutor(2) as pool:
+        pool.submit(extract, "retried")
+        time.sleep(0.1)
+        pool.submit(extract, "second")
+    # The second call ran while the first one waited for its retry
+    assert finished == ["second", "retried"]
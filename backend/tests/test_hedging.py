@@ -0,0 +1,109 @@
+import time
+import asyncio
+import pytest
+import hedging
+from executors import BackgroundLoop
+
+INVOICE = {"header": {"id": "1"}, "trade": {}}
+providers = BackgroundLoop("test-providers")
+
+
+@pytest.fixture
+def fake_providers(monkeypatch):
+    """Providers answering after ``delays[model]`` with ``answers[model]``."""
+    fake = {"delays": {}, "answers": {}, "started": [], "cancelled": [], "events": {}}
+
+    def submit(
+        model, pdf_text, pdf_file=None, pdf_bytes=None, test=False, cancelled=None
+    ):
+        fake["events"][model] = cancelled
+
+        async def answer():
+            fake["started"].append(model)
+            try:
+                await asyncio.sleep(fake["delays"][model])
+            except asyncio.CancelledError:
+                fake["cancelled"].append(model)
+                raise
+            if isinstance(fake["answers"][model], Exception):
+                raise fake["answers"][model]
+            return fake["answers"][model]
+
+        return providers.submit(answer())
+
+    monkeypatch.setattr(hedging, "submit", submit)
+    monkeypatch.setattr(hedging, "_stats", {})
+    monkeypatch.setattr(hedging, "HEDGE_DEFAULT_DELAY", 0.1)
+    return fake
+
+
+POLICY = {"primary": "gemini", "secondary": "ollama", "percentile": 0.9}
+
+
+def test_fast_primary_is_not_hedged(fake_providers):
+    fake_providers["delays"] = {"gemini": 0.01}
+    fake_providers["answers"] = {"gemini": INVOICE}
+
+    assert hedging.hedged_extract("Rechnung", POLICY) == INVOICE
+    assert fake_providers["started"] == ["gemini"]
+    assert hedging.hedging_stats()["gemini"]["wins"] == 1
+
+
+def test_late_primary_is_raced_and_cancelled(fake_providers):
+    fake_providers["delays"] = {"gemini": 5, "ollama": 0.01}
+    fake_providers["answers"] = {"gemini": INVOICE, "ollama": {**INVOICE, "by": 2}}
+
+    start_time = time.perf_counter()
+    assert hedging.hedged_extract("Rechnung", POLICY)["by"] == 2
+    assert time.perf_counter() - start_time < 1
+    time.sleep(0.05)  # cancellation reaches the loop
+    assert fake_providers["cancelled"] == ["gemini"]
+    # Browser providers stop on the event instead
+    assert fake_providers["events"]["gemini"].is_set()
+    assert not fake_providers["events"]["ollama"].is_set()
+    stats = hedging.hedging_stats()
+    assert stats["ollama"]["hedged"] == 1
+    assert stats["ollama"]["wins"] == 1
+    assert stats["gemini"]["losses"] == 1
+
+
+def test_failed_primary_hedges_right_away(fake_providers, monkeypatch):
+    monkeypatch.setattr(hedging, "HEDGE_DEFAULT_DELAY", 5)
+    fake_providers["delays"] = {"gemini": 0, "ollama": 0.01}
+    fake_providers["answers"] = {"gemini": ValueError("broken"), "ollama": INVOICE}
+
+    start_time = time.perf_counter()
+    assert hedging.hedged_extract("Rechnung", POLICY) == INVOICE
+    assert time.perf_counter() - start_time < 1
+    assert hedging.hedging_stats()["gemini"]["errors"] == 1
+
+
+def test_both_failing_raises(fake_providers):
+    fake_providers["delays"] = {"gemini": 0, "ollama": 0}
+    fake_providers["answers"] = {"gemini": ValueError("a"), "ollama": {"no": 1}}
+
+    with pytest.raises(ValueError):
+        hedging.hedged_extract("Rechnung", POLICY)
+
+
+def test_hedge_delay_follows_the_p90_latency(monkeypatch):
+    monkeypatch.setattr(hedging, "_stats", {})
+    assert hedging.hedge_delay("gemini") == hedging.HEDGE_DEFAULT_DELAY
+    hedging.provider_stats("gemini")["latencies"].extend(range(1, 101))
+    assert hedging.hedge_delay("gemini") == 91
+    assert hedging.hedge_delay("gemini", percentile=0.5) == 51
+
+
+def test_policies_are_chosen_per_endpoint(monkeypatch):
+    monkeypatch.setattr(
+        hedging, "DEFAULT_POLICY", {"secondary": None, "percentile": 0.9}
+    )
+    monkeypatch.setattr(
+        hedging, "EXTRACTION_POLICIES", {"upload": {"secondary": "ollama"}}
+    )
+    assert hedging.extraction_policy("upload", "gemini")["secondary"] == "ollama"
+    assert hedging.extraction_policy("batch", "gemini") == {
+        "primary": "gemini",
+        "secondary": None,
+        "percentile": 0.9,
+    }
@@ -0,0 +1,115 @@
+import shutil
+import pdfplumber
+from fastapi.testclient import TestClient
+from pypdf import PdfReader
+import main
+from cii_writer import generate_cii_xml
+from hybrid_pdf import build_update, write_hybrid_pdf
+from storage import LocalStorage, artifact_key
+from test_create_xrechnung import invoice_data
+
+XML = open("tests/samples/zugferd_2p1_EN16931_Einfach.xml", "rb").read()
+
+
+def make_hybrid(sample, tmp_path):
+    with open(sample, "rb") as pdf_file:
+        update = build_update(pdf_file, XML, {"title": "R-1 & 2", "author": "Ä GmbH"})
+    output = tmp_path / "hybrid.pdf"
+    output.write_bytes(open(sample, "rb").read() + update)
+    return output
+
+
+def text(pdf_path):
+    with pdfplumber.open(pdf_path) as pdf:
+        return [page.extract_text() for page in pdf.pages]
+
+
+def test_original_is_kept_and_xml_attached(tmp_path):
+    sample = "tests/samples/invoice_pdf17.pdf"
+    output = make_hybrid(sample, tmp_path)
+
+    original = open(sample, "rb").read()
+    assert output.read_bytes().startswith(original)
+    reader = PdfReader(output, strict=True)
+    assert list(reader.attachments) == ["factur-x.xml"]
+    assert reader.attachments["factur-x.xml"] == [XML]
+    assert reader.metadata.title == "R-1 & 2"
+    assert b"<pdfaid:part>3</pdfaid:part>" in reader.xmp_metadata.stream.get_data()
+    assert text(output) == text(sample)
+
+
+def test_xref_stream_pdf_gets_its_invoice_replaced(tmp_path):
+    # Written with an xref stream and carrying a ZUGFeRD 1.0 attachment
+    output = make_hybrid("tests/samples/zugferd1_invoice_pdfa3b.pdf", tmp_path)
+
+    reader = PdfReader(output, strict=True)
+    assert list(reader.attachments) == ["factur-x.xml"]
+    assert reader.attachments["factur-x.xml"] == [XML]
+    assert len(reader.trailer["/Root"]["/AF"]) == 1
+
+
+class FakeSessions:
+    async def find_one(self, query):
+        return {"session_id": query["session_id"], "pdf": "invoice.pdf"}
+
+
+def test_hybrid_endpoint_streams_the_upload_with_the_xml(tmp_path, monkeypatch):
+    (tmp_path / "s1").mkdir()
+    shutil.copyfile("tests/samples/output.pdf", tmp_path / "s1" / "invoice.pdf")
+    monkeypatch.setattr(main, "UPLOAD_FOLDER", tmp_path)
+    monkeypatch.setattr(main, "sessions_collection", FakeSessions())
+
+    response = TestClient(main.app).post(
+        "/convert/hybrid",
+        json=invoice_data,
+        headers={"X-Session-ID": "s1", "Origin": main.ORIGIN},
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/pdf"
+    assert int(response.headers["content-length"]) == len(response.content)
+    expected = write_hybrid_pdf(
+        tmp_path / "s1" / "invoice.pdf", invoice_data, tmp_path / "expected.pdf"
+    )
+    hybrid = tmp_path / "hybrid.pdf"
+    hybrid.write_bytes(response.content)
+    attachments = PdfReader(hybrid).attachments
+    assert attachments["factur-x.xml"] == [generate_cii_xml(invoice_data).encode()]
+    assert len(PdfReader(expected).pages) == len(PdfReader(hybrid).pages) == 2
+
+
+class StoredSessions:
+    def __init__(self, session):
+        self.session = session
+
+    async def find_one(self, query):
+        return dict(self.session)
+
+    async def update_one(self, query, update, upsert=False):
+        self.session.update(update["$set"])
+        for field in update.get("$unset", {}):
+            self.session.pop(field, None)
+
+
+def test_hybrid_still_works_after_convert(tmp_path, monkeypatch):
+    store = LocalStorage(tmp_path / "store")
+    source = tmp_path / "upload.pdf"
+    shutil.copyfile("tests/samples/output.pdf", source)
+    key = artifact_key("pdf", "ab" * 32, ".pdf")
+    store.put_file(key, source)
+    sessions = StoredSessions({"session_id": "s1", "pdf": key})
+    learned = []
+    monkeypatch.setattr(main, "storage", store)
+    monkeypatch.setattr(main, "sessions_collection", sessions)
+    monkeypatch.setattr(main, "learn_layout", lambda *args: learned.append(args))
+    client = TestClient(main.app)
+    headers = {"X-Session-ID": "s1", "Origin": main.ORIGIN}
+
+    for _ in range(2):
+        assert client.post("/convert", json=invoice_data, headers=headers).is_success
+    response = client.post("/convert/hybrid", json=invoice_data, headers=headers)
+
+    assert response.status_code == 200
+    assert response.content.startswith(source.read_bytes())
+    # The layout is still learned once per upload
+    assert len(learned) == 1
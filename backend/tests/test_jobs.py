@@ -0,0 +1,138 @@
+import asyncio
+import jobs
+from jobs import DONE, FAILED, JobWorkers, MemoryJobQueue, new_job, public_job
+from storage import LocalStorage
+
+
+def run_jobs(handler, *files, workers=2):
+    queue = MemoryJobQueue()
+    job_workers = JobWorkers(queue, workers=workers, handler=handler)
+
+    async def scenario():
+        job_ids = [(await queue.put(new_job(file)))["_id"] for file in files]
+        await job_workers.start()
+        while True:
+            counts = await queue.counts()
+            if counts[DONE] + counts[FAILED] == len(files):
+                break
+            await asyncio.sleep(0.01)
+        await job_workers.stop()
+        return [public_job(await queue.get(job_id)) for job_id in job_ids]
+
+    return asyncio.run(scenario()), job_workers
+
+
+def test_transient_failures_are_retried(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_RETRY_DELAY", 0)
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0.01)
+    calls = []
+
+    async def flaky(job):
+        calls.append(job["pdf"])
+        if len(calls) == 1:
+            raise ConnectionError("connection reset")
+        return {"xml_content": "<Invoice/>"}
+
+    (job,), workers = run_jobs(flaky, "a.pdf")
+    assert job["status"] == DONE
+    assert job["attempts"] == 2
+    assert job["result"] == {"xml_content": "<Invoice/>"}
+    assert workers.metrics["retried"] == 1
+
+
+def test_permanent_failures_are_not_retried(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0.01)
+
+    async def broken(job):
+        raise ValueError("not an invoice")
+
+    (job,), workers = run_jobs(broken, "a.pdf")
+    assert job["status"] == FAILED
+    assert job["attempts"] == 1
+    assert job["error"] == "not an invoice"
+
+
+def test_concurrency_is_bounded(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0.01)
+    running = []
+    peak = []
+
+    async def slow(job):
+        running.append(job)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(job)
+        return {}
+
+    results, workers = run_jobs(slow, *[f"{i}.pdf" for i in range(6)], workers=2)
+    assert [job["status"] for job in results] == [DONE] * 6
+    assert max(peak) == 2
+    assert workers.metrics["completed"] == 6
+
+
+def test_lease_is_renewed_while_a_long_job_runs(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(jobs, "JOB_LEASE_SECONDS", 0.1)
+    monkeypatch.setattr(jobs, "JOB_HEARTBEAT_INTERVAL", 0.02)
+    calls = []
+
+    async def long_ocr(job):
+        calls.append(job["worker"])
+        await asyncio.sleep(0.4)
+        return {}
+
+    queue = MemoryJobQueue()
+    job_workers = JobWorkers(queue, workers=2, handler=long_ocr)
+
+    async def scenario():
+        job = await queue.put(new_job("pdf/a.pdf"))
+        await job_workers.start()
+        while (await queue.get(job["_id"]))["status"] != DONE:
+            await asyncio.sleep(0.01)
+        await job_workers.stop()
+        return await queue.get(job["_id"])
+
+    job = asyncio.run(asyncio.wait_for(scenario(), timeout=5))
+    assert job["status"] == DONE
+    assert len(calls) == 1
+
+
+def test_result_of_a_lost_lease_is_dropped():
+    queue = MemoryJobQueue()
+    job_workers = JobWorkers(queue, workers=1, handler=None)
+
+    async def scenario():
+        job = await queue.put(new_job("a.pdf"))
+        first = await queue.claim("first")
+        # The lease ran out and another worker took the job over
+        queue.jobs[job["_id"]]["updated_at"] -= jobs.timedelta(days=1)
+        await queue.claim("second")
+        assert not await job_workers.finish(first, "completed", status=DONE, result={})
+        return await queue.get(job["_id"])
+
+    job = asyncio.run(scenario())
+    assert job["status"] == jobs.RUNNING
+    assert job["worker"] == "second"
+
+
+def test_job_pdf_is_read_from_the_store(monkeypatch, tmp_path):
+    store = LocalStorage(tmp_path)
+    source = tmp_path / "upload.pdf"
+    source.write_bytes(b"%PDF-1.4")
+    store.put_file("pdf/ab/cd/abcd.pdf", source)
+    read = []
+
+    def extract(pdf_path, endpoint):
+        read.append(open(pdf_path, "rb").read())
+        return {"header": {"id": "1"}}
+
+    async def generate(function, invoice_data):
+        return "<Invoice/>"
+
+    monkeypatch.setattr(jobs, "extract_invoice_data", extract)
+    monkeypatch.setattr(jobs, "run_in_process", generate)
+
+    result = asyncio.run(jobs.convert_job(new_job("pdf/ab/cd/abcd.pdf"), store))
+
+    assert read == [b"%PDF-1.4"]
+    assert result["xml_content"] == "<Invoice/>"
@@ -0,0 +1,190 @@
+import copy
+import pytest
+import layouts
+from cii_reader import parse_cii
+from text_layer import read_words
+
+PDF = "tests/samples/zugferd_2p1_BASIC_Einfach.pdf"
+XML = "tests/samples/zugferd_2p1_BASIC_Einfach.xml"
+
+# The next invoice of the same seller: other number, date and quantity
+NEXT_INVOICE = {
+    "471102": "471188",
+    "2020-03-05": "2020-04-09",
+    "5.3.2020": "9.4.2020",
+    "20.0000": "10.0000",
+    "198,00": "99,00",
+    "37,62": "18,81",
+    "235,62": "117,81",
+}
+
+
+def reprint(pages, replacements):
+    pages = copy.deepcopy(pages)
+    for page in pages:
+        for word in page["words"]:
+            word["text"] = replacements.get(word["text"], word["text"])
+    return pages
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = layouts.LayoutStore(tmp_path / "layouts")
+    monkeypatch.setattr(layouts, "layout_store", store)
+    return store
+
+
+@pytest.fixture(scope="module")
+def pages():
+    return read_words(PDF)
+
+
+def test_known_layout_is_read_without_the_llm(store, pages):
+    confirmed = parse_cii(XML)
+    assert store.learn(pages, confirmed)["confirmations"] == 1
+    # One confirmation is not enough to trust the template
+    assert layouts.extract_with_layout(pages) is None
+    store.learn(pages, confirmed)
+
+    invoice_data = layouts.extract_with_layout(reprint(pages, NEXT_INVOICE))
+
+    assert invoice_data["header"]["id"] == "471188"
+    assert invoice_data["header"]["issue_date_time"] == "2020-04-09"
+    assert invoice_data["trade"]["agreement"]["buyer"]["name"] == "Kunden AG Mitte"
+    summation = invoice_data["trade"]["settlement"]["monetary_summation"]
+    assert summation["grand_total"] == 117.81
+    [item] = invoice_data["trade"]["items"]
+    assert item["quantity"] == 10
+    assert item["delivery_details"] == 99.0
+    assert item["total_amount"] == 117.81
+
+
+def test_amounts_that_do_not_add_up_fall_back(store, pages):
+    confirmed = parse_cii(XML)
+    store.learn(pages, confirmed)
+    store.learn(pages, confirmed)
+
+    # Grand total no longer equals net plus tax
+    misread = reprint(pages, {**NEXT_INVOICE, "235,62": "118,81"})
+    assert layouts.extract_with_layout(reprint(pages, NEXT_INVOICE)) is not None
+    assert layouts.extract_with_layout(misread) is None
+
+
+def test_other_layouts_do_not_match(store, pages):
+    confirmed = parse_cii(XML)
+    store.learn(pages, confirmed)
+    store.learn(pages, confirmed)
+
+    other = read_words("tests/samples/invoice_pdf17.pdf")
+    template, score = store.match(other)
+    assert template is None
+    assert score < layouts.LAYOUT_MIN_SCORE
+    assert layouts.extract_with_layout(other) is None
+
+
+def test_templates_survive_a_restart(store, pages):
+    confirmed = parse_cii(XML)
+    store.learn(pages, confirmed)
+    store.learn(pages, confirmed)
+
+    reloaded = layouts.LayoutStore(store.directory)
+    template, score = reloaded.match(pages)
+    assert score == 1.0
+    assert template["confirmations"] == 2
+
+
+def table_invoice(invoice_id, rows):
+    def word(x, top, text):
+        return {"x0": x, "x1": x + 6 * len(text), "top": top, "text": text}
+
+    words = [word(50, 20, "Muster"), word(100, 20, "GmbH")]
+    words += [word(50, 60, "Rechnungsnr.:"), word(140, 60, invoice_id)]
+    for x, text in [(50, "Pos"), (80, "Bezeichnung"), (300, "Menge")]:
+        words.append(word(x, 120, text))
+    words += [word(360, 120, "Preis"), word(430, 120, "Betrag")]
+    top, net_total = 140, 0
+    for position, (name, quantity, price) in enumerate(rows, start=1):
+        net_total += quantity * price
+        for x, text in [(50, str(position)), (80, name), (300, str(quantity))]:
+            words.append(word(x, top, text))
+        words.append(word(360, top, f"{price:.2f}".replace(".", ",")))
+        words.append(word(430, top, f"{quantity * price:.2f}".replace(".", ",")))
+        top += 15
+    tax_total = round(net_total * 0.19, 2)
+    for label, amount in [
+        ("Nettobetrag:", net_total),
+        ("MwSt:", tax_total),
+        ("Gesamtbetrag:", net_total + tax_total),
+    ]:
+        top += 15
+        words += [
+            word(50, top, label),
+            word(430, top, f"{amount:.2f}".replace(".", ",")),
+        ]
+    pages = [{"page": 1, "width": 595, "height": 842, "words": words}]
+    invoice_data = {
+        "header": {"id": invoice_id},
+        "trade": {
+            "settlement": {
+                "monetary_summation": {
+                    "net_total": net_total,
+                    "tax_total": tax_total,
+                    "grand_total": round(net_total + tax_total, 2),
+                }
+            },
+            "items": [
+                {
+                    "line_id": str(position),
+                    "product_name": name,
+                    "quantity": quantity,
+                    "agreement_net_price": price,
+                    "delivery_details": quantity * price,
+                    "settlement_tax": {"category": "S", "rate": 19.0},
+                }
+                for position, (name, quantity, price) in enumerate(rows, start=1)
+            ],
+        },
+    }
+    return pages, invoice_data
+
+
+def test_item_tables_are_read_row_by_row(store):
+    pages, confirmed = table_invoice(
+        "A-100", [("Schrauben", 10, 1.5), ("Muttern", 4, 2.0)]
+    )
+    store.learn(pages, confirmed)
+    store.learn(pages, confirmed)
+
+    rows = [("Bolzen", 3, 5.0), ("Scheiben", 100, 0.1), ("Nieten", 2, 1.0)]
+    pages, _ = table_invoice("A-101", rows)
+    invoice_data = layouts.extract_with_layout(pages)
+
+    assert invoice_data["header"]["id"] == "A-101"
+    items = invoice_data["trade"]["items"]
+    assert [item["product_name"] for item in items] == ["Bolzen", "Scheiben", "Nieten"]
+    assert [item["quantity"] for item in items] == [3, 100, 2]
+    assert [item["settlement_tax"]["rate"] for item in items] == [19.0] * 3
+
+
+def test_only_printed_seller_details_are_constants():
+    pages, invoice_data = table_invoice("R-1", [("Schrauben", 2, 1.5)])
+    invoice_data["trade"]["agreement"] = {"seller": {"name": "Muster GmbH"}}
+    invoice_data["trade"]["settlement"]["payment_means"] = {
+        "payee_account": {"iban_id": "DE02120300000000202051"}
+    }
+
+    template = layouts.learn_template(pages, invoice_data)
+
+    assert template["constants"] == {"trade.agreement.seller.name": "Muster GmbH"}
+
+
+def test_unprinted_constants_are_not_replayed():
+    pages, invoice_data = table_invoice("R-1", [("Schrauben", 2, 1.5)])
+    template = layouts.learn_template(pages, invoice_data)
+    iban = "trade.settlement.payment_means.payee_account.iban_id"
+    template["constants"][iban] = "DE02120300000000202051"
+
+    read, confidence = layouts.extract_with_template(pages, template)
+
+    assert "payment_means" not in read["trade"]["settlement"]
+    assert confidence < 1.0
@@ -0,0 +1,79 @@
+import copy
+from utils import (
+    compile_normalizer,
+    fix_settlement_tax,
+    format_dates,
+    normalize_invoice,
+    remove_nulls,
+    replace_value_in_dict,
+    NORMALIZE_RULES,
+)
+
+ANSWER = {
+    "header": {
+        "id": "2019-03",
+        "leitweg_id": "string",
+        "issue_date_time": "2019-05-08T00:00:00Z",
+        "notes": ["Zahlbar sofort", None],
+    },
+    "trade": {
+        "agreement": {
+            "seller": {"name": "Kraxi GmbH", "tax_id": "321/312/54321"},
+            "buyer": {"name": "Papierflieger GmbH", "order_id": "ABC-123"},
+        },
+        "settlement": {"payment_reference": None, "currency_code": "EUR"},
+        "items": [
+            {
+                "line_id": "1",
+                "delivery_details": 40.0,
+                "settlement_tax": {"category": "S", "rate": 19.0},
+                "period_end": None,
+            },
+            {"line_id": "2", "delivery_details": 200.0, "settlement_tax": {}},
+        ],
+    },
+}
+
+
+def chained(data):
+    data = replace_value_in_dict(data, "leitweg_id", "LEITWEGID-12345ABCXYZ-00", 0)
+    data = replace_value_in_dict(data, "leitweg_id", "string", 0)
+    data = replace_value_in_dict(data, "tax_id", "321/312/54321", None)
+    data = replace_value_in_dict(data, "order_id", "SELLER-2019-0789", None)
+    data = replace_value_in_dict(data, "order_id", "BUYER-2019-0789", None)
+    data = remove_nulls(data)
+    data = format_dates(data)
+    return fix_settlement_tax(data)
+
+
+def test_same_result_as_the_chained_passes():
+    assert normalize_invoice(copy.deepcopy(ANSWER)) == chained(copy.deepcopy(ANSWER))
+
+
+def test_rules_are_applied():
+    invoice = normalize_invoice(copy.deepcopy(ANSWER))
+
+    assert invoice["header"]["leitweg_id"] == 0
+    assert invoice["header"]["issue_date_time"] == "2019-05-08"
+    assert invoice["header"]["notes"] == ["Zahlbar sofort", None]
+    assert "tax_id" not in invoice["trade"]["agreement"]["seller"]
+    assert invoice["trade"]["agreement"]["buyer"]["order_id"] == "ABC-123"
+    assert "payment_reference" not in invoice["trade"]["settlement"]
+    first, second = invoice["trade"]["items"]
+    assert first["settlement_tax"]["amount"] == 7.6
+    assert first["total_amount"] == 47.6
+    assert "period_end" not in first
+    assert second["total_amount"] == 200.0
+
+
+def test_only_the_configured_items_are_taxed():
+    normalize = compile_normalizer({**NORMALIZE_RULES, "line_items": ("positions",)})
+    invoice = normalize(
+        {
+            "positions": [{"delivery_details": 10.0, "settlement_tax": {"rate": 7}}],
+            "trade": {"items": [{"delivery_details": 10.0}]},
+        }
+    )
+
+    assert invoice["positions"][0]["total_amount"] == 10.7
+    assert "total_amount" not in invoice["trade"]["items"][0]
@@ -0,0 +1,88 @@
+import threading
+import ocr
+
+
+class FakeReader:
+    def __init__(self, languages):
+        self.languages = languages
+
+    def readtext(self, image, **kwargs):
+        return [([], f"{image} {','.join(self.languages)}", 0.9)]
+
+
+def test_reader_registry_loads_once_and_evicts(monkeypatch):
+    monkeypatch.setattr(ocr.easyocr, "Reader", FakeReader)
+    monkeypatch.setattr(ocr, "OCR_MAX_READERS", 2)
+    monkeypatch.setattr(ocr, "_readers", ocr.OrderedDict())
+    monkeypatch.setattr(ocr, "_metrics", dict.fromkeys(ocr._metrics, 0))
+
+    threads = [
+        threading.Thread(target=ocr.readtext, args=("page", ["de"])) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert ocr.readtext("page", "en") == [([], "page en", 0.9)]
+    ocr.get_reader(["en", "de"])
+
+    stats = ocr.ocr_stats()
+    assert stats["loads"] == 3
+    assert stats["inferences"] == 9
+    assert stats["evictions"] == 1
+    assert stats["readers"] == ["en", "de,en"]
+
+
+def test_rasterize_pages_renders_one_page_at_a_time(monkeypatch):
+    rendered = []
+
+    def fake_convert_from_path(path, dpi, grayscale, first_page, last_page):
+        assert first_page == last_page
+        assert (dpi, grayscale) == (150, True)
+        # The previous page must be released before the next one is rendered
+        assert all(image.closed for image in rendered)
+        image = FakeImage(first_page)
+        rendered.append(image)
+        return [image]
+
+    class FakeImage:
+        def __init__(self, page):
+            self.page = page
+            self.closed = False
+
+        def __array__(self, dtype=None, copy=None):
+            return ocr.np.full((2, 2), self.page, dtype="uint8")
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(ocr, "convert_from_path", fake_convert_from_path)
+    pages = ocr.rasterize_pages("invoice.pdf", [1, 2, 3], dpi=150, grayscale=True)
+    for page_number, pixels in pages:
+        assert pixels.shape == (2, 2)
+        assert pixels[0, 0] == page_number
+    assert len(rendered) == 3
+
+
+def test_pool_workers_report_their_metrics(monkeypatch):
+    monkeypatch.setattr(ocr.easyocr, "Reader", FakeReader)
+    monkeypatch.setattr(ocr, "_readers", ocr.OrderedDict())
+    monkeypatch.setattr(ocr, "_metrics", dict.fromkeys(ocr._metrics, 0))
+    monkeypatch.setattr(ocr, "_worker_memory", {})
+    monkeypatch.setattr(
+        ocr, "rasterize_pages", lambda path, pages: ((page, "pixels") for page in pages)
+    )
+
+    # What a pool worker sends back with its page
+    page = ocr.ocr_page_in_worker("invoice.pdf", 2, "de")
+    report = page.pop("worker")
+    assert page["text"] == "pixels de"
+    assert report["metrics"]["loads"] == report["metrics"]["inferences"] == 1
+
+    # The parent counts it as if the page had been recognized in-process
+    monkeypatch.setattr(ocr, "_metrics", dict.fromkeys(ocr._metrics, 0))
+    ocr.merge_worker_metrics(dict(report, memory=64 * 1024 * 1024))
+    stats = ocr.ocr_stats()
+    assert (stats["loads"], stats["inferences"]) == (1, 1)
+    assert stats["worker_memory_mb"] == 64.0
@@ -0,0 +1,112 @@
+import json
+import asyncio
+import httpx
+import pytest
+import ollama_integration
+from stream_parser import MalformedOutput
+from utils import PROMPT
+
+INVOICE = '{"header": {"id": "1"}, "trade": {"items": []}}'
+
+
+def ndjson_response(chunks, **final):
+    lines = [{"response": chunk, "done": False} for chunk in chunks]
+    lines.append({"response": "", "done": True, **final})
+    body = "\n".join(json.dumps(line) for line in lines) + "\n"
+    return httpx.Response(200, content=body.encode())
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    """Swaps the pooled client for one whose transport calls ``handler``."""
+    fake = {"handler": None, "payloads": []}
+
+    async def dispatch(request):
+        payload = json.loads(request.content)
+        fake["payloads"].append(payload)
+        return await fake["handler"](payload)
+
+    class FakeClient(ollama_integration.OllamaClient):
+        async def setup(self):
+            await super().setup()
+            self.http = httpx.AsyncClient(transport=httpx.MockTransport(dispatch))
+
+    monkeypatch.setattr(ollama_integration, "client", FakeClient())
+    return fake
+
+
+def test_repeated_invoices_send_the_same_request(fake_ollama):
+    async def echo(payload):
+        # Answers depend on everything the model is given
+        answer = json.loads(INVOICE)
+        answer["header"]["id"] = str(hash(json.dumps(payload, sort_keys=True)))
+        return ndjson_response([json.dumps(answer)])
+
+    fake_ollama["handler"] = echo
+
+    answers = [ollama_integration.process_with_ollama("Rechnung 1") for _ in range(3)]
+    uncached = ollama_integration.client.run(
+        ollama_integration.query_ollama(
+            ollama_integration.OLLAMA_MODEL, f"{PROMPT} Rechnung 1"
+        )
+    )
+
+    assert answers == [ollama_integration.normalize_invoice(uncached)] * 3
+    payloads = fake_ollama["payloads"]
+    assert all(payload["prompt"] == f"{PROMPT} Rechnung 1" for payload in payloads)
+    assert all("context" not in payload for payload in payloads)
+    assert all(payload["keep_alive"] == "30m" for payload in payloads)
+
+
+def test_stream_stops_after_the_invoice(fake_ollama):
+    async def padded(payload):
+        # Trailing whitespace would otherwise run until num_predict is reached
+        return ndjson_response([INVOICE] + ["\n"] * 50 + ["garbage"])
+
+    fake_ollama["handler"] = padded
+    assert ollama_integration.client.run(
+        ollama_integration.query_ollama("llama3.1", "Rechnung")
+    ) == json.loads(INVOICE)
+
+
+def test_malformed_output_aborts_the_stream(fake_ollama):
+    sent = []
+
+    async def chunks():
+        for chunk in ['{"header": ', '{"id": 17', "}", ' "trade": {}}']:
+            sent.append(chunk)
+            yield json.dumps({"response": chunk, "done": False}).encode() + b"\n"
+
+    async def malformed(payload):
+        return httpx.Response(200, content=chunks())
+
+    fake_ollama["handler"] = malformed
+    aborted = ollama_integration._stats["aborted"]
+    with pytest.raises(MalformedOutput, match="header.id"):
+        ollama_integration.client.run(
+            ollama_integration.query_ollama("llama3.1", "Rechnung")
+        )
+    assert len(sent) == 3
+    assert ollama_integration._stats["aborted"] == aborted + 1
+
+
+def test_requests_are_limited_to_the_parallel_slots(monkeypatch, fake_ollama):
+    monkeypatch.setattr(ollama_integration, "OLLAMA_NUM_PARALLEL", 2)
+    running = {"now": 0, "max": 0}
+
+    async def slow(payload):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        return ndjson_response([INVOICE])
+
+    fake_ollama["handler"] = slow
+
+    async def many():
+        return await asyncio.gather(
+            *(ollama_integration.query_ollama("llama3.1", str(i)) for i in range(6))
+        )
+
+    assert len(ollama_integration.client.run(many())) == 6
+    assert running["max"] == 2
@@ -0,0 +1,36 @@
+import json
+import pytest
+from stream_parser import MalformedOutput, SchemaStreamParser
+
+INVOICE = {
+    "header": {"id": "RE-1", "name": 'GmbH & Co. "Rechnung"', "notes": []},
+    "trade": {"items": [{"quantity": 2, "price": 9.5}]},
+    "sales_order_number": None,
+}
+
+
+@pytest.mark.parametrize("size", [1, 3, 17])
+def test_chunked_output_is_parsed(size):
+    text = json.dumps(INVOICE, ensure_ascii=False) + "\n\n  "
+    parser = SchemaStreamParser()
+    for i in range(0, len(text), size):
+        parser.feed(text[i : i + size])
+    assert parser.done
+    assert parser.result() == INVOICE
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        'Here is the invoice: {"header": {}}',
+        '{"header": [',
+        '{"header": {"id": 17,',
+        '{"header": {} "trade"',
+        '{"trade": {}}',
+        '{"header": {"notes": "none"',
+        '{"header": {"id": null, "notes": tru}',
+    ],
+)
+def test_malformed_output_is_rejected_early(output):
+    with pytest.raises(MalformedOutput):
+        SchemaStreamParser().feed(output)
@@ -0,0 +1,36 @@
+import pytest
+import pdf_parser
+from pdf_parser import extract_pages_from_pdf, is_usable_text_layer
+
+
+@pytest.mark.parametrize(
+    "text, usable",
+    [
+        ("", False),
+        ("Seite 1", False),
+        ("Rechnungsnummer: 2019-03", True),
+        ("(cid:12)(cid:7)(cid:99)(cid:3) Rechnungsnummer 2019-03", False),
+        ("Rechnung\x00\x01\x02\x03\x04\x05\x06\x07\x08", False),
+    ],
+)
+def test_text_layer_quality(text, usable):
+    assert is_usable_text_layer(text) == usable
+
+
+def test_pages_are_routed_individually(monkeypatch):
+    requested = []
+
+    def fake_ocr_pages(pdf_file_path, page_numbers, language):
+        requested.extend(page_numbers)
+        return [{"page": n, "text": "ocr", "seconds": 1.0} for n in page_numbers]
+
+    monkeypatch.setattr(pdf_parser, "ocr_pages", fake_ocr_pages)
+
+    pages = extract_pages_from_pdf("tests/samples/output.pdf")
+    assert [page["source"] for page in pages] == ["text", "text"]
+    assert requested == []
+
+    pages = extract_pages_from_pdf("tests/samples/example-invoice-scanned.pdf")
+    assert [(page["source"], page["text"]) for page in pages] == [("ocr", "ocr")]
+    assert pages[0]["seconds"] >= 1.0
+    assert requested == [1]
@@ -0,0 +1,109 @@
+import io
+import asyncio
+import hashlib
+import shutil
+import pytest
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+from uploads import (
+    UploadLimitMiddleware,
+    UploadTooLarge,
+    check_page_budget,
+    save_upload,
+)
+
+PDF = open("tests/samples/output.pdf", "rb").read()
+
+
+def test_upload_is_saved_and_hashed_in_chunks(tmp_path):
+    path = tmp_path / "invoice.pdf"
+    upload = UploadFile(io.BytesIO(PDF), filename="invoice.pdf")
+
+    pdf_hash, size = asyncio.run(save_upload(upload, path, chunk_size=1000))
+
+    assert path.read_bytes() == PDF
+    assert pdf_hash == hashlib.sha256(PDF).hexdigest()
+    assert size == len(PDF)
+
+
+def test_too_large_upload_is_removed(tmp_path):
+    path = tmp_path / "invoice.pdf"
+    upload = UploadFile(io.BytesIO(PDF), filename="invoice.pdf")
+
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(save_upload(upload, path, max_bytes=5000, chunk_size=1000))
+    assert not path.exists()
+
+
+def test_page_budget(tmp_path):
+    path = tmp_path / "invoice.pdf"
+    shutil.copyfile("tests/samples/output.pdf", path)
+
+    assert check_page_budget(path, max_pages=2) == 2
+    with pytest.raises(UploadTooLarge):
+        check_page_budget(path, max_pages=1)
+    assert not path.exists()
+
+
+@pytest.fixture
+def limited_client():
+    received = []
+    app = FastAPI()
+    app.add_middleware(UploadLimitMiddleware, max_bytes=5000)
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        received.append(await file.read())
+        return {"size": len(received[-1])}
+
+    return TestClient(app), received
+
+
+def test_announced_large_body_is_refused(limited_client):
+    client, received = limited_client
+
+    response = client.post("/upload", files={"file": ("invoice.pdf", PDF)})
+
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_chunked_large_body_is_stopped(limited_client):
+    client, received = limited_client
+
+    def body():
+        # No Content-Length, the middleware counts the chunks
+        for start in range(0, len(PDF), 1000):
+            yield PDF[start : start + 1000]
+
+    response = client.post(
+        "/upload",
+        content=body(),
+        headers={"Content-Type": "multipart/form-data; boundary=x"},
+    )
+
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_small_body_passes(limited_client):
+    client, received = limited_client
+
+    response = client.post("/upload", files={"file": ("invoice.pdf", b"%PDF-1.4")})
+
+    assert response.json() == {"size": 8}
+
+
+def test_cii_uploads_are_limited():
+    app = FastAPI()
+    app.add_middleware(UploadLimitMiddleware, max_bytes=5000)
+
+    @app.post("/convert/cii")
+    async def convert(file: UploadFile = File(...)):
+        return {"size": len(await file.read())}
+
+    response = TestClient(app).post(
+        "/convert/cii", files={"file": ("invoice.xml", b"<a/>" * 5000)}
+    )
+
+    assert response.status_code == 413
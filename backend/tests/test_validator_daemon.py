@@ -0,0 +1,68 @@
+import time
+import threading
+import subprocess
+import pytest
+import validate
+from validate import ValidatorDaemon
+
+
+@pytest.fixture
+def daemon_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(validate, "VALIDATOR_LOCK_FILE", tmp_path / ".daemon.lock")
+    monkeypatch.setattr(validate, "VALIDATOR_PID_FILE", tmp_path / ".daemon.pid")
+    return tmp_path
+
+
+def unused_daemon():
+    # Nothing listens on port 9, the health check always fails
+    return ValidatorDaemon(port=9)
+
+
+def test_starting_daemon_is_not_replaced(daemon_files):
+    process = subprocess.Popen(["sleep", "30"])
+    try:
+        validate.VALIDATOR_PID_FILE.write_text(f"{process.pid} {time.time()}")
+
+        assert unused_daemon().spawn() is False
+        assert process.poll() is None
+    finally:
+        process.kill()
+        process.wait()
+
+
+def test_spawn_holds_the_lock_until_the_daemon_is_healthy(daemon_files, monkeypatch):
+    owner = unused_daemon()
+    monkeypatch.setattr(owner, "command", lambda: ["sleep", "30"])
+    ready = threading.Event()
+    monkeypatch.setattr(owner, "check_health", lambda: ready.is_set())
+    spawning = threading.Thread(target=owner.spawn)
+    spawning.start()
+    try:
+        while owner.process is None:
+            time.sleep(0.05)
+
+        # Another worker finds the lock taken and leaves the new JVM alone
+        assert unused_daemon().spawn() is False
+        assert owner.process.poll() is None
+
+        ready.set()
+        spawning.join(timeout=5)
+        assert not spawning.is_alive()
+    finally:
+        owner.process.kill()
+        owner.process.wait()
+
+
+def test_busy_validator_result_has_the_usual_keys(monkeypatch):
+    def busy(xml_file, upload_folder):
+        raise validate.ValidatorBusy("Validator queue is full")
+
+    monkeypatch.setattr(validate, "VALIDATION_CACHE", False)
+    monkeypatch.setattr(validate.validator_daemon, "healthy", True)
+    monkeypatch.setattr(validate.validator_daemon, "validate", busy)
+
+    assert validate.validate("tests/output_invoice.xml") == {
+        "return_code": -3,
+        "message": "Validation failed",
+        "description": "Validator queue is full",
+    }
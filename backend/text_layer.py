@@ -0,0 +1,75 @@
+import os
+import re
+import time
+from pdfplumber import open as open_pdf
+
+# Kept apart from pdf_parser so CPU pool workers import only pdfplumber
+
+CID_PATTERN = re.compile(r"\(cid:\d+\)")
+# Text layers below these limits are treated as missing and the page is OCR'd
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "8"))
+TEXT_LAYER_MAX_CID_RATIO = 0.05
+TEXT_LAYER_MIN_PRINTABLE_RATIO = 0.9
+
+
+def is_usable_text_layer(text):
+    """Check whether a page's text layer is real text and not glyph garbage."""
+    if not text:
+        return False
+
+    # Unmapped glyphs come out as "(cid:NN)" runs
+    cid_chars = sum(len(match) for match in CID_PATTERN.findall(text))
+    if cid_chars / len(text) > TEXT_LAYER_MAX_CID_RATIO:
+        return False
+
+    text = CID_PATTERN.sub("", text)
+    if sum(char.isalnum() for char in text) < TEXT_LAYER_MIN_CHARS:
+        return False
+    printable = sum(char.isprintable() or char.isspace() for char in text)
+    return printable / len(text) >= TEXT_LAYER_MIN_PRINTABLE_RATIO
+
+
+def read_text_layers(pdf_file_path: str) -> list:
+    """Read the text layer of every page, marking pages that need OCR."""
+    pages = []
+    with open_pdf(pdf_file_path) as pdf:
+        for page_number, page in enumerate(pdf.pages, start=1):
+            start_time = time.perf_counter()
+            text = page.extract_text() or ""
+            usable = is_usable_text_layer(text)
+            pages.append(
+                {
+                    "page": page_number,
+                    "source": "text" if usable else "ocr",
+                    "text": text if usable else "",
+                    "seconds": time.perf_counter() - start_time,
+                }
+            )
+            page.close()
+    return pages
+
+
+def read_words(pdf_file_path: str) -> list:
+    """Read the positioned words of every page, for layout templates."""
+    pages = []
+    with open_pdf(pdf_file_path) as pdf:
+        for page_number, page in enumerate(pdf.pages, start=1):
+            words = [
+                {
+                    "x0": round(word["x0"], 1),
+                    "x1": round(word["x1"], 1),
+                    "top": round(word["top"], 1),
+                    "text": word["text"],
+                }
+                for word in page.extract_words()
+            ]
+            pages.append(
+                {
+                    "page": page_number,
+                    "width": round(page.width),
+                    "height": round(page.height),
+                    "words": words,
+                }
+            )
+            page.close()
+    return pages
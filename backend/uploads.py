@@ -0,0 +1,125 @@
+import os
+import hashlib
+import logging
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pypdf import PdfReader
+from executors import run_in_thread
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+# Uploads are copied to disk in chunks of this size, never read whole
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Larger uploads are refused with 413 while they arrive
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(64 * 1024 * 1024)))
+# PDFs with more pages are refused before any extraction starts
+UPLOAD_MAX_PAGES = int(os.getenv("UPLOAD_MAX_PAGES", "200"))
+# Room for the multipart boundaries and headers around the PDF
+MULTIPART_OVERHEAD = 64 * 1024
+UPLOAD_PATHS = {"/upload", "/autoconvert", "/jobs", "/convert/cii", "/batch"}
+# A batch carries many PDFs or ZIP archives in one body
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Paths with their own limit instead of UPLOAD_MAX_BYTES
+UPLOAD_LIMITS = {"/batch": BATCH_MAX_BYTES}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadLimitMiddleware:
+    """Refuses upload bodies over ``max_bytes`` before they are read.
+
+    A body announcing a larger Content-Length is answered right away, any
+    other is counted as it arrives and stopped once it passes the limit.
+    """
+
+    def __init__(
+        self,
+        app,
+        max_bytes=UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD,
+        paths=UPLOAD_PATHS,
+        limits=UPLOAD_LIMITS,
+    ):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = self.max_bytes
+        limit = UPLOAD_MAX_BYTES
+        if scope["path"] in self.limits:
+            limit = self.limits[scope["path"]]
+            max_bytes = limit + MULTIPART_OVERHEAD
+        detail = f"Uploads are limited to {limit} bytes"
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                # FastAPI passes HTTPExceptions of the body parsing through
+                raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+async def save_upload(
+    file, path, max_bytes=UPLOAD_MAX_BYTES, chunk_size=UPLOAD_CHUNK_SIZE
+):
+    """Copy the ``UploadFile`` to ``path`` chunk by chunk.
+
+    Returns the SHA-256 of the content, hashed on the way, and its size.
+    Raises ``UploadTooLarge`` past ``max_bytes`` and removes the partial file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    output = await run_in_thread(open, path, "wb")
+    try:
+        while chunk := await file.read(chunk_size):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Uploads are limited to {max_bytes} bytes")
+            digest.update(chunk)
+            await run_in_thread(output.write, chunk)
+    except BaseException:
+        output.close()
+        await run_in_thread(os.remove, path)
+        raise
+    output.close()
+    return digest.hexdigest(), size
+
+
+def page_count(path):
+    """Pages declared by the PDF at ``path``, ``None`` if it cannot be read."""
+    try:
+        with open(path, "rb") as f:
+            return int(PdfReader(f).root_object["/Pages"]["/Count"])
+    except Exception as e:
+        logging.warning(f"Could not count the pages of {path}: {e}")
+        return None
+
+
+def check_page_budget(path, max_pages=UPLOAD_MAX_PAGES):
+    """Raise ``UploadTooLarge`` and remove ``path`` if it has too many pages."""
+    pages = page_count(path)
+    if pages is not None and pages > max_pages:
+        os.remove(path)
+        raise UploadTooLarge(f"PDFs are limited to {max_pages} pages, got {pages}")
+    return pages
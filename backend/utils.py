@@ -1,5 +1,6 @@
 import re
-from schemas import Invoice
+import hashlib
+from schemas import Invoice, ItemPage
 
 
 # Function to recursively remove keys with None values
@@ -27,19 +28,23 @@ def format_dates(obj):
         return obj
 
 
+def line_tax(item):
+    delivery = item.get("delivery_details", 0)
+    tax_info = item.get("settlement_tax", {})
+    rate = tax_info.get("rate", 0)
+
+    # Calculate amount as rate percent of delivery_details
+    tax_amount = round((delivery * rate) / 100, 2)
+    tax_info["amount"] = tax_amount
+
+    # Calculate total amount
+    item["total_amount"] = round(delivery + tax_amount, 2)
+
+
 def fix_settlement_tax(data):
     trade = data.get("trade", {})
     for item in trade.get("items", []):
-        delivery = item.get("delivery_details", 0)
-        tax_info = item.get("settlement_tax", {})
-        rate = tax_info.get("rate", 0)
-
-        # Calculate amount as rate percent of delivery_details
-        tax_amount = round((delivery * rate) / 100, 2)
-        tax_info["amount"] = tax_amount
-
-        # Calculate total amount
-        item["total_amount"] = round(delivery + tax_amount, 2)
+        line_tax(item)
 
     return data
 
@@ -60,6 +65,69 @@ def replace_value_in_dict(data, target_key, target_value, replacement_value):
     return data
 
 
+ISO_DATETIME = re.compile(r"(\d{4}-\d{2}-\d{2})T\d{2}:\d{2}:\d{2}Z")
+
+# Post-processing of every provider answer, see ``normalize_invoice``
+NORMALIZE_RULES = {
+    # Values copied from the example output instead of read from the invoice,
+    # per key placeholder -> replacement, None drops the key
+    "placeholders": {
+        "leitweg_id": {"LEITWEGID-12345ABCXYZ-00": 0, "string": 0},
+        "tax_id": {"321/312/54321": None},
+        "order_id": {"SELLER-2019-0789": None, "BUYER-2019-0789": None},
+    },
+    # List of line items whose tax amount and total are recomputed
+    "line_items": ("trade", "items"),
+}
+
+
+def compile_normalizer(rules):
+    """Build a function applying ``rules`` in one walk over an invoice dict.
+
+    It does what ``replace_value_in_dict`` per placeholder, ``remove_nulls``,
+    ``format_dates`` and ``fix_settlement_tax`` do one after another, but
+    visits every value once and builds the result as it goes.
+    """
+    placeholders = rules["placeholders"]
+    items_path = rules["line_items"]
+
+    def walk(obj, depth):
+        # ``depth`` counts the keys of ``items_path`` leading here, -1 if off it
+        if isinstance(obj, dict):
+            on_path = 0 <= depth < len(items_path)
+            result = {}
+            for key, value in obj.items():
+                replacements = placeholders.get(key)
+                if replacements and isinstance(value, str) and value in replacements:
+                    value = replacements[value]
+                if value is None:
+                    continue
+                child = depth + 1 if on_path and key == items_path[depth] else -1
+                result[key] = walk(value, child)
+            return result
+        if isinstance(obj, list):
+            result = [walk(value, -1) for value in obj]
+            if depth == len(items_path):
+                for item in result:
+                    if isinstance(item, dict):
+                        line_tax(item)
+            return result
+        # Cheap test first, the regex only runs on "yyyy-mm-ddThh:mm:ssZ"
+        if isinstance(obj, str) and len(obj) == 20 and obj[10] == "T":
+            match = ISO_DATETIME.fullmatch(obj)
+            if match:
+                return match.group(1)
+        return obj
+
+    def normalize(data):
+        return walk(data, 0)
+
+    return normalize
+
+
+normalize_invoice = compile_normalizer(NORMALIZE_RULES)
+
+
 EXAMPLE_JSON = """
 ```
 {
@@ -359,3 +427,30 @@ Here is an example of the expected output format:
 Now extract the data from the attached invoice pdf file.
 For extraction support the following plain text was extracted from the attached pdf:
 """
+
+# Line items of a few pages of a long invoice, header and totals are read apart
+ITEMS_PROMPT = f"""
+You are a highly skilled document processing AI.
+
+Your task is to extract the invoice line items from raw text of some pages of a long invoice. Return them as a single **valid JSON object** using the **exact key names and structure** defined in the following schema:
+
+```json
+{ItemPage.model_json_schema()}
+```
+
+Instructions:
+  - Extract every line item on these pages, in the order they appear.
+  - Ignore headers, addresses, subtotals, carried forward amounts and totals.
+  - Keep the line ids exactly as printed on the invoice.
+  - Preserve all numerical values exactly as they appear (do not reformat).
+  - Use null if data of an item is missing.
+  - All the dates should be in the format "yyyy-mm-dd".
+  - Your entire output should be a valid JSON object only.
+
+Now extract the line items from the following pages:
+"""
+
+# Changes whenever one of the prompts or the schemas embedded in them changes
+PROMPT_VERSION = hashlib.sha256((PROMPT + ITEMS_PROMPT).encode("utf-8")).hexdigest()[
+    :12
+]
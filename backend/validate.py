@@ -1,57 +1,421 @@
+import os
+import time
+import fcntl
+import shutil
+import signal
 import logging
+import threading
 import subprocess
+import requests
+import xml.etree.ElementTree as ET
 from pathlib import Path
+from cache import DiskCache, content_hash, file_hash
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     level=logging.INFO,
 )
 
+JAR_PATH = "validator/validationtool-1.5.0-standalone.jar"
+SCENARIOS_FILE = "validator/scenarios.xml"
+REPOSITORY_DIRECTORY = Path.cwd() / "validator/"
 
-def validate(xml_file, upload_folder=Path("./uploads")):
-    jar_path = "validator/validationtool-1.5.0-standalone.jar"
-    scenarios_file = "validator/scenarios.xml"
-    output_directory = Path.cwd() / "validator/"
+# Long-lived validator daemon shared by all uvicorn workers on this host
+VALIDATOR_DAEMON = os.getenv("VALIDATOR_DAEMON", "1") == "1"
+VALIDATOR_HOST = os.getenv("VALIDATOR_HOST", "127.0.0.1")
+VALIDATOR_PORT = int(os.getenv("VALIDATOR_PORT", "8081"))
+VALIDATOR_THREADS = int(os.getenv("VALIDATOR_THREADS", "4"))
+VALIDATOR_QUEUE_SIZE = int(os.getenv("VALIDATOR_QUEUE_SIZE", "32"))
+VALIDATOR_QUEUE_TIMEOUT = float(os.getenv("VALIDATOR_QUEUE_TIMEOUT", "60"))
+VALIDATOR_REQUEST_TIMEOUT = float(os.getenv("VALIDATOR_REQUEST_TIMEOUT", "120"))
+VALIDATOR_HEALTH_INTERVAL = float(os.getenv("VALIDATOR_HEALTH_INTERVAL", "10"))
+# A freshly spawned JVM needs a while to load the scenarios, nobody kills or
+# replaces it before it answered /server/health or this many seconds passed
+VALIDATOR_STARTUP_TIMEOUT = float(os.getenv("VALIDATOR_STARTUP_TIMEOUT", "120"))
+VALIDATOR_LOCK_FILE = REPOSITORY_DIRECTORY / ".daemon.lock"
+VALIDATOR_PID_FILE = REPOSITORY_DIRECTORY / ".daemon.pid"
+
+# Validation results keyed on the XML content and the validator version
+VALIDATION_CACHE = os.getenv("VALIDATION_CACHE", "1") == "1"
+VALIDATION_CACHE_DIR = os.getenv("VALIDATION_CACHE_DIR", "./uploads/.cache/validation")
+VALIDATION_CACHE_MAX_ENTRIES = int(os.getenv("VALIDATION_CACHE_MAX_ENTRIES", "5000"))
+VALIDATION_CACHE_TTL = int(os.getenv("VALIDATION_CACHE_TTL", str(7 * 24 * 3600)))
+
+XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
+
+
+def describe(return_code):
+    response = {"return_code": return_code, "message": "Validation completed"}
+
+    if return_code == 0:
+        response["description"] = (
+            "XRechnung is valid according to KoSIT Validator 1.5.0."
+        )
+    elif return_code > 0:
+        response["description"] = (
+            "XRechnung file is invalid according to KoSIT Validator 1.5.0."
+        )
+    elif return_code == -1:
+        response["description"] = "Parsing error: Incorrect command-line arguments."
+    elif return_code == -2:
+        response["description"] = (
+            "Configuration error: Issues with loading configuration/validation targets."
+        )
+    else:
+        response["description"] = "Unknown error."
+    return response
+
+
+def failure(return_code, description):
+    """A result for a validation that could not run, with the usual keys."""
+    return {
+        "return_code": return_code,
+        "message": "Validation failed",
+        "description": description,
+    }
+
+
+class ValidatorBusy(Exception):
+    pass
+
+
+class ValidatorDaemon:
+    """Warm KoSIT validator JVM running in daemon mode (``-D``).
+
+    Every uvicorn worker holds one of these handles, but only the worker that
+    wins the lock file spawns the JVM; the others talk to the same port. A
+    background thread polls the health endpoint and respawns the daemon after
+    a crash, but leaves a daemon alone while it is still starting up. Requests are bounded per worker: at most ``VALIDATOR_THREADS`` in
+    flight and ``VALIDATOR_QUEUE_SIZE`` waiting, everything beyond is rejected.
+    """
+
+    def __init__(
+        self,
+        host=VALIDATOR_HOST,
+        port=VALIDATOR_PORT,
+        threads=VALIDATOR_THREADS,
+        queue_size=VALIDATOR_QUEUE_SIZE,
+    ):
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.queue_size = queue_size
+        self.url = f"http://{host}:{port}"
+        self.process = None
+        self.session = requests.Session()
+        self.slots = threading.BoundedSemaphore(threads)
+        self.waiting = 0
+        self.waiting_lock = threading.Lock()
+        self.healthy = False
+        self.stopped = threading.Event()
+        self.monitor = None
+
+    def command(self):
+        return [
+            "java",
+            "-jar",
+            JAR_PATH,
+            "-s",
+            SCENARIOS_FILE,
+            "-r",
+            str(REPOSITORY_DIRECTORY),
+            "-D",
+            "-H",
+            self.host,
+            "-P",
+            str(self.port),
+            "-T",
+            str(self.threads),
+        ]
 
+    def check_health(self):
+        try:
+            response = self.session.get(f"{self.url}/server/health", timeout=2)
+            self.healthy = response.status_code == 200
+        except requests.RequestException:
+            self.healthy = False
+        return self.healthy
+
+    def spawn(self):
+        """Start the JVM unless another worker already holds the lock.
+
+        The lock is held until the new daemon is healthy or
+        ``VALIDATOR_STARTUP_TIMEOUT`` passed, so the other workers wait for it
+        instead of killing it half-started.
+        """
+        with open(VALIDATOR_LOCK_FILE, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                # Someone may have restarted it while we were waiting
+                if self.check_health():
+                    return False
+                # A daemon whose owner died during its startup gets its window too
+                if self.starting():
+                    return False
+                self.kill_stale()
+                logging.info(f"Starting KoSIT validator daemon on {self.url} ...")
+                self.process = subprocess.Popen(
+                    self.command(),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+                VALIDATOR_PID_FILE.write_text(f"{self.process.pid} {time.time()}")
+                self.wait_until_healthy()
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def wait_until_healthy(self, timeout=VALIDATOR_STARTUP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not self.stopped.is_set() and time.monotonic() < deadline:
+            if self.check_health():
+                logging.info("KoSIT validator daemon is up")
+                return True
+            if self.process.poll() is not None:
+                logging.warning(
+                    f"Validator daemon exited during startup ({self.process.returncode})"
+                )
+                return False
+            self.stopped.wait(1)
+        logging.warning(f"Validator daemon did not come up within {timeout} seconds")
+        return False
+
+    def recorded_daemon(self):
+        """``(pid, started_at)`` of the last spawned daemon, ``None`` if unknown."""
+        try:
+            pid, started_at = VALIDATOR_PID_FILE.read_text().split()
+            return int(pid), float(started_at)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def starting(self):
+        """Whether the recorded daemon is alive and still within its startup."""
+        recorded = self.recorded_daemon()
+        if recorded is None:
+            return False
+        pid, started_at = recorded
+        if time.time() - started_at >= VALIDATOR_STARTUP_TIMEOUT:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def kill_stale(self):
+        """Kill a hung daemon left behind by a previous (crashed) owner."""
+        recorded = self.recorded_daemon()
+        if recorded is None:
+            return
+        pid = recorded[0]
+        try:
+            os.kill(pid, signal.SIGKILL)
+            logging.warning(f"Killed unresponsive validator daemon (pid {pid})")
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def watch(self):
+        while not self.stopped.is_set():
+            if not self.check_health():
+                self.spawn()
+            self.stopped.wait(VALIDATOR_HEALTH_INTERVAL)
+
+    def start(self):
+        if self.monitor is not None and self.monitor.is_alive():
+            return
+        self.stopped.clear()
+        self.monitor = threading.Thread(
+            target=self.watch, name="validator-daemon-monitor", daemon=True
+        )
+        self.monitor.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.process is not None and self.process.poll() is None:
+            logging.info("Stopping KoSIT validator daemon ...")
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def acquire(self):
+        with self.waiting_lock:
+            if self.waiting >= self.queue_size:
+                raise ValidatorBusy("Validator queue is full")
+            self.waiting += 1
+        try:
+            if not self.slots.acquire(timeout=VALIDATOR_QUEUE_TIMEOUT):
+                raise ValidatorBusy("Timed out waiting for a validator slot")
+        finally:
+            with self.waiting_lock:
+                self.waiting -= 1
+
+    def validate(self, xml_file, upload_folder):
+        xml_file = Path(xml_file)
+        self.acquire()
+        try:
+            response = self.session.post(
+                f"{self.url}/",
+                data=xml_file.read_bytes(),
+                headers={"Content-Type": "application/xml"},
+                timeout=VALIDATOR_REQUEST_TIMEOUT,
+            )
+        finally:
+            self.slots.release()
+
+        # 200: acceptable, 406: not acceptable, 422: document could not be processed
+        if response.status_code == 200:
+            return_code = 0
+        elif response.status_code in (406, 422):
+            return_code = 1
+        else:
+            raise requests.HTTPError(
+                f"Validator daemon answered {response.status_code}", response=response
+            )
+
+        report_xml = Path(upload_folder) / f"{xml_file.stem}-report.xml"
+        report_xml.write_bytes(response.content)
+        write_html_report(response.content, report_xml.with_suffix(".html"))
+        return return_code
+
+
+def write_html_report(report, html_file):
+    """Extract the embedded XHTML from the report, like the CLI's ``-h`` flag."""
+    root = ET.fromstring(report)
+    html = root.find(f".//{{{XHTML_NAMESPACE}}}html")
+    if html is None:
+        return
+    ET.register_namespace("", XHTML_NAMESPACE)
+    html_file.write_text(ET.tostring(html, encoding="unicode"))
+
+
+validator_daemon = ValidatorDaemon()
+validation_cache = DiskCache(
+    VALIDATION_CACHE_DIR,
+    max_entries=VALIDATION_CACHE_MAX_ENTRIES,
+    ttl=VALIDATION_CACHE_TTL,
+)
+_fingerprint = {}
+
+
+def start_validator_daemon():
+    if VALIDATOR_DAEMON:
+        validator_daemon.start()
+
+
+def stop_validator_daemon():
+    validator_daemon.stop()
+
+
+def validate_with_cli(xml_file, upload_folder):
     command = [
         "java",
         "-jar",
-        jar_path,
+        JAR_PATH,
         "-s",
-        scenarios_file,
+        SCENARIOS_FILE,
         "-r",
-        str(output_directory),
+        str(REPOSITORY_DIRECTORY),
         "--output-directory",
         str(upload_folder),
         "-h",
         xml_file,
     ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    return result.returncode
+
 
+def validator_fingerprint():
+    """Version key of the validator setup, changes with the jar or scenarios.xml."""
+    stats = []
+    for path in (JAR_PATH, SCENARIOS_FILE):
+        try:
+            stat = os.stat(path)
+            stats.append((path, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stats.append((path, None, None))
+
+    if _fingerprint.get("stats") != stats:
+        hashes = [
+            file_hash(path) if size is not None else "missing"
+            for path, size, _ in stats
+        ]
+        _fingerprint["stats"] = stats
+        _fingerprint["value"] = content_hash("KoSIT 1.5.0", *hashes)
+    return _fingerprint["value"]
+
+
+def report_paths(xml_file, upload_folder):
+    stem = Path(xml_file).stem
+    return {
+        "report.xml": Path(upload_folder) / f"{stem}-report.xml",
+        "report.html": Path(upload_folder) / f"{stem}-report.html",
+    }
+
+
+def load_cached_result(key, xml_file, upload_folder):
+    cached = validation_cache.get(key)
+    if cached is None:
+        return None
+    payload, entry = cached
+    for name, target in report_paths(xml_file, upload_folder).items():
+        if (entry / name).is_file():
+            shutil.copyfile(entry / name, target)
+    return payload["return_code"]
+
+
+def store_result(key, return_code, xml_file, upload_folder):
+    files = {
+        name: path
+        for name, path in report_paths(xml_file, upload_folder).items()
+        if path.is_file()
+    }
+    validation_cache.put(key, {"return_code": return_code}, files)
+
+
+def validate(xml_file, upload_folder=Path("./uploads")):
     try:
         logging.info(f"Validating {xml_file} ...")
-        result = subprocess.run(command, capture_output=True, text=True)
-        return_code = result.returncode
+        return_code = None
+        key = None
+        if VALIDATION_CACHE:
+            key = content_hash(Path(xml_file).read_bytes(), validator_fingerprint())
+            return_code = load_cached_result(key, xml_file, upload_folder)
+            if return_code is not None:
+                response = describe(return_code)
+                logging.info(f"Validation cache hit: {response['description']}")
+                return response
 
-        response = {"return_code": return_code, "message": "Validation completed"}
+        if VALIDATOR_DAEMON and validator_daemon.healthy:
+            start_time = time.perf_counter()
+            try:
+                return_code = validator_daemon.validate(xml_file, upload_folder)
+                logging.info(
+                    f"Validator daemon answered in {time.perf_counter() - start_time:.3f} seconds"
+                )
+            except ValidatorBusy as e:
+                return failure(-3, str(e))
+            except requests.RequestException as e:
+                # Daemon went away mid-request, the monitor will bring it back
+                logging.warning(f"Validator daemon unavailable, using CLI: {e}")
+                validator_daemon.healthy = False
+        if return_code is None:
+            return_code = validate_with_cli(xml_file, upload_folder)
 
-        if return_code == 0:
-            response["description"] = (
-                "XRechnung is valid according to KoSIT Validator 1.5.0."
-            )
-        elif return_code > 0:
-            response["description"] = (
-                "XRechnung file is invalid according to KoSIT Validator 1.5.0."
-            )
-        elif return_code == -1:
-            response["description"] = "Parsing error: Incorrect command-line arguments."
-        elif return_code == -2:
-            response["description"] = (
-                "Configuration error: Issues with loading configuration/validation targets."
-            )
-        else:
-            response["description"] = "Unknown error."
+        # Negative codes are setup errors and must not stick to the document
+        if key is not None and return_code >= 0:
+            store_result(key, return_code, xml_file, upload_folder)
 
+        response = describe(return_code)
         logging.info(f"Validation completed: {response['description']}")
         return response
     except Exception as e:
-        return {"return_code": -99, "description": str(e)}
+        return failure(-99, str(e))
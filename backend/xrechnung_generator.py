@@ -1,10 +1,52 @@
 import os
 import csv
 import sys
+import logging
+import threading
 import requests
 from pathlib import Path
 from datetime import datetime
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+TEMPLATE_FOLDER = os.getenv(
+    "TEMPLATE_FOLDER", str(Path(__file__).resolve().parent / "templates")
+)
+# Compiled templates on disk, process pool workers and restarts skip the compile
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", "./uploads/.cache/jinja")
+XRECHNUNG_TEMPLATE = "ubl-3.0.1-xrechnung-template.xml"
+# Rendered pieces joined into one chunk of generate_xrechnung_stream
+XRECHNUNG_STREAM_BUFFER = int(os.getenv("XRECHNUNG_STREAM_BUFFER", "256"))
+
+_template = None
+_template_lock = threading.Lock()
+
+
+def bytecode_cache():
+    """The on-disk bytecode cache, ``None`` if the folder cannot be created."""
+    directory = TEMPLATE_CACHE_DIR
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logging.warning(f"Template cache {directory} unavailable: {e}")
+        return None
+    return FileSystemBytecodeCache(directory)
+
+
+def xrechnung_template():
+    """The compiled XRechnung template, loaded on first use."""
+    global _template
+    with _template_lock:
+        if _template is None:
+            environment = Environment(
+                loader=FileSystemLoader(TEMPLATE_FOLDER),
+                bytecode_cache=bytecode_cache(),
+                # Names like "GmbH & Co. KG" must not break the XML
+                autoescape=True,
+                # Templates ship with the code, no need to stat them on every render
+                auto_reload=False,
+            )
+            _template = environment.get_template(XRECHNUNG_TEMPLATE)
+        return _template
 
 
 class Invoice:
@@ -95,7 +137,7 @@ def validate_xml_file(fileName):
 
 
 # fmt: off
-def generate_xrechnung(invoice_data):
+def xrechnung_invoice(invoice_data):
     invoice = Invoice()
     
     # HEADER ------------------------------------------------------------
@@ -231,12 +273,33 @@ def generate_xrechnung(invoice_data):
             tax_sub_totals[tax_category] = {"priceNet": delivery_details, "taxPercent": tax_percent}
 
     invoice.taxSubTotals = tax_sub_totals
-    
-    template = Template(open("./templates/ubl-3.0.1-xrechnung-template.xml").read())
-    return template.render(data=invoice)
+    return invoice
 # fmt: on
 
 
+def generate_xrechnung(invoice_data):
+    return xrechnung_template().render(data=xrechnung_invoice(invoice_data))
+
+
+def generate_xrechnung_stream(invoice_data, buffer_size=XRECHNUNG_STREAM_BUFFER):
+    """Iterate over the XML in chunks instead of building it in memory.
+
+    The invoice is mapped before the first chunk, so incomplete invoice data
+    raises here and not halfway through a response.
+    """
+    stream = xrechnung_template().stream(data=xrechnung_invoice(invoice_data))
+    stream.enable_buffering(buffer_size)
+    return stream
+
+
+def write_xrechnung(invoice_data, path):
+    """Stream the XML into ``path``, only the path travels back from the pool."""
+    with open(path, "w", encoding="utf-8") as f:
+        for chunk in generate_xrechnung_stream(invoice_data):
+            f.write(chunk)
+    return path
+
+
 def resource_path(relative_path):
     try:
         base_path = sys._MEIPASS